@@ -0,0 +1,377 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Batched COPY ingestion of syslog-ng pipe output into the logs table.
+
+syslog-ng writes one tab-separated line per message (see
+syslog-ng.conf.sample); rows are collected and written with a single
+COPY ... FROM STDIN per batch, flushed when --batch-rows are pending or
+the oldest pending row is --batch-interval seconds old.
+
+With --collapse, a message repeated (same host, program and msg) within
+that many seconds of its first copy is written once as usual, and the
+copies that follow as one more row at the end of the window with their
+number in repeats and when the first and last arrived in repeat_first
+and repeat_last, like syslogd's "last message repeated N times".
+"""
+
+__version__ = '$Id$'
+
+DEFAULT_BATCH_ROWS = 1000
+DEFAULT_BATCH_INTERVAL = 1.0
+DEFAULT_REPORT_INTERVAL = 300
+RECONNECT_DELAY = 5
+
+INGEST_COLS = ['host', 'facility', 'priority', 'level', 'tag',
+               'date', 'time', 'program', 'msg']
+COLLAPSE_COLS = ['repeats', 'repeat_first', 'repeat_last']
+COLLAPSE_KEY = [INGEST_COLS.index(x) for x in ('host', 'program', 'msg')]
+
+import collections
+import cStringIO
+import datetime
+import errno
+import optparse
+import os
+import psycopg2
+import select
+import signal
+import sys
+import time
+
+import pgsyslog
+
+
+class ingeststats(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.nrows = 0
+        self.nbatch = 0
+        self.nreject = 0
+        self.ncollapsed = 0
+        self.latency = 0.
+        self.maxlatency = 0.
+
+    def batch(self, nrows, latency):
+        self.nrows += nrows
+        self.nbatch += 1
+        self.latency += latency
+        self.maxlatency = max(self.maxlatency, latency)
+
+    def reject(self):
+        self.nreject += 1
+
+    def collapsed(self, n):
+        self.ncollapsed += n
+
+    def due(self, interval):
+        return interval > 0 and time.time() - self.start >= interval
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        avg = self.latency / self.nbatch if self.nbatch else 0.
+        return '%d rows in %d batches (%.1f rows/s), batch latency avg %.1f ms max %.1f ms, %d rejected, %d collapsed' % (
+            self.nrows, self.nbatch, self.nrows / elapsed,
+            avg * 1000, self.maxlatency * 1000, self.nreject, self.ncollapsed)
+
+
+class collapser(object):
+    """Holds back the copies of messages repeated within window seconds
+    of the first (see pgsyslog.repeatfilter)"""
+
+    def __init__(self, window):
+        self.window = window
+        # key -> [window end, copies, first copy, last copy, last fields], by window end
+        self.runs = collections.OrderedDict()
+
+    def add(self, fields, t):
+        """Return the rows, (fields, copies, first, last), to write for a
+        message received at t; copies is None for a message as is"""
+        out = self.expire(t)
+        k = tuple(fields[i] for i in COLLAPSE_KEY)
+        run = self.runs.get(k)
+        if run is not None:
+            if not run[1]:
+                run[2] = t
+            run[1] += 1
+            run[3] = t
+            run[4] = fields
+            return out
+        if len(self.runs) >= pgsyslog.COLLAPSE_MAX_KEYS:
+            out.extend(self.pop())
+        self.runs[k] = [t + self.window, 0, None, None, fields]
+        out.append((fields, None, None, None))
+        return out
+
+    def pop(self):
+        k, (end, copies, first, last, fields) = self.runs.popitem(last=False)
+        if copies:
+            yield fields, copies, first, last
+
+    def expire(self, t=None):
+        """Return the rows of the runs whose window ended before t (all
+        if None)"""
+        out = []
+        while self.runs and (t is None or self.deadline() < t):
+            out.extend(self.pop())
+        return out
+
+    def deadline(self):
+        """When the next window ends, or None"""
+        for end, copies, first, last, fields in self.runs.itervalues():
+            return end
+        return None
+
+
+class ingester(object):
+
+    def __init__(self, options):
+        self.dbconnfile = options.dbconnfile
+        self.batch_rows = options.batch_rows
+        self.batch_interval = options.batch_interval
+        self.report_interval = options.report_interval
+        self.verbose = options.verbose
+        self.collapser = None
+        cols = INGEST_COLS
+        if options.collapse > 0:
+            self.collapser = collapser(options.collapse)
+            cols = cols + COLLAPSE_COLS
+        self.copystmt = 'COPY %s (%s) FROM STDIN' % (
+            options.table, pgsyslog.colslist(cols))
+        self.pgdb = None
+        self.rows = []
+        self.batch_started = None
+        self.stats = ingeststats()
+
+    def connect(self):
+        while self.pgdb is None:
+            try:
+                self.pgdb = pgsyslog.dbconnect(self.dbconnfile)
+            except psycopg2.OperationalError, e:
+                self.warn('connect failed, retrying in %d s: %s' % (
+                    RECONNECT_DELAY, str(e).strip()))
+                time.sleep(RECONNECT_DELAY)
+
+    def disconnect(self):
+        if self.pgdb is not None:
+            try:
+                self.pgdb.close()
+            except psycopg2.Error:
+                pass
+            self.pgdb = None
+
+    def warn(self, s):
+        print >> sys.stderr, 'WARNING: %s' % s
+
+    def parse(self, line):
+        """Split one pipe line into INGEST_COLS"""
+        fields = line.split('\t', len(INGEST_COLS) - 1)
+        if len(fields) != len(INGEST_COLS):
+            return None
+        return fields
+
+    def copyrow(self, fields, copies=None, first=None, last=None):
+        """Convert fields into a COPY text-format row"""
+        row = map(copyescape, fields)
+        if self.collapser is not None:
+            if copies is None:
+                row.extend(['\\N'] * len(COLLAPSE_COLS))
+            else:
+                row.extend([str(copies), utcstamp(first), utcstamp(last)])
+        return '\t'.join(row) + '\n'
+
+    def add(self, line):
+        fields = self.parse(line)
+        if fields is None:
+            self.stats.reject()
+            if self.verbose:
+                self.warn('malformed input: %r' % line)
+            return
+        if self.collapser is None:
+            self.append(self.copyrow(fields))
+            return
+        self.appendcollapsed(self.collapser.add(fields, time.time()))
+
+    def expire(self, t=None):
+        """Write the collapsed copies whose window has ended"""
+        if self.collapser is not None:
+            self.appendcollapsed(self.collapser.expire(t))
+
+    def appendcollapsed(self, rows):
+        for fields, copies, first, last in rows:
+            if copies is not None:
+                # Rows saved
+                self.stats.collapsed(copies - 1)
+            self.append(self.copyrow(fields, copies, first, last))
+
+    def append(self, row):
+        if not self.rows:
+            self.batch_started = time.time()
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        t = time.time()
+        while True:
+            self.connect()
+            try:
+                self.copy(rows)
+                break
+            except (psycopg2.OperationalError, psycopg2.InterfaceError), e:
+                self.warn('lost connection, retrying batch of %d: %s' % (
+                    len(rows), str(e).strip()))
+                self.disconnect()
+                time.sleep(RECONNECT_DELAY)
+            except psycopg2.Error, e:
+                self.pgdb.rollback()
+                self.warn('batch of %d failed, inserting rows separately: %s' % (
+                    len(rows), str(e).strip()))
+                self.copyeach(rows)
+                break
+        self.stats.batch(len(rows), time.time() - t)
+
+    def copy(self, rows):
+        c = self.pgdb.cursor()
+        try:
+            c.copy_expert(self.copystmt, cStringIO.StringIO(''.join(rows)))
+        finally:
+            c.close()
+        self.pgdb.commit()
+
+    def copyeach(self, rows):
+        for row in rows:
+            try:
+                self.copy([row])
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except psycopg2.Error, e:
+                self.pgdb.rollback()
+                self.stats.reject()
+                self.warn('rejected row: %s: %r' % (str(e).strip(), row))
+
+    def timeout(self):
+        """How long the input can stay idle before a flush or report is due"""
+        ts = []
+        if self.rows:
+            ts.append(self.batch_started + self.batch_interval)
+        if self.collapser is not None and self.collapser.runs:
+            ts.append(self.collapser.deadline())
+        if self.report_interval > 0:
+            ts.append(self.stats.start + self.report_interval)
+        if not ts:
+            return None
+        return max(0, min(ts) - time.time())
+
+    def run(self, fd):
+        pending = ''
+        try:
+            while True:
+                try:
+                    r = select.select([fd], [], [], self.timeout())[0]
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    r = []
+                if r:
+                    data = os.read(fd, 1 << 16)
+                    if not data:
+                        break
+                    lines = (pending + data).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        self.add(line)
+                self.expire(time.time())
+                if self.rows and time.time() - self.batch_started >= self.batch_interval:
+                    self.flush()
+                if self.stats.due(self.report_interval):
+                    self.report()
+            if pending:
+                self.add(pending)
+        finally:
+            self.expire()
+            self.flush()
+            self.report()
+
+    def report(self):
+        print >> sys.stderr, self.stats.report()
+        self.stats.reset()
+
+
+def utcstamp(t):
+    return pgsyslog.stampstr(datetime.datetime.utcfromtimestamp(t))
+
+def copyescape(s):
+    # The pipe never delivers a raw newline (syslog-ng.conf.sample
+    # replaces them), but one must not end a COPY row either
+    return s.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\r', '\\r').replace('\n', '\\n').replace('\0', '')
+
+def optparseconfig():
+    parser = optparse.OptionParser('usage: %prog [options] [pipe]',
+                                   version=__version__)
+    parser.add_option('-d', '--dbconnfile', dest='dbconnfile', type='string',
+                      help='File containing PostgreSQL connection string; '\
+                      'default read from SYSLOG_PGDB environment variable')
+    parser.add_option('-t', '--table', default='logs',
+                      help='Table to load into (default: %default)')
+    parser.add_option('-b', '--batch-rows', type='int', default=DEFAULT_BATCH_ROWS,
+                      help='Flush after this many rows (default: %default)')
+    parser.add_option('-i', '--batch-interval', type='float', default=DEFAULT_BATCH_INTERVAL,
+                      help='Flush when the oldest pending row is this old (seconds, default: %default)')
+    parser.add_option('-r', '--report-interval', type='float', default=DEFAULT_REPORT_INTERVAL,
+                      help='Report rows/s and batch latency this often (seconds, 0=only at exit, default: %default)')
+    parser.add_option('-c', '--collapse', type='float', default=0, metavar='SECONDS',
+                      help='Write the copies of a message repeated within SECONDS of the first '
+                           'as one row (needs the repeats columns, see postgres.sql)')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='Report malformed input lines')
+    return parser
+
+def main():
+    parser = optparseconfig()
+    options, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error('at most one input pipe may be specified')
+    if options.batch_rows < 1:
+        parser.error('--batch-rows must be positive')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    ing = ingester(options)
+    try:
+        ing.connect()
+        if args:
+            fd = os.open(args[0], os.O_RDONLY)
+        else:
+            fd = sys.stdin.fileno()
+        ing.run(fd)
+    except EnvironmentError, e:
+        parser.error('%s' % e)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ing.disconnect()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Versioned changes to the logs schema after postgres.sql (version 1).
+
+status    show which versions are applied
+migrate   apply the pending versions in order, up to --to
+check     EXPLAIN the query of each pgsyslog.py mode and report whether
+          it uses the index meant for it
+
+The applied versions are recorded in <table>_schema. Indexes are built
+and dropped CONCURRENTLY (unless the table is partitioned), so inserts
+go on meanwhile; each step can be repeated, so a migration that fails
+half way is simply run again.
+"""
+
+__version__ = '$Id$'
+
+CHECK_TAILCOUNT = 1000
+# Partitions a 1 hour range may read: the hour's, the one before it at
+# a boundary, and the default partition
+CHECK_PRUNED_PARTITIONS = 3
+
+import optparse
+import psycopg2
+import re
+import sys
+
+import pgsyslog
+
+MIGRATIONS = [
+    (1, 'postgres.sql'),
+    (2, 'BRIN index on stamp and seq'),
+    (3, 'stamp index covering host, facility, priority and program, replacing the plain one'),
+    (4, 'host index for -h, with wildcards (text_pattern_ops)'),
+    (5, 'partial stamp index for priority err and worse'),
+    (6, 'drop the (stamp, host, msg) index'),
+]
+
+SEVERE_PRIORITIES = ['emerg', 'alert', 'crit', 'err']
+
+# The covering stamp index of version 3, with or without INCLUDE
+COVER_INDEX = r'USING btree \(stamp(?:\) INCLUDE \(|, )host'
+
+# Name, pgsyslog.py arguments, extra condition and clauses, what the
+# definition of an index the plan uses should match, and for checks
+# only run on a partitioned table, how many partitions the plan may
+# read. The arguments only contribute the filter; %(host)s and
+# %(prefix)s are filled in from the newest row.
+PLAN_CHECKS = [
+    ('tail', ['-i', '1 hour'], '', ['ORDER BY stamp DESC', 'LIMIT %d' % CHECK_TAILCOUNT],
+     COVER_INDEX, None),
+    ('poller', [], 'seq > %(mseq)s', ['ORDER BY seq', 'LIMIT %d' % pgsyslog.DEFAULT_CATCHUP_BATCH],
+     r'USING btree \(seq\)', None),
+    ('host', ['-i', '24 hours', '-h', '%(host)s'], '', ['ORDER BY stamp'],
+     r'USING btree \(host text_pattern_ops, stamp\)', None),
+    ('host wildcard', ['-i', '24 hours', '-h', '%(prefix)s*'], '', ['ORDER BY stamp'],
+     r'USING btree \(host text_pattern_ops, stamp\)', None),
+    ('priority', ['-i', '24 hours', '--priority', 'err', '--priority', 'crit'], '',
+     ['ORDER BY stamp DESC', 'LIMIT %d' % CHECK_TAILCOUNT], r'WHERE .*priority', None),
+    ('hosts', ['-i', '1 hour'], '', ['GROUP BY host'], COVER_INDEX, None),
+    ('view', ['-i', '7 days'], '', [], r'USING brin|USING btree \(stamp', None),
+    ('partitions', ['-i', '1 hour'], '', [], COVER_INDEX + '|USING brin',
+     CHECK_PRUNED_PARTITIONS),
+]
+
+# A plain btree on stamp alone, which version 3 replaces
+plain_stamp_re = re.compile(r'^CREATE INDEX \S+ ON (?:ONLY )?\S+ USING btree \(stamp\)$')
+
+
+class planfilter(pgsyslog.syslogfilter):
+    """Just the WHERE clause pgsyslog.py builds from its options"""
+
+    def __init__(self, options, logstable):
+        self.logstable = logstable
+        self.verbose = False
+        self.setfilter(options)
+
+
+class migrator(object):
+
+    def __init__(self, options):
+        self.table = options.table
+        self.schema = '%s_schema' % options.table
+        self.verbose = options.verbose
+        self.dry_run = options.dry_run
+        self.concurrently = options.concurrently
+        self.force_index = options.force_index
+        self.pgdb = pgsyslog.dbconnect(options.dbconnfile)
+        # Statements run one at a time, as CREATE INDEX CONCURRENTLY must
+        self.pgdb.autocommit = True
+
+    def close(self):
+        self.pgdb.close()
+
+    def execute(self, c, stmt, args=None, change=False):
+        """Run stmt; with --dry-run, statements that change the schema
+        are only printed"""
+        if self.verbose or (self.dry_run and change):
+            print >> sys.stderr, '%s;' % (c.mogrify(stmt, args) if args else stmt)
+        if not (self.dry_run and change):
+            c.execute(stmt, args)
+
+    def run(self, command, to=None):
+        c = self.pgdb.cursor()
+        try:
+            if self.relkind(c, self.table) not in ('r', 'p'):
+                raise pgsyslog.ApplicationError, 'no table %s' % self.table
+            if command == 'migrate':
+                return self.do_migrate(c, to)
+            return getattr(self, 'do_%s' % command)(c)
+        finally:
+            c.close()
+
+    def relkind(self, c, name):
+        self.execute(c, 'SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', (name,))
+        r = c.fetchone()
+        return r and r[0]
+
+    def applied(self, c):
+        """Return {version: when applied}"""
+        if self.relkind(c, self.schema) is None:
+            return {}
+        self.execute(c, 'SELECT version, applied FROM %s' % self.schema)
+        return dict(c.fetchall())
+
+    def do_status(self, c):
+        applied = self.applied(c)
+        for version, name in MIGRATIONS:
+            when = applied.get(version)
+            print '%3d  %-19s  %s' % (version, when.strftime('%Y-%m-%d %H:%M:%S') if when else 'pending',
+                                      name)
+
+    def do_migrate(self, c, to=None):
+        applied = self.applied(c)
+        self.execute(c, 'CREATE TABLE IF NOT EXISTS %s (version integer PRIMARY KEY, '
+                        'name text NOT NULL, applied timestamp NOT NULL DEFAULT localtimestamp)' %
+                     self.schema, change=True)
+        for version, name in MIGRATIONS:
+            if version in applied or (to is not None and version > to):
+                continue
+            print >> sys.stderr, '%d: %s' % (version, name)
+            getattr(self, 'v%d' % version)(c)
+            self.execute(c, 'INSERT INTO %s (version, name) VALUES (%%s, %%s)' % self.schema,
+                         (version, name), change=True)
+
+    def concurrent(self, c):
+        # Not possible on a partitioned table (PostgreSQL 11), whose
+        # indexes are built under a lock that blocks inserts
+        if self.concurrently is False or self.relkind(c, self.table) == 'p':
+            return ''
+        return ' CONCURRENTLY'
+
+    def createindex(self, c, name, definition):
+        # A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind
+        self.execute(c, 'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)',
+                     (name,))
+        r = c.fetchone()
+        if r and not r[0]:
+            self.dropindex(c, name)
+        self.execute(c, 'CREATE INDEX%s IF NOT EXISTS %s ON %s %s' % (
+            self.concurrent(c), name, self.table, definition), change=True)
+
+    def dropindex(self, c, name):
+        self.execute(c, 'DROP INDEX%s IF EXISTS %s' % (self.concurrent(c), name), change=True)
+
+    def v1(self, c):
+        """The schema of postgres.sql, which is already there"""
+
+    def v2(self, c):
+        # A few pages for the whole table; serves long time ranges,
+        # which a btree would answer no faster from far more pages
+        self.createindex(c, '%s_stamp_seq_brin_ix' % self.table, 'USING brin (stamp, seq)')
+
+    def v3(self, c):
+        # --hosts, --hstats and --view without the rollup table become
+        # index-only scans; tail mode still reads the index in order
+        cols = 'host, facility, priority, program'
+        if self.pgdb.server_version >= 110000:
+            definition = 'USING btree (stamp) INCLUDE (%s)' % cols
+        else:
+            definition = 'USING btree (stamp, %s)' % cols
+        self.createindex(c, '%s_stamp_cover_ix' % self.table, definition)
+        # Found by definition: on a table pgpartman.py converted, the
+        # parent's is named by PostgreSQL, and logs_stamp_ix is that
+        # index's on the first partition, which cannot be dropped alone
+        for name, idef in self.tableindexes(c).iteritems():
+            if plain_stamp_re.match(idef):
+                self.dropindex(c, name)
+
+    def tableindexes(self, c):
+        """Return {name: definition} for the indexes of the table itself"""
+        self.execute(c, 'SELECT c.relname, pg_get_indexdef(c.oid) FROM pg_index i '
+                        'JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = %s::regclass',
+                     (self.table,))
+        return dict(c.fetchall())
+
+    def v4(self, c):
+        # -h, exact or with a literal prefix (see syslogfilter.globclause)
+        self.createindex(c, '%s_host_stamp_ix' % self.table,
+                         'USING btree (host text_pattern_ops, stamp)')
+
+    def v5(self, c):
+        self.createindex(c, '%s_stamp_severe_ix' % self.table,
+                         'USING btree (stamp) WHERE priority IN (%s)' % ', '.join(
+                             "'%s'" % x for x in SEVERE_PRIORITIES))
+
+    def v6(self, c):
+        # Copies every message into a btree, and no query leads with msg
+        self.dropindex(c, '%s_stamp_msg_ix' % self.table)
+
+    def do_check(self, c):
+        """EXPLAIN each of PLAN_CHECKS; returns whether all used the
+        intended index"""
+        self.execute(c, 'SELECT max(seq) FROM %s' % self.table)
+        maxseq, = c.fetchone()
+        self.execute(c, 'SELECT host FROM %s WHERE host IS NOT NULL ORDER BY seq DESC LIMIT 1' %
+                     self.table)
+        r = c.fetchone()
+        if r is None:
+            raise pgsyslog.ApplicationError, '%s has no hosts; nothing to plan for' % self.table
+        host, = r
+        values = {'host': host, 'prefix': host[:3]}
+        partitioned = self.relkind(c, self.table) == 'p'
+        if self.force_index:
+            self.execute(c, 'SET enable_seqscan = off')
+        ok = True
+        for name, args, where, clauses, want, most in PLAN_CHECKS:
+            if most is not None and not partitioned:
+                continue
+            # A parser of its own, as appended options pile up in the defaults
+            options, rest = pgsyslog.optparseconfig().parse_args(['-n', '1'] + [x % values for x in args])
+            pf = planfilter(options, self.table)
+            statement = pf.mkstmt(pgsyslog.SYSLOG_BASE_COLS + ['program'], where, clauses)
+            if name in ('hosts', 'view', 'partitions'):
+                # Aggregates, so only the columns they read count
+                statement = pf.mkstmt('host, COUNT(*)' if name == 'hosts' else 'COUNT(*)',
+                                      where, clauses)
+            sqla = dict(pf.sqla, mseq=max(0, maxseq - pgsyslog.DEFAULT_CATCHUP_BATCH))
+            self.execute(c, 'EXPLAIN %s' % statement, sqla)
+            plan = [x for x, in c.fetchall()]
+            used = self.indexdefs(c, set(m.group(1) for m in map(
+                pgsyslog.plan_index_re.search, plan) if m))
+            match = any(re.search(want, x) for _, x in used.itervalues())
+            if most is not None:
+                # Each partition read has an index of its own in the plan
+                match = match and len(set(t for t, _ in used.itervalues())) <= most
+            ok = ok and match
+            print '%-14s %-4s %s' % (name, 'ok' if match else 'MISS',
+                                     ', '.join(sorted(used)) or 'no index')
+            if not match or self.verbose:
+                for line in plan:
+                    print '    %s' % line
+        return ok
+
+    def indexdefs(self, c, names):
+        """Return {name: (table, definition)} for the indexes names"""
+        if not names:
+            return {}
+        self.execute(c, 'SELECT c.relname, i.indrelid::regclass::text, pg_get_indexdef(c.oid) '
+                        'FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid '
+                        'WHERE c.relname = ANY(%s)', (sorted(names),))
+        return dict((name, (table, idef)) for name, table, idef in c.fetchall())
+
+
+def optparseconfig():
+    parser = optparse.OptionParser('usage: %prog [options] status|migrate|check',
+                                   version=__version__)
+    parser.add_option('-d', '--dbconnfile', dest='dbconnfile', type='string',
+                      help='File containing PostgreSQL connection string; '\
+                      'default read from SYSLOG_PGDB environment variable')
+    parser.add_option('-t', '--table', default='logs',
+                      help='Table to migrate (default: %default)')
+    parser.add_option('', '--to', type='int', metavar='VERSION',
+                      help='Migrate no further than VERSION')
+    pgsyslog.addboolopt(parser, 'concurrently',
+                        help='building and dropping indexes without blocking inserts '
+                             '(default: unless the table is partitioned)')
+    parser.add_option('', '--force-index', action='store_true',
+                      help='For check, disable sequential scans (for a small test database, '
+                           'where they would always win)')
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help='Print the statements that would change the schema instead of running them')
+    parser.add_option('', '--sql-verbose', dest='verbose', action='store_true',
+                      help='Print SQL statements as they are executed')
+    return parser
+
+def main():
+    parser = optparseconfig()
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ('status', 'migrate', 'check'):
+        parser.error('exactly one of status, migrate or check is required')
+    if options.to is not None and options.to not in dict(MIGRATIONS):
+        parser.error('no version %d' % options.to)
+    try:
+        m = migrator(options)
+        try:
+            ok = m.run(args[0], options.to)
+        finally:
+            m.close()
+    except (EnvironmentError, psycopg2.Error), e:
+        parser.error(('%s' % e).strip())
+    if args[0] == 'check' and not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Range partitioning of the logs table on stamp.
+
+convert   turn a plain logs table into a partitioned one; the old table
+          becomes the partition for everything before the next period,
+          its indexes renamed to <table>_legacy_*, and the new parent
+          gets each of them under the old name (every partition then
+          has them), and one on seq for the primary key. That one is
+          built CONCURRENTLY first; the rest holds an ACCESS EXCLUSIVE
+          lock on the table, blocking inserts while the old table is
+          scanned once to check that it fits its bound
+maintain  create partitions --ahead of time and detach or drop the ones
+          older than --retain (run this from cron), first exporting them
+          to files under --archive, which pgsyslog.py --archive reads
+list      show partitions, their bounds and sizes
+
+Requires PostgreSQL 11 or later.
+"""
+
+__version__ = '$Id$'
+
+DEFAULT_AHEAD = '3 days'
+DEFAULT_GRANULARITY = 'daily'
+ARCHIVE_ITERSIZE = 10000
+
+import datetime
+import itertools
+import optparse
+import os
+import psycopg2
+import re
+import sys
+
+import pgsyslog
+
+PARTITION_STEPS = {
+    'daily': datetime.timedelta(days=1),
+    'hourly': datetime.timedelta(hours=1),
+}
+PARTITION_NAME_FORMATS = {
+    'daily': '%Y%m%d',
+    'hourly': '%Y%m%d%H',
+}
+# In place of the primary key, which on a partitioned table would have
+# to include stamp; built on the old table, and then copied from it like
+# its other indexes
+PARTITION_INDEX_COLS = [('seq',)]
+BOUND_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+bound_re = re.compile(r"FROM \((.*?)\) TO \((.*?)\)")
+
+
+class partition(object):
+
+    def __init__(self, name, lo, hi, size, default=False):
+        self.name = name
+        self.lo = lo
+        self.hi = hi
+        self.size = size
+        self.default = default
+
+    def boundstr(self):
+        if self.default:
+            return 'DEFAULT'
+        return '[%s, %s)' % (self.lo or 'MINVALUE', self.hi or 'MAXVALUE')
+
+
+class partman(object):
+
+    def __init__(self, options):
+        self.table = options.table
+        self.legacy = '%s_legacy' % options.table
+        self.default = '%s_default' % options.table
+        self.granularity = options.granularity
+        self.ahead = options.ahead
+        self.retain = options.retain
+        self.detach = options.detach
+        self.verbose = options.verbose
+        self.dry_run = options.dry_run
+        self.archive = None
+        if options.archive:
+            if not os.path.isdir(options.archive):
+                raise pgsyslog.ApplicationError, 'no archive directory %s' % options.archive
+            self.archive = pgsyslog.logarchive(options.archive)
+        self.pgdb = pgsyslog.dbconnect(options.dbconnfile)
+        if self.pgdb.server_version < 110000:
+            raise pgsyslog.ApplicationError, 'PostgreSQL 11 or later is required'
+
+    def close(self):
+        self.pgdb.close()
+
+    def execute(self, c, stmt, args=None):
+        if self.verbose or self.dry_run:
+            print >> sys.stderr, '%s;' % (c.mogrify(stmt, args) if args else stmt)
+        c.execute(stmt, args)
+
+    def run(self, command):
+        c = self.pgdb.cursor()
+        try:
+            getattr(self, 'do_%s' % command)(c)
+        except:
+            self.pgdb.rollback()
+            raise
+        else:
+            if self.dry_run:
+                self.pgdb.rollback()
+            else:
+                self.pgdb.commit()
+        finally:
+            c.close()
+
+    def legacyname(self, name):
+        if name.startswith(self.table + '_'):
+            return self.legacy + name[len(self.table):]
+        return '%s_legacy' % name
+
+    def servertime(self, c, interval):
+        self.execute(c, 'SELECT localtimestamp, localtimestamp + %s::interval',
+                     (interval,))
+        return c.fetchone()
+
+    def relkind(self, c, name):
+        self.execute(c, 'SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)',
+                     (name,))
+        r = c.fetchone()
+        return r and r[0]
+
+    def partitions(self, c):
+        self.execute(c, 'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), '
+                        'pg_total_relation_size(c.oid) '
+                        'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                        'WHERE i.inhparent = %s::regclass', (self.table,))
+        parts = []
+        for name, bound, size in c.fetchall():
+            if bound == 'DEFAULT':
+                parts.append(partition(name, None, None, size, default=True))
+                continue
+            m = bound_re.search(bound)
+            if m is None:
+                raise pgsyslog.ApplicationError, 'unexpected partition bound for %s: %s' % (name, bound)
+            parts.append(partition(name, parsebound(m.group(1)),
+                                   parsebound(m.group(2)), size))
+        parts.sort(key=lambda p: (p.default, p.lo or datetime.datetime.min))
+        return parts
+
+    def getgranularity(self, parts):
+        """Use --granularity, or infer it from the newest regular partition"""
+        spans = [p.hi - p.lo for p in parts if p.lo and p.hi]
+        if spans:
+            for k, step in PARTITION_STEPS.iteritems():
+                if step == spans[-1]:
+                    if self.granularity and self.granularity != k:
+                        raise pgsyslog.ApplicationError, \
+                            'existing partitions are %s, not %s' % (k, self.granularity)
+                    return k
+        return self.granularity or DEFAULT_GRANULARITY
+
+    def do_list(self, c):
+        for p in self.partitions(c):
+            print '%-24s %-48s %s' % (p.name, p.boundstr(), sizeformat(p.size))
+
+    def do_convert(self, c):
+        if self.relkind(c, self.table) != 'r':
+            raise pgsyslog.ApplicationError, '%s is not a plain table' % self.table
+        if self.relkind(c, self.legacy) is not None:
+            raise pgsyslog.ApplicationError, '%s already exists' % self.legacy
+        granularity = self.granularity or DEFAULT_GRANULARITY
+        self.prebuild(c)
+        self.execute(c, 'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % self.table)
+        self.execute(c, "SELECT pg_get_serial_sequence(%s, 'seq')", (self.table,))
+        seqname, = c.fetchone()
+        self.execute(c, 'SELECT tableowner FROM pg_tables WHERE tablename = %s', (self.table,))
+        owner, = c.fetchone()
+        self.execute(c, 'SELECT grantee, privilege_type FROM information_schema.role_table_grants '
+                        'WHERE table_name = %s AND grantee <> %s', (self.table, owner))
+        grants = c.fetchall()
+        self.execute(c, 'SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger '
+                        'WHERE tgrelid = %s::regclass AND NOT tgisinternal', (self.table,))
+        triggers = c.fetchall()
+        # Unique ones (the primary key) cannot be had without stamp
+        self.execute(c, 'SELECT c.relname, pg_get_indexdef(c.oid) FROM pg_index i '
+                        'JOIN pg_class c ON c.oid = i.indexrelid '
+                        'WHERE i.indrelid = %s::regclass AND NOT i.indisunique', (self.table,))
+        indexes = c.fetchall()
+
+        self.execute(c, 'ALTER TABLE %s RENAME TO %s' % (self.table, self.legacy))
+        self.execute(c, 'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (stamp)' % (
+            self.table, self.legacy))
+        if seqname:
+            self.execute(c, 'ALTER SEQUENCE %s OWNED BY %s.seq' % (seqname, self.table))
+        # The definitions were read before the rename, so they are on
+        # the parent; the old table's indexes become its partition's on
+        # ATTACH, which would otherwise build them under the lock.
+        for name, idef in indexes:
+            self.execute(c, 'ALTER INDEX %s RENAME TO %s' % (name, self.legacyname(name)))
+            self.execute(c, idef)
+        for grantee, priv in grants:
+            self.execute(c, 'GRANT %s ON %s TO "%s"' % (priv, self.table, grantee))
+        # Triggers (e.g. logs_notify) move to the parent; the definition
+        # is rendered with the table's new name, so swap it back.
+        ontable = re.compile(r' ON (\S+\.)?%s ' % re.escape(self.legacy))
+        for name, tdef in triggers:
+            self.execute(c, 'DROP TRIGGER %s ON %s' % (name, self.legacy))
+            self.execute(c, ontable.sub(' ON %s ' % self.table, tdef, 1))
+
+        stamp, _ = self.servertime(c, '0')
+        first = truncstamp(stamp, granularity) + PARTITION_STEPS[granularity]
+        self.execute(c, 'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%s)' % (
+            self.table, self.legacy, boundliteral(first)))
+        self.execute(c, 'CREATE TABLE %s PARTITION OF %s DEFAULT' % (self.default, self.table))
+        self.premake(c, self.partitions(c), granularity)
+
+    def prebuild(self, c):
+        """Build the indexes of PARTITION_INDEX_COLS on the plain table
+        CONCURRENTLY, so inserts go on meanwhile; with --dry-run, in
+        the transaction, which is rolled back"""
+        concurrently = '' if self.dry_run else ' CONCURRENTLY'
+        if concurrently:
+            # Not possible in a transaction block
+            self.pgdb.commit()
+            self.pgdb.autocommit = True
+        try:
+            for cols in PARTITION_INDEX_COLS:
+                name = '%s_%s_ix' % (self.table, '_'.join(cols))
+                # A failed CREATE INDEX CONCURRENTLY leaves an invalid
+                # index behind
+                self.execute(c, 'SELECT indisvalid FROM pg_index '
+                                'WHERE indexrelid = to_regclass(%s)', (name,))
+                r = c.fetchone()
+                if r and not r[0]:
+                    self.execute(c, 'DROP INDEX%s %s' % (concurrently, name))
+                self.execute(c, 'CREATE INDEX%s IF NOT EXISTS %s ON %s (%s)' % (
+                    concurrently, name, self.table, pgsyslog.colslist(cols)))
+        finally:
+            if concurrently:
+                self.pgdb.autocommit = False
+
+    def do_maintain(self, c):
+        if self.relkind(c, self.table) != 'p':
+            raise pgsyslog.ApplicationError, '%s is not partitioned; run convert first' % self.table
+        parts = self.partitions(c)
+        self.premake(c, parts, self.getgranularity(parts))
+        if self.retain:
+            self.expire(c, parts)
+
+    def premake(self, c, parts, granularity):
+        """Create partitions from the newest existing one to --ahead"""
+        step = PARTITION_STEPS[granularity]
+        stamp, horizon = self.servertime(c, self.ahead)
+        his = [p.hi for p in parts if p.hi]
+        lo = max(his) if his else truncstamp(stamp, granularity)
+        hasdefault = any(p.default for p in parts)
+        while lo < horizon:
+            hi = lo + step
+            self.mkpartition(c, lo, hi, granularity, hasdefault)
+            lo = hi
+
+    def mkpartition(self, c, lo, hi, granularity, hasdefault):
+        name = '%s_p%s' % (self.table, lo.strftime(PARTITION_NAME_FORMATS[granularity]))
+        self.execute(c, 'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (name, self.table))
+        if hasdefault:
+            # Rows that arrived while no partition covered them; moving
+            # them out lets the default partition be re-validated.
+            self.execute(c, 'WITH moved AS (DELETE FROM %s WHERE stamp >= %%s AND stamp < %%s '
+                            'RETURNING *) INSERT INTO %s SELECT * FROM moved' % (
+                                self.default, name), (lo, hi))
+        self.execute(c, 'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%s) TO (%s)' % (
+            self.table, name, boundliteral(lo), boundliteral(hi)))
+
+    def expire(self, c, parts):
+        self.execute(c, 'SELECT localtimestamp - %s::interval', (self.retain,))
+        cutoff, = c.fetchone()
+        for p in parts:
+            if p.default or p.hi is None or p.hi > cutoff:
+                continue
+            if self.archive is not None:
+                self.export(p)
+            if self.detach:
+                self.execute(c, 'ALTER TABLE %s DETACH PARTITION %s' % (self.table, p.name))
+            else:
+                self.execute(c, 'DROP TABLE %s' % p.name)
+
+    def export(self, p):
+        """Write partition p to the archive, in stamp order"""
+        name = p.name + pgsyslog.ARCHIVE_SUFFIX
+        if self.verbose or self.dry_run:
+            print >> sys.stderr, '-- archive %s to %s' % (p.name, os.path.join(self.archive.path, name))
+        if self.dry_run:
+            return
+        c = self.pgdb.cursor('pgpartman_export')
+        try:
+            c.itersize = ARCHIVE_ITERSIZE
+            c.execute('SELECT * FROM %s ORDER BY stamp' % p.name)
+            rows = iter(c)
+            # A named cursor's description is only known once it has fetched
+            first = list(itertools.islice(rows, 1))
+            if first:
+                cols = [x[0] for x in c.description]
+                self.archive.write(name, cols, itertools.chain(first, rows))
+        finally:
+            c.close()
+
+
+def parsebound(s):
+    if s == 'MINVALUE' or s == 'MAXVALUE':
+        return None
+    return datetime.datetime.strptime(s.strip("'"), BOUND_FORMAT)
+
+def boundliteral(stamp):
+    # Bounds must be plain literals before PostgreSQL 12
+    return "'%s'" % stamp.strftime(BOUND_FORMAT)
+
+def truncstamp(stamp, granularity):
+    if granularity == 'hourly':
+        return stamp.replace(minute=0, second=0, microsecond=0)
+    return stamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def sizeformat(n):
+    for unit in 'bytes', 'kB', 'MB', 'GB':
+        if n < 10240:
+            return '%d %s' % (n, unit)
+        n //= 1024
+    return '%d TB' % n
+
+def optparseconfig():
+    parser = optparse.OptionParser('usage: %prog [options] convert|maintain|list',
+                                   version=__version__)
+    parser.add_option('-d', '--dbconnfile', dest='dbconnfile', type='string',
+                      help='File containing PostgreSQL connection string; '\
+                      'default read from SYSLOG_PGDB environment variable')
+    parser.add_option('-t', '--table', default='logs',
+                      help='Table to partition (default: %default)')
+    parser.add_option('-g', '--granularity', type='choice',
+                      choices=sorted(PARTITION_STEPS),
+                      help='Partition size, daily or hourly (default: same as existing '
+                           'partitions, otherwise %s)' % DEFAULT_GRANULARITY)
+    parser.add_option('-a', '--ahead', default=DEFAULT_AHEAD,
+                      help='SQL interval to create partitions ahead of time (default: %default)')
+    parser.add_option('-r', '--retain',
+                      help='SQL interval; partitions entirely older than this are expired')
+    parser.add_option('', '--detach', action='store_true',
+                      help='Detach expired partitions instead of dropping them')
+    parser.add_option('', '--archive', metavar='DIR',
+                      help='Export expired partitions to files in DIR before they are '
+                           'dropped or detached')
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help='Print statements and roll back instead of committing')
+    parser.add_option('', '--sql-verbose', dest='verbose', action='store_true',
+                      help='Print SQL statements as they are executed')
+    return parser
+
+def main():
+    parser = optparseconfig()
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ('convert', 'maintain', 'list'):
+        parser.error('exactly one of convert, maintain or list is required')
+    try:
+        pm = partman(options)
+        try:
+            pm.run(args[0])
+        finally:
+            pm.close()
+    except (EnvironmentError, psycopg2.Error), e:
+        parser.error(('%s' % e).strip())
+
+if __name__ == '__main__':
+    main()
@@ -20,26 +20,142 @@ __version__ = '$Id: pgsyslog.py 304 2019-07-12 22:02:06Z dima $'
 
 # TODO:
 #  - atrun/save-entropy summarization
-#  - expand IN filters to support LIKE or other wildcards
 
 DEFAULT_DATE_FORMAT = '%b %d %H:%M:%S'
 DEFAULT_INTERVAL = '24 hours'
 DEFAULT_TAILCOUNT = 1000
+DEFAULT_ITERSIZE = 2000
+DEFAULT_CATCHUP_BATCH = 1000
+# Without LISTEN/NOTIFY, -P polls every --poll-interval while records
+# arrive, backing off by POLL_BACKOFF per empty poll up to this
+DEFAULT_POLL_MAX_INTERVAL = 5
+POLL_BACKOFF = 2
+
+# Rows per hand-off, and hand-offs buffered, per database when streaming
+# from several at once
+STREAM_PAGE = 500
+STREAM_QUEUE_PAGES = 8
+# How often a reader waiting for room in its queue checks whether the
+# merge was abandoned, and how long one is given to notice before its
+# query is cancelled (seconds)
+STREAM_CANCEL_CHECK = .1
+STREAM_CANCEL_WAIT = 1
+
+OUTPUT_BUFSIZE = 1 << 16
+STAMP_CACHE_SIZE = 4096
+
+# Idle connections kept per database by connpool, and how long one may
+# sit idle before it is checked when reused (seconds)
+POOL_MAXIDLE = 4
+POOL_CHECK_AFTER = 30
+
+# Results of queries whose time range ended at least CACHE_SEAL_DELAY
+# ago (so no transaction still in flight can add to it) are cached, if
+# they have at most CACHE_MAX_ROWS rows
+DEFAULT_CACHE_SIZE = 256
+CACHE_SEAL_DELAY = '5 minutes'
+CACHE_MAX_ROWS = 100000
+
+# Heavy-hitter counters kept per column for --stats, overall and per
+# slot of a sliding window; (seconds, slot width) of the windows
+# reported in polling mode
+STATS_TOPK = 100
+STATS_WINDOW_TOPK = 20
+STATS_WINDOWS = [(60, 10), (300, 30), (3600, 300)]
+
+# Ingestion delays (stamp minus the date and time the device sent) are
+# counted in buckets from DELAY_RESOLUTION seconds up, each
+# 2 ** (1 / DELAY_BUCKETS_PER_OCTAVE) times as wide as the last (about
+# 9%); per host for the first DELAY_MAX_HOSTS hosts, the rest together
+DELAY_RESOLUTION = .001
+DELAY_BUCKETS_PER_OCTAVE = 8
+DELAY_MAX_HOSTS = 1000
+DELAY_OTHER_HOSTS = '(other)'
+DEFAULT_DELAY_METRICS_INTERVAL = 60
+
+# Expired partitions exported by pgpartman.py maintain --archive: one
+# column-oriented file per partition, in row groups of ARCHIVE_GROUP_ROWS
+# rows sorted by stamp with each column compressed separately, listed
+# in ARCHIVE_INDEX with their stamp range and hosts. Matching rows are
+# loaded into the temporary table ARCHIVE_TABLE for a query.
+ARCHIVE_MAGIC = 'PGSYSLOGARCHIVE1\n'
+ARCHIVE_SUFFIX = '.pga'
+ARCHIVE_INDEX = 'index.json'
+ARCHIVE_GROUP_ROWS = 65536
+ARCHIVE_TABLE = 'logs_archive'
+
+# Runs of identical (host, program, msg) collapsed by --collapse (and
+# pgingest.py --collapse) are shown as REPEAT_FORMAT % (copies, msg);
+# at most COLLAPSE_MAX_KEYS runs are followed at once
+REPEAT_FORMAT = 'message repeated %d times: [ %s ]'
+COLLAPSE_MAX_KEYS = 10000
+
+# Statements are shown up to this many characters in the --profile report
+PROFILE_SQL_WIDTH = 100
+
+STAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Must match the logs_msg_fts_ix expression in postgres.sql
+SEARCH_VECTOR = "to_tsvector('simple', msg)"
+SEARCH_SYNTAX_FUNCS = {
+    'web': 'websearch_to_tsquery',
+    'plain': 'plainto_tsquery',
+    'phrase': 'phraseto_tsquery',
+    'tsquery': 'to_tsquery',
+}
+
+# The rollup's primary key cannot hold NULL, so these are rolled up as
+# '' with bit 1 << i of its nulls column set (see postgres.sql); read
+# back as NULL, the rollup groups and filters them as the raw rows do
+ROLLUP_KEY_COLS = ['host', 'facility', 'priority', 'program']
+
+IN_ARRAY_OPS = {'IN': '= ANY', 'NOT IN': '<> ALL'}
+
+NOTIFY_CHANNEL = 'logs_insert'
+NOTIFY_TRIGGER = 'logs_notify'
 
 SYSLOG_BASE_COLS = ['stamp', 'date', 'time', 'host', 'msg']
 SYSLOG_ALL_COLS = SYSLOG_BASE_COLS + \
                   ['seq', 'facility', 'priority', 'tag', 'program']
+# Set by pgingest.py --collapse; selected where the table has them
+SYSLOG_REPEAT_COLS = ['repeats', 'repeat_first', 'repeat_last']
 
+import bisect
+import collections
+import cPickle
+import cStringIO
 import datetime
+import errno
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import marshal
+import math
+import multiprocessing.pool
 import operator
 import os
 import optparse
-import psycopg2, psycopg2.extras
+import psycopg2, psycopg2.extensions
+import Queue
+import re
+import select
 import signal
+import struct
 import sys
+import threading
 import time
+import weakref
+import zlib
 
 now = datetime.datetime.utcnow
+EPOCH = datetime.datetime(1970, 1, 1)
+
+dblabel_re = re.compile(r'^[\w.-]+$')
+# The psycopg2 placeholders of a statement, and its escaped %
+param_re = re.compile(r'%(?:\((\w+)\)s|%)')
+plan_index_re = re.compile(r'Index (?:Only )?Scan(?: Backward)? (?:using|on) (\S+)')
 
 # Dynamic
 LOCAL_TIMEZONE = None
@@ -51,7 +167,382 @@ def app_error(s):
     raise ApplicationError, s
 
 
+class recordcursor(psycopg2.extensions.cursor):
+    """Cursor returning rowtype records instead of plain tuples.
+
+    The record class is looked up once per result from its column
+    names; each row is then a tuple with no per-row index or dict.
+    """
+
+    record = None
+    # (queryprofile, entry) for the statement executed, with --profile
+    profile = None
+
+    def execute(self, query, vars=None):
+        self.record = None
+        self.profile = None
+        return super(recordcursor, self).execute(query, vars)
+
+    def mkrecord(self):
+        if self.record is None:
+            self.record = functools.partial(tuple.__new__, rowtype(
+                [d[0] for d in self.description]))
+        return self.record
+
+    def fetched(self, start, ts):
+        prof, entry = self.profile
+        prof.fetched(entry, time.time() - start, ts)
+
+    def fetchone(self):
+        start = time.time()
+        t = super(recordcursor, self).fetchone()
+        if self.profile is not None:
+            self.fetched(start, () if t is None else (t,))
+        if t is not None:
+            return self.mkrecord()(t)
+
+    def fetchmany(self, size=None):
+        start = time.time()
+        if size is None:
+            ts = super(recordcursor, self).fetchmany()
+        else:
+            ts = super(recordcursor, self).fetchmany(size)
+        if self.profile is not None:
+            self.fetched(start, ts)
+        return map(self.mkrecord(), ts)
+
+    def fetchall(self):
+        start = time.time()
+        ts = super(recordcursor, self).fetchall()
+        if self.profile is not None:
+            self.fetched(start, ts)
+        return map(self.mkrecord(), ts)
+
+    def __iter__(self):
+        it = super(recordcursor, self).__iter__()
+        if self.profile is not None:
+            it = self.profiled(it)
+        t = next(it)
+        record = self.mkrecord()
+        yield record(t)
+        for t in it:
+            yield record(t)
+
+    def profiled(self, it):
+        """Time each step of it; a named cursor fetches --itersize rows
+        in some of them"""
+        while True:
+            start = time.time()
+            try:
+                t = next(it)
+            except StopIteration:
+                self.fetched(start, ())
+                return
+            self.fetched(start, (t,))
+            yield t
+
+
+class queryprofile(object):
+    """Time spent in, and rows returned by, each distinct statement
+    (--profile).
+
+    Execute time is until the server has answered; for a named cursor
+    that is only the DECLARE, and running the query is part of fetching
+    its first rows. Bytes are the length of the values as text, which
+    is about what the server sent. Repeated statements (the poller's)
+    also get the mean and slowest execute time per call, and preparing
+    one is listed as a statement of its own.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def executed(self, statement, elapsed):
+        """Count a run of statement; returns its entry for fetched"""
+        with self.lock:
+            entry = self.entries.get(statement)
+            if entry is None:
+                # calls, execute, fetch, rows, bytes, slowest execute
+                entry = self.entries[statement] = [0, 0., 0., 0, 0, 0.]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[5] = max(entry[5], elapsed)
+        return entry
+
+    def fetched(self, entry, elapsed, rows):
+        nbytes = 0
+        for row in rows:
+            for x in row:
+                if x is not None:
+                    nbytes += len(x) if isinstance(x, basestring) else len(str(x))
+        with self.lock:
+            entry[2] += elapsed
+            entry[3] += len(rows)
+            entry[4] += nbytes
+
+    def report(self):
+        with self.lock:
+            entries = sorted(self.entries.iteritems(), key=lambda x: x[1][1] + x[1][2],
+                             reverse=True)
+        fmt = '%6s %10s %10s %10s %12s %9s %9s  %s'
+        lines = ['Query profile (%.3f s elapsed):' % (time.time() - self.started),
+                 fmt % ('calls', 'execute', 'fetch', 'rows', 'bytes', 'ms/call', 'max ms',
+                        'statement')]
+        totals = [0, 0., 0., 0, 0]
+        for statement, entry in entries:
+            totals = map(operator.add, totals, entry[:5])
+            percall = ('%.3f' % (entry[1] / entry[0] * 1000), '%.3f' % (entry[5] * 1000)) \
+                if entry[0] > 1 else ('', '')
+            lines.append(fmt % ((entry[0], '%.3f' % entry[1], '%.3f' % entry[2],
+                                 entry[3], entry[4]) + percall +
+                                (' '.join(statement.split())[:PROFILE_SQL_WIDTH],)))
+        lines.append(fmt % (totals[0], '%.3f' % totals[1], '%.3f' % totals[2],
+                            totals[3], totals[4], '', '', '(total)'))
+        return '\n'.join(lines)
+
+
+class spacesaving(object):
+    """Heavy hitters of a stream in at most k counters (the Space-Saving
+    algorithm of Metwally et al.).
+
+    Any key seen more than n/k times is kept; a kept key's count
+    overestimates the true one by at most err(key) <= n/k. Counters
+    sit in a lazily updated min-heap, so evicting the smallest costs
+    O(log k) amortized.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.n = 0
+        self.counts = {}
+        self.errs = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, c=1):
+        self.n += c
+        counts = self.counts
+        if key in counts:
+            counts[key] += c
+            return
+        if len(counts) < self.k:
+            counts[key] = c
+            self.errs[key] = 0
+            heapq.heappush(self.heap, (c, key))
+            return
+        # Heap entries only lag behind their counts; refresh stale ones
+        # until the smallest is current
+        heap = self.heap
+        while True:
+            m, mkey = heap[0]
+            if counts[mkey] == m:
+                break
+            heapq.heapreplace(heap, (counts[mkey], mkey))
+        del counts[mkey], self.errs[mkey]
+        counts[key] = m + c
+        self.errs[key] = m
+        heapq.heapreplace(heap, (m + c, key))
+
+    def update(self, other):
+        """Add the counts of other"""
+        errs = self.errs
+        for key, c in other.counts.iteritems():
+            self.add(key, c)
+            if key in errs:
+                errs[key] += other.errs[key]
+
+    def load(self, counts, n):
+        """Fill an empty table from the exact counts of n items; the k
+        most common are kept, with no error"""
+        top = heapq.nlargest(self.k, counts.iteritems(), key=operator.itemgetter(1))
+        for key, c in top:
+            self.add(key, c)
+        self.n = n
+
+    def top(self, n):
+        """Return the n largest (key, count, err), largest first"""
+        errs = self.errs
+        return [(key, c, errs[key]) for key, c in
+                heapq.nlargest(n, self.counts.iteritems(), key=operator.itemgetter(1))]
+
+
+class delayhistogram(object):
+    """Distribution of delays in log-scaled buckets (as in HdrHistogram),
+    so percentiles are within a bucket's width and memory grows only
+    with the log of the largest delay"""
+
+    scale = DELAY_BUCKETS_PER_OCTAVE / math.log(2)
+
+    def __init__(self):
+        self.n = 0
+        self.max = None
+        self.counts = {}
+
+    def add(self, d):
+        self.n += 1
+        if self.max is None or d > self.max:
+            self.max = d
+        if d <= DELAY_RESOLUTION:
+            i = 0
+        else:
+            i = int(math.log(d / DELAY_RESOLUTION) * self.scale) + 1
+        self.counts[i] = self.counts.get(i, 0) + 1
+
+    def update(self, other):
+        self.n += other.n
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        for i, v in other.counts.iteritems():
+            self.counts[i] = self.counts.get(i, 0) + v
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket of the p quantile (0-1)"""
+        if not self.n:
+            return None
+        acc = 0
+        for i in sorted(self.counts):
+            acc += self.counts[i]
+            if acc >= p * self.n:
+                return min(self.max, round(DELAY_RESOLUTION * math.exp(i / self.scale), 6))
+        return self.max
+
+    def metrics(self):
+        return {'n': self.n, 'p50': self.percentile(.5), 'p99': self.percentile(.99),
+                'max': self.max}
+
+    def format(self):
+        return 'p50 %.3fs  p99 %.3fs  max %.3fs' % (
+            self.percentile(.5), self.percentile(.99), self.max)
+
+
+class pollscheduler(object):
+    """How often the poller queries without LISTEN/NOTIFY, and how its
+    polls have gone.
+
+    The interval is --poll-interval after a poll that found records,
+    and grows by POLL_BACKOFF with each empty one up to
+    --poll-max-interval. On a hot standby a poll is skipped (and counts
+    as empty) if replay has not advanced since the last one, as nothing
+    new can be visible. Latency is from the stamp of the newest record
+    found by a poll to when the poll returned; on a standby it includes
+    the replay lag.
+    """
+
+    def __init__(self, interval, maxinterval):
+        self.base = self.interval = interval
+        self.maxinterval = max(interval, maxinterval)
+        self.polls = 0
+        self.empty = 0
+        self.skipped = 0
+        self.latency = delayhistogram()
+        # Seconds since the last transaction replayed, per standby
+        self.lag = {}
+
+    def polled(self, nrec, newest=None):
+        self.polls += 1
+        if nrec:
+            self.interval = self.base
+            if newest is not None:
+                td = now() - newest
+                self.latency.add(max(0, td.days * 86400 + td.seconds + td.microseconds * 1e-6))
+        else:
+            self.empty += 1
+            self.interval = min(self.maxinterval, self.interval * POLL_BACKOFF)
+
+    def report(self):
+        rs = ['Polls:\t%d, %.1f%% empty (%d with nothing replayed), now every %.3fs' % (
+            self.polls, 100. * self.empty / max(self.polls, 1), self.skipped, self.interval)]
+        if self.latency.n:
+            rs.append('Poll latency:\t%s' % self.latency.format())
+        if self.lag:
+            rs.append('Replay lag:\t' + '  '.join(
+                '%s %s' % (label, 'none' if lag is None else '%.3fs' % lag)
+                for label, lag in sorted(self.lag.iteritems())))
+        return rs
+
+    def metrics(self):
+        return {'polls': self.polls, 'empty': self.empty, 'skipped': self.skipped,
+                'interval': self.interval, 'latency': self.latency.metrics(),
+                'lag': self.lag}
+
+
+class statslot(object):
+    """Record count, per-column heavy hitters and ingestion delays for
+    one time slot"""
+
+    def __init__(self, ncols, k):
+        self.nrec = 0
+        self.tabs = [spacesaving(k) for i in xrange(ncols)]
+        self.delays = delayhistogram()
+
+    def enter(self, values, delay=None):
+        self.nrec += 1
+        for tab, value in zip(self.tabs, values):
+            tab.add(value)
+        if delay is not None:
+            self.delays.add(delay)
+
+
+class statwindow(object):
+    """Statistics over the last `seconds` of record stamps, kept as at
+    most seconds / width + 1 slots of `width` seconds each"""
+
+    def __init__(self, seconds, width, ncols, k=STATS_WINDOW_TOPK):
+        self.seconds = seconds
+        self.width = width
+        self.nslots = seconds // width
+        self.ncols = ncols
+        self.k = k
+        self.slots = {}
+        self.latest = self.current = None
+
+    def enter(self, t, values, delay=None):
+        i = t // self.width
+        if i == self.latest:
+            self.current.enter(values, delay)
+            return
+        slot = self.slots.get(i)
+        if slot is None:
+            if self.latest is not None and i <= self.latest - self.nslots:
+                return
+            slot = self.slots[i] = statslot(self.ncols, self.k)
+            if self.latest is None or i > self.latest:
+                self.latest = i
+                self.current = slot
+                for x in [x for x in self.slots if x <= i - self.nslots - 1]:
+                    del self.slots[x]
+        slot.enter(values, delay)
+
+    def summary(self, t):
+        """Return the record count, merged per-column heavy hitters and
+        delays of the slots overlapping the window ending at t"""
+        first = (t - self.seconds) // self.width
+        nrec = 0
+        tabs = [spacesaving(self.k * 2) for i in xrange(self.ncols)]
+        delays = delayhistogram()
+        for i, slot in self.slots.iteritems():
+            if i >= first:
+                nrec += slot.nrec
+                for tab, x in zip(tabs, slot.tabs):
+                    tab.update(x)
+                delays.update(slot.delays)
+        return nrec, tabs, delays
+
+
 class statcounter(object):
+    """Record statistics in bounded memory.
+
+    Each column is summarized by a spacesaving table, so memory and
+    report cost depend on STATS_TOPK rather than the number of
+    distinct values; percentages marked ~ are upper bounds. windows is
+    a list of (seconds, slot width) sliding windows to report as well.
+    With delays, the ingestion delay of each record is kept in
+    delayhistograms, overall, per window and per host.
+    """
 
     tab_cols_map = (
         ('htab', ('host',)),
@@ -60,129 +551,408 @@ class statcounter(object):
         ('ptab', ('program', 'programs', '\n\t')),
     )
 
-    def __init__(self):
+    def __init__(self, cols, windows=(), delays=False):
+        self.tabcols = [(tabname, cnx) for tabname, cnx in self.tab_cols_map
+                        if cnx[0] in cols]
+        ixs = [cols.index(cnx[0]) for tabname, cnx in self.tabcols]
+        self.getvalues = lambda rec: [rec[i] for i in ixs]
+        self.windowspecs = windows
+        self.trackdelays = delays
+        if delays:
+            self.delayixs = [cols.index(x) for x in ('stamp', 'date', 'time', 'host')]
+        # The poller's pollscheduler, if polling
+        self.polls = None
         self.reset()
 
     def reset(self):
         self.nrec = 0
-        self.first = None
-        self.htab = {}
-        self.ftab = {}
-        self.ltab = {}
-        self.ptab = {}
+        self.firststamp = None
+        for tabname, cnx in self.tabcols:
+            setattr(self, tabname, spacesaving(STATS_TOPK))
+        self.tabs = [getattr(self, tabname) for tabname, cnx in self.tabcols]
+        self.windows = [statwindow(seconds, width, len(self.tabcols))
+                        for seconds, width in self.windowspecs]
+        self.delays = delayhistogram() if self.trackdelays else None
+        self.hostdelays = {}
+        self.lastsent = None, None, None
 
     def enter(self, rec):
         self.nrec += 1
-        if self.first is None:
-            self.first = rec
-        for tabname, cnx in self.tab_cols_map:
-            colname = cnx[0]
-            if colname in rec:
-                self.count(getattr(self, tabname), rec[colname])
-
-    def count(self, tab, k):
-        try:
-            tab[k] = tab[k] + 1
-        except KeyError:
-            tab[k] = 1
+        if self.firststamp is None:
+            self.firststamp = rec.stamp
+        values = self.getvalues(rec)
+        for tab, value in zip(self.tabs, values):
+            tab.add(value)
+        delay = None
+        if self.delays is not None:
+            delay = self.enterdelay(rec)
+        if self.windows:
+            t = epochseconds(rec.stamp)
+            for w in self.windows:
+                w.enter(t, values, delay)
+
+    def enterdelay(self, rec):
+        """Count and return the seconds from when rec was sent to stamp"""
+        si, di, ti, hi = self.delayixs
+        date, time_, sent = self.lastsent
+        if rec[di] != date or rec[ti] != time_:
+            date, time_ = rec[di], rec[ti]
+            sent = datetime.datetime.combine(date, time_)
+            self.lastsent = date, time_, sent
+        td = rec[si] - sent
+        delay = td.days * 86400 + td.seconds + td.microseconds * 1e-6
+        self.delays.add(delay)
+        host = rec[hi]
+        h = self.hostdelays.get(host)
+        if h is None:
+            if len(self.hostdelays) >= DELAY_MAX_HOSTS:
+                host = DELAY_OTHER_HOSTS
+                h = self.hostdelays.get(host)
+            if h is None:
+                h = self.hostdelays[host] = delayhistogram()
+        h.add(delay)
+        return delay
+
+    def load(self, nrec, firststamp, counts):
+        """Enter the counts of nrec records made elsewhere; counts maps
+        each column to a {value: count} dict"""
+        self.nrec = nrec
+        self.firststamp = firststamp
+        for (tabname, cnx), tab in zip(self.tabcols, self.tabs):
+            tab.load(counts.get(cnx[0], {}), nrec)
 
     def report(self):
         rs = []
         rs.append('Processed %d records spanning %s' % (
-            self.nrec, deltaformat(now() - self.first['stamp'])))
-        rs.append('Top 5 hosts:\t' +
-                  '\n\t\t'.join('%.2f%%\t%s' % (v, k)
-                                for k, v in self.topnstat(self.htab)))
-        def ntopn(what, tab, sep='\t'):
-            rs.append('Top 5 %s:%s' % (what, sep) +
-                      ' '.join('%s(%.2f%%)' % x for x in self.topnstat(tab)))
-        for tabname, cnx in self.tab_cols_map[1:]:
-            tab = getattr(self, tabname)
-            if tab:
-                ntopn(cnx[1] if len(cnx) > 1 else cnx[0], tab, *cnx[2:])
+            self.nrec, deltaformat(now() - self.firststamp)))
+        self.reporttabs(rs, self.tabs)
+        if self.delays is not None and self.delays.n:
+            rs.append('Ingestion delay:\t%s' % self.delays.format())
+            rs.append('Top 5 delayed hosts (p99):\t' + '\n\t\t\t\t'.join(
+                '%.3fs\t%s' % (h.percentile(.99), host) for host, h in sorted(
+                    self.hostdelays.iteritems(), key=lambda x: x[1].percentile(.99),
+                    reverse=True)[:5]))
+        if self.polls is not None:
+            rs.extend(self.polls.report())
+        t = epochseconds(now())
+        for w in self.windows:
+            nrec, tabs, delays = w.summary(t)
+            rs.append('Last %s:\t%d records (%.1f/s)' % (
+                shortdelta(w.seconds), nrec, float(nrec) / w.seconds))
+            if nrec:
+                self.reporttabs(rs, tabs, '\t')
+            if delays.n:
+                rs.append('\tIngestion delay:\t%s' % delays.format())
         return '\n'.join(rs)
 
+    def delaymetrics(self):
+        """Ingestion delay percentiles, overall, for each window and
+        per host, for --delay-metrics"""
+        t = epochseconds(now())
+        m = {
+            'records': self.nrec,
+            'delay': self.delays.metrics(),
+            'windows': dict((shortdelta(w.seconds), w.summary(t)[2].metrics())
+                            for w in self.windows),
+            'hosts': dict((host, h.metrics()) for host, h in self.hostdelays.iteritems()),
+        }
+        if self.polls is not None:
+            m['polls'] = self.polls.metrics()
+        return m
+
+    def reporttabs(self, rs, tabs, indent=''):
+        for (tabname, cnx), tab in zip(self.tabcols, tabs):
+            if tabname == 'htab':
+                rs.append(indent + 'Top 5 hosts:\t' +
+                          ('\n\t\t' + indent).join('%s\t%s' % (v, k)
+                                                   for k, v in self.topnstat(tab)))
+            elif len(tab):
+                what = cnx[1] if len(cnx) > 1 else cnx[0]
+                sep = cnx[2] + indent if len(cnx) > 2 else '\t'
+                rs.append(indent + 'Top 5 %s:%s' % (what, sep) +
+                          ' '.join('%s(%s)' % x for x in self.topnstat(tab)))
+
     def topnstat(self, tab, n=5):
-        total = sum(tab.itervalues())
-        for i, (x, v) in enumerate(sorted(tab.iteritems(), key=operator.itemgetter(1),
-                                          reverse=True)):
-            if i >= n:
-                return
-            yield x, 100. * v / total
+        """Yield (key, percentage) for the n most common keys of tab"""
+        total = tab.n
+        for x, v, err in tab.top(n):
+            yield x, '%s%.2f%%' % ('~' if err else '', 100. * v / total)
+
+
+class recformatter(object):
+    """Renders records as output text.
+
+    format(rec) is put together once from the options, reading the
+    columns by their position in cols. Rendered timestamps are cached
+    per second and local timezone offsets per quarter hour (the
+    granularity of DST transitions), since records arrive roughly in
+    time order. Rows collapsed by pgingest.py (repeats set) are shown
+    as REPEAT_FORMAT, whatever --collapse is.
+    """
+
+    def __init__(self, options, cols):
+        self.options = options
+        self.date_format = options.date_format
+        self.stampcache = {}
+        self.tzcache = {}
+        self.hostcache = {}
+        if options.print_full:
+            self.format = self.compile_full(options, cols)
+        else:
+            self.format = self.compile_brief(options, cols)
+        if 'repeats' in cols:
+            self.format = self.counted(self.format, cols, options.print_full)
+
+    def compile_full(self, options, cols):
+        fmt = '%s %s%s.%s prog=%s tag=%s delay=%d\n\t%s\n' + '-' * 40 + '\n'
+        stamp = self.stamp
+        if options.no_hostname:
+            host = lambda h: ''
+        else:
+            # Printed as stored, without unquote_implied_domains
+            host = lambda h: '%s ' % h
+        get = operator.itemgetter(*map(cols.index, (
+            'date', 'time', 'host', 'facility', 'priority', 'program', 'tag', 'stamp', 'msg')))
+        def format(rec):
+            date, time, h, facility, priority, program, tag, dbstamp, msg = get(rec)
+            s, slstamp = stamp(date, time)
+            return fmt % (s, host(h), facility, priority, program, tag,
+                          (dbstamp - slstamp).total_seconds(), msg)
+        return format
+
+    def compile_brief(self, options, cols):
+        stamp = self.stamp
+        if options.no_hostname:
+            host = lambda h: ''
+        else:
+            host = self.host
+        if options.print_priority:
+            fmt = '%s %s[%s.%s] %s%s\n'
+            get = operator.itemgetter(*map(cols.index, (
+                'date', 'time', 'host', 'facility', 'priority', 'program', 'msg')))
+            def format(rec):
+                date, time, h, facility, priority, program, msg = get(rec)
+                return fmt % (stamp(date, time)[0], host(h), facility, priority,
+                              program and '%s: ' % program or '', msg)
+        else:
+            fmt = '%s %s%s%s\n'
+            get = operator.itemgetter(*map(cols.index, (
+                'date', 'time', 'host', 'program', 'msg')))
+            def format(rec):
+                date, time, h, program, msg = get(rec)
+                return fmt % (stamp(date, time)[0], host(h),
+                              program and '%s: ' % program or '', msg)
+        return format
+
+    def counted(self, format, cols, span):
+        """Wrap format to show the copies of collapsed rows, and with
+        span when the first and last arrived"""
+        ri, mi = cols.index('repeats'), cols.index('msg')
+        get = operator.itemgetter(*map(cols.index, ('repeat_first', 'repeat_last'))) \
+            if span and 'repeat_first' in cols and 'repeat_last' in cols else None
+        def counted(rec):
+            n = rec[ri]
+            if n is None:
+                return format(rec)
+            values = list(rec)
+            values[mi] = REPEAT_FORMAT % (n, rec[mi])
+            if get is not None:
+                first, last = get(rec)
+                if first is not None and last is not None:
+                    values[mi] += ' (%s to %s)' % (first, last)
+            return format(values)
+        return counted
+
+    def stamp(self, date, time):
+        """Return the rendered and the datetime syslog stamp"""
+        key = date, time
+        try:
+            return self.stampcache[key]
+        except KeyError:
+            pass
+        if len(self.stampcache) >= STAMP_CACHE_SIZE:
+            self.stampcache.clear()
+        slstamp = datetime.datetime.combine(date, time)
+        r = self.stampcache[key] = self.localize(slstamp).strftime(self.date_format), slstamp
+        return r
+
+    def localize(self, stamp):
+        if LOCAL_TIMEZONE is None:
+            return stamp
+        q = stamp.replace(minute=stamp.minute - stamp.minute % 15, second=0, microsecond=0)
+        try:
+            offset, tz = self.tzcache[q]
+        except KeyError:
+            if len(self.tzcache) >= STAMP_CACHE_SIZE:
+                self.tzcache.clear()
+            local = LOCAL_TIMEZONE.fromutc(q)
+            offset, tz = self.tzcache[q] = local.utcoffset(), local.tzinfo
+        return (stamp + offset).replace(tzinfo=tz)
+
+    def host(self, host):
+        """Return host as printed, followed by a space"""
+        try:
+            return self.hostcache[host]
+        except KeyError:
+            pass
+        if len(self.hostcache) >= STAMP_CACHE_SIZE:
+            self.hostcache.clear()
+        r = self.hostcache[host] = '%s ' % unquote_implied_domains(self.options, host)
+        return r
+
+
+class repeatfilter(object):
+    """Collapses runs of records with the same host, program and msg,
+    as syslogd does.
+
+    The first record of a run passes; the copies stamped within window
+    seconds of it are counted, and passed as one record saying how many
+    there were once the window has closed. Rows already collapsed by
+    pgingest.py (cols include repeats) count as their number of copies.
+    """
+
+    def __init__(self, cols, window):
+        self.window = datetime.timedelta(seconds=window)
+        self.key = operator.itemgetter(*map(cols.index, ('host', 'program', 'msg')))
+        self.stampi = cols.index('stamp')
+        self.msgi = cols.index('msg')
+        self.repeatsi = cols.index('repeats') if 'repeats' in cols else None
+        # Not known for a run counted here
+        self.spanis = [cols.index(x) for x in ('repeat_first', 'repeat_last') if x in cols]
+        # (label, key) -> [window end, copies, last copy, source], by window end
+        self.runs = collections.OrderedDict()
+
+    def repeated(self, rec, n):
+        """rec standing for n copies; where there is a repeats column,
+        recformatter shows the count"""
+        values = list(rec)
+        if self.repeatsi is not None:
+            values[self.repeatsi] = n
+            for i in self.spanis:
+                values[i] = None
+        else:
+            values[self.msgi] = REPEAT_FORMAT % (n, rec[self.msgi])
+        return tuple.__new__(type(rec), values)
+
+    def add(self, rec, src):
+        """Return the (source, record) pairs to print for rec"""
+        stamp = rec[self.stampi]
+        out = self.expire(stamp)
+        n = rec[self.repeatsi] if self.repeatsi is not None else None
+        k = (src.label, self.key(rec))
+        run = self.runs.get(k)
+        if run is not None:
+            run[1] += n or 1
+            run[2] = rec
+            return out
+        if len(self.runs) >= COLLAPSE_MAX_KEYS:
+            out.extend(self.pop())
+        self.runs[k] = [stamp + self.window, 0, rec, src]
+        out.append((src, rec))
+        return out
+
+    def pop(self):
+        k, (end, n, rec, src) = self.runs.popitem(last=False)
+        if n:
+            yield src, self.repeated(rec, n)
+
+    def expire(self, stamp=None):
+        """Close the runs whose window ended before stamp (all if None)
+        and return what they have to print"""
+        out = []
+        while self.runs and (stamp is None or next(self.runs.itervalues())[0] < stamp):
+            out.extend(self.pop())
+        return out
 
 
 class logprinter(object):
 
-    def __init__(self, options):
+    def __init__(self, options, cols, labels=False, out=None):
         self.options = options
-        self.stats = statcounter()
-        self.stats_on = not not options.print_stats
         self.track_seq = options.mode == 'poller'
-        if self.track_seq:
-            self.maxseq = 0
+        self.stats = statcounter(cols, STATS_WINDOWS, delays=self.track_seq)
+        # Otherwise --stats are counted by the database (serverstats)
+        self.stats_on = (not not options.print_stats or not not options.delay_metrics) \
+            and self.track_seq
+        self.labels = labels
         self.count = 0
-
-    def stampformat(self, datestamp, format=None):
-        if format is None:
-            format = self.options.date_format
-        return stampformat(datestamp, format)
-
-    def pplog(self, rec):
+        self.formatter = recformatter(options, cols)
+        self.repeats = None
+        if options.collapse > 0:
+            self.repeats = repeatfilter(cols, options.collapse)
+        if out is None:
+            out = stdoutwriter()
+        self.out = out
+
+    def pplog(self, rec, src):
         if self.track_seq:
-            seq = rec['seq']
-            if seq <= self.maxseq:
-                print >> sys.stderr, 'WARNING! syslog pgdb sequence going wrong way! %d . %d' % (self.maxseq, seq)
-            self.maxseq = seq
-        self.count += 1
-        self.prec(rec)
+            seq = rec.seq
+            if seq <= src.lastseq:
+                print >> sys.stderr, 'WARNING! syslog pgdb sequence going wrong way! %d . %d' % (src.lastseq, seq)
+            src.lastseq = seq
+            if seq > src.maxseq:
+                src.maxseq = seq
         if self.stats_on:
             self.stats.enter(rec)
+        if self.repeats is None:
+            self.pprint(rec, src)
+        else:
+            for src, rec in self.repeats.add(rec, src):
+                self.pprint(rec, src)
+
+    def pprint(self, rec, src):
+        self.count += 1
+        if self.labels:
+            self.out.write('[%s] ' % src.label)
+        self.prec(rec)
 
     def prec(self, rec):
-        slstamp = datetime.datetime.combine(rec['date'], rec['time'])
-        print self.stampformat(slstamp),
-        if self.options.no_hostname:
-            fmt = ''
-        else:
-            fmt = '%(host)s '
-        if self.options.print_full:
-            dbstamp = rec['stamp']
-            td = dbstamp - slstamp
-            fmt += '%(facility)s.%(priority)s prog=%(program)s tag=%(tag)s'
-            print fmt % rec,
-            print 'delay=%d' % td.total_seconds()
-            print '\t%(msg)s' % rec
-            print '-' * 40
-        else:
-            pr = dict(rec)
-            pr['host'] = unquote_implied_domains(self.options, pr['host'])
-            if pr['program']:
-                pr['_print_program'] = ': '
-            else:
-                pr['program'] = ''
-                pr['_print_program'] = ''
-            if self.options.print_priority:
-                fmt += '[%(facility)s.%(priority)s] %(program)s%(_print_program)s%(msg)s'
-            else:
-                fmt += '%(program)s%(_print_program)s%(msg)s'
-            print fmt % pr
+        self.out.write(self.formatter.format(rec))
 
     def precs(self, recs):
-        for rec in recs:
-            self.pplog(rec)
+        """Print (source, record) pairs as they are produced; returns
+        how many there were"""
+        # Anything print-ed to stdout (e.g. poller progress) goes first
+        sys.stdout.flush()
+        n = 0
+        if self.track_seq or self.labels or self.stats_on or self.repeats is not None:
+            for src, rec in recs:
+                self.pplog(rec, src)
+                n += 1
+        else:
+            write, format = self.out.write, self.formatter.format
+            for src, rec in recs:
+                write(format(rec))
+                n += 1
+            self.count += n
+        self.out.flush()
+        return n
+
+    def expire(self, stamp=None):
+        """Print the --collapse runs that ended before stamp (all if None)"""
+        if self.repeats is None:
+            return
+        for src, rec in self.repeats.expire(stamp):
+            self.pprint(rec, src)
+        self.out.flush()
+
+    def close(self):
+        self.expire()
+        self.out.close()
 
     def print_summary(self):
         #if self.count > 0 and (self.options.print_stats or sys.stdout.isatty()):
         if self.count > 0 and self.options.print_stats:
-            assert self.stats_on
             print >> sys.stderr, '(%d records printed)' % self.count
             self.print_stats()
 
-    def print_stats(self):
-        if not self.stats_on:
-            return
+    def print_stats(self, stats=None):
+        if stats is None:
+            if not self.stats_on or not self.options.print_stats:
+                return
+            stats = self.stats
         linesep(sys.stderr)
-        print >> sys.stderr, self.stats.report()
+        print >> sys.stderr, stats.report()
         linesep(sys.stderr)
 
 
@@ -190,82 +960,793 @@ class poller(object):
 
     def __init__(self, slf, options):
         self.slf = slf
-        self.interval = options.poller_interval
+        self.schedule = pollscheduler(options.poller_interval, options.poller_max_interval)
+        self.newest = None
+        # pages runs in a thread per source with several; guards newest
+        # and what it counts in schedule
+        self.lock = threading.Lock()
         self.elapsenote = options.poller_elapsenote
         self.initial_page = options.poller_initial_page
         self.output_progress = options.progress
+        self.notify = options.poller_notify
+        self.notify_timeout = options.poller_notify_timeout
+        self.batch = options.poller_batch
+        self.statefile = options.poller_state
+        self.savedseqs = None
+        self.metricsfile = options.delay_metrics
+        self.metricsinterval = options.delay_metrics_interval
+        self.metricswritten = None
         self.siginfoflag = False
 
-    def siginfohandler(self, signum, frame):
-        self.slf.logprinter.print_stats()
+    def listen(self):
+        """Subscribe to insert notifications, or decide to poll instead"""
+        if self.notify is False:
+            return
+        sources = self.slf.sources
+        if self.notify is None:
+            self.notify = all(self.slf.has_trigger(src, NOTIFY_TRIGGER) for src in sources)
+            if not self.notify:
+                self.slf.vprint('no %s trigger, polling every %.3f to %.3f s' % (
+                    NOTIFY_TRIGGER, self.schedule.base, self.schedule.maxinterval))
+                return
+        for src in sources:
+            if src.standby:
+                self.slf.vprint('%shot standby, polling' % self.slf.srcprefix(src))
+                self.notify = False
+                return
+        for src in sources:
+            try:
+                self.slf.listen(src, NOTIFY_CHANNEL)
+            except psycopg2.Error, e:
+                src.pgdb.rollback()
+                self.slf.warn('%sLISTEN failed, falling back to polling: %s' % (
+                    self.slf.srcprefix(src), str(e).strip()))
+                self.notify = False
+                return
+
+    def wait(self, iwait, lastdata):
+        nw = now()
+        elapsed = (nw - lastdata).total_seconds()
+        if self.notify:
+            return iwait(self.notify_timeout,
+                         'Listening... since %s... no new data for %.3f s...' % (
+                             stampformat(lastdata), elapsed),
+                         self.slf.waitnotify)
+        return iwait(self.schedule.interval, 'Polling... since %s... no new data for %.3f s...' % (
+            stampformat(lastdata), elapsed))
+
+    def findstandbys(self):
+        for src in self.slf.sources:
+            c = src.pgdb.cursor()
+            try:
+                self.slf.cexec(c, 'SELECT pg_is_in_recovery()', sqla={})
+                src.standby, = c.fetchone()
+            finally:
+                c.close()
+            self.slf.endquery(src)
+
+    def replayed(self, src):
+        """Whether standby src has replayed anything since the last poll"""
+        if src.pgdb.server_version >= 100000:
+            position = 'pg_last_wal_replay_lsn()'
+        else:
+            position = 'pg_last_xlog_replay_location()'
+        c = src.pgdb.cursor()
+        try:
+            self.slf.cexec(c, 'SELECT %s, extract(epoch FROM now() - '
+                              'pg_last_xact_replay_timestamp())' % position, sqla={})
+            lsn, lag = c.fetchone()
+        finally:
+            c.close()
+        self.slf.endquery(src)
+        with self.lock:
+            self.schedule.lag[src.label] = lag
+        if lsn is not None and lsn == src.replayed:
+            return False
+        src.replayed = lsn
+        return True
+
+    def pages(self, src):
+        """Yield the records after the last seq seen in src, a page at a time.
+
+        Pages are keyed on seq and at most --catchup-batch rows long,
+        so a long gap is never fetched (or sorted) in one piece.
+        """
+        if src.standby and not self.notify and not self.replayed(src):
+            with self.lock:
+                self.schedule.skipped += 1
+            return
+        mseq = src.maxseq
+        while True:
+            curs = self.slf.getcursor(src)
+            try:
+                self.slf.select2(curs, 'seq > %(mseq)s',
+                                 ['ORDER BY seq', 'LIMIT %d' % self.batch],
+                                 sqla={'mseq': mseq}, prepare=True)
+                recs = curs.fetchall()
+            finally:
+                curs.close()
+            self.slf.endquery(src)
+            if recs:
+                with self.lock:
+                    if self.newest is None or recs[-1].stamp > self.newest:
+                        self.newest = recs[-1].stamp
+            for rec in recs:
+                yield rec
+            if len(recs) < self.batch:
+                return
+            mseq = recs[-1].seq
+
+    def catchup(self, first=None):
+        """Print everything new, merged across sources by stamp. first is
+        called before anything is printed. Returns the row count."""
+        lp = self.slf.logprinter
+        recs = self.slf.stream(self.pages, stampkey)
+        rec = next(recs, None)
+        if rec is None:
+            return 0
+        if first is not None:
+            first()
+        recs = itertools.chain((rec,), recs)
+        total = 0
+        while True:
+            n = lp.precs(itertools.islice(recs, self.batch))
+            total += n
+            self.savestate()
+            if n < self.batch:
+                return total
+
+    def savestate(self):
+        seqs = dict((src.label, src.maxseq) for src in self.slf.sources)
+        if self.statefile and seqs != self.savedseqs:
+            savestate(self.statefile, {'seq': seqs})
+            self.savedseqs = seqs
+
+    def initial(self):
+        lp = self.slf.logprinter
+        state = loadstate(self.statefile) if self.statefile else None
+        if state:
+            seqs = state['seq']
+            if isinstance(seqs, (int, long)) and not self.slf.multi:
+                seqs = {self.slf.sources[0].label: seqs}
+            if set(seqs) == set(src.label for src in self.slf.sources):
+                for src in self.slf.sources:
+                    src.lastseq = src.maxseq = seqs[src.label]
+                self.savedseqs = seqs
+                self.catchup()
+                return
+            self.slf.warn('%s is for other databases (%s); ignoring it' % (
+                self.statefile, ', '.join(sorted(seqs))))
+        def page(src):
+            curs = self.slf.getcursor(src, named=True)
+            try:
+                self.slf.select(curs, ['ORDER BY stamp DESC', 'LIMIT %d' % self.initial_page],
+                                outer='SELECT * FROM (%s) AS x ORDER BY x.stamp')
+                for rec in curs:
+                    yield rec
+            finally:
+                curs.close()
+                self.slf.endquery(src)
+        if not lp.precs(self.slf.stream(page, stampkey)):
+            raise EnvironmentError, 'polling not supported with no initial results'
+        self.savestate()
 
     def start(self):
-        if hasattr(signal, 'SIGINFO'):
-            signal.signal(signal.SIGINFO, self.siginfohandler)
-        curs = self.slf.getcursor()
+        self.findstandbys()
+        self.listen()
+        if not self.notify:
+            self.slf.logprinter.stats.polls = self.schedule
         iwait = conswaiter(noprint=not self.output_progress)
+        self.initial()
+        lastdata = lastpoll = now()
+        while True:
+            nw = now()
+            clrn = self.wait(iwait, lastdata)
+            def first():
+                if self.output_progress:
+                    if clrn is not None:
+                        print '\r%s' % (' ' * clrn),
+                    print '\r',
+                    delta = nw - lastdata
+                    if self.elapsenote > 0 and delta.seconds >= self.elapsenote:
+                        print '%s %s elapsed...' % ('=' * 70, delta)
+            self.newest = None
+            n = self.catchup(first)
+            if n:
+                lastdata = nw
+            if not self.notify:
+                self.schedule.polled(n, self.newest)
+            lastpoll = now()
+            self.slf.logprinter.expire(lastpoll)
+            self.writemetrics()
+
+    def writemetrics(self):
+        """Write --delay-metrics if --delay-metrics-interval has passed;
+        checked after every poll or notification wait"""
+        t = time.time()
+        if not self.metricsfile or (self.metricswritten is not None and
+                                    t - self.metricswritten < self.metricsinterval):
+            return
+        m = self.slf.logprinter.stats.delaymetrics()
+        m['time'] = t
+        savestate(self.metricsfile, m)
+        self.metricswritten = t
+
+
+class connpool(object):
+    """Idle connections kept for reuse by later queries, by connection
+    string (see pgsyslogd.py).
+
+    A connection idle for more than POOL_CHECK_AFTER seconds is tested
+    before it is handed out, in case the server has dropped it.
+    """
+
+    def __init__(self, maxidle=POOL_MAXIDLE):
+        self.maxidle = maxidle
+        self.idle = {}
+
+    def get(self, fn):
+        """Return (key, connection) for connection file fn"""
+        key = readdsn(fn)
+        conns = self.idle.get(key)
+        while conns:
+            pgdb, since = conns.pop()
+            if time.time() - since < POOL_CHECK_AFTER or connalive(pgdb):
+                return key, pgdb
+            pgdb.close()
+        return key, psycopg2.connect(key)
+
+    def put(self, key, pgdb, listening=False, prepared=False):
+        """Take back a connection from get, unless it is unusable"""
+        if pgdb.closed:
+            return
+        try:
+            pgdb.rollback()
+            if listening or prepared:
+                c = pgdb.cursor()
+                if listening:
+                    c.execute('UNLISTEN *')
+                if prepared:
+                    # Names are only unique within one syslogfilter
+                    c.execute('DEALLOCATE ALL')
+                c.close()
+                pgdb.commit()
+                del pgdb.notifies[:]
+        except psycopg2.Error:
+            pgdb.close()
+            return
+        conns = self.idle.setdefault(key, [])
+        if len(conns) >= self.maxidle:
+            pgdb.close()
+        else:
+            conns.append((pgdb, time.time()))
+
+    def size(self):
+        return sum(len(x) for x in self.idle.itervalues())
+
+    def close(self):
+        for conns in self.idle.itervalues():
+            for pgdb, since in conns:
+                pgdb.close()
+        self.idle = {}
+
+
+class resultcache(object):
+    """Query results stored compressed on disk, evicting the least
+    recently used once they take up more than maxbytes"""
+
+    suffix = '.z'
+
+    def __init__(self, path, maxbytes):
+        self.path = path
+        self.maxbytes = maxbytes
+
+    def key(self, *parts):
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        """Return the rows stored for key, or None"""
+        fn = self.filename(key)
         try:
-            self.slf.select(curs, ['ORDER BY stamp DESC', 'LIMIT %d' % self.initial_page],
-                            outer='SELECT * FROM (%s) AS x ORDER BY x.stamp')
-            data = curs.fetchall()
-            if not data:
-                raise EnvironmentError, 'polling not supported with no initial results'
-            mseq = max(x[0] for x in data)
-            lastdata = lastpoll = now()
-            self.slf.logprinter.precs(data)
+            with open(fn, 'rb') as f:
+                cols, rows = cPickle.loads(zlib.decompress(f.read()))
+            os.utime(fn, None)
+        except (EnvironmentError, zlib.error, cPickle.UnpicklingError, ValueError, EOFError):
+            return None
+        record = functools.partial(tuple.__new__, rowtype(cols))
+        return map(record, rows)
+
+    def put(self, key, cols, rows):
+        data = zlib.compress(cPickle.dumps((cols, map(tuple, rows)), 2))
+        if len(data) > self.maxbytes // 4:
+            return
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0700)
+            tmp = '%s.%d' % (self.filename(key), os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self.filename(key))
+            self.evict()
+        except EnvironmentError, e:
+            print >> sys.stderr, 'WARNING: cannot write result cache: %s' % e
+
+    def evict(self):
+        entries = []
+        total = 0
+        for x in os.listdir(self.path):
+            if x.endswith(self.suffix):
+                try:
+                    st = os.stat(os.path.join(self.path, x))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, x))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, x in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.unlink(os.path.join(self.path, x))
+            except OSError:
+                pass
+            total -= size
+
+
+class logarchive(object):
+    """Partitions exported from logs, in files under path (see
+    ARCHIVE_MAGIC).
+
+    A file is its magic, the compressed columns of each row group, a
+    JSON footer with the columns, and each group's row count, stamp
+    range and column offsets, and the footer's length. The index has
+    each file's stamp range and hosts, so files can be passed over
+    without opening them; within a file, groups are passed over by
+    stamp, and rows found by bisecting the stamp column.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.indexfile = os.path.join(path, ARCHIVE_INDEX)
+        self.index = loadstate(self.indexfile) or {}
+
+    def write(self, name, cols, rows):
+        """Store rows, tuples of cols in stamp order, as file name and
+        add it to the index; returns the row count"""
+        fn = os.path.join(self.path, name)
+        tmp = '%s.%d' % (fn, os.getpid())
+        si, hi = cols.index('stamp'), cols.index('host')
+        codecs = [ARCHIVE_CODECS.get(x, (None, None))[0] for x in cols]
+        hosts = set()
+        groups = []
+        rows = iter(rows)
+        with open(tmp, 'wb') as f:
+            f.write(ARCHIVE_MAGIC)
             while True:
-                nw = now()
-                clrn = iwait(self.interval, 'Polling... since %s... no new data for %.3f s...' % (
-                    stampformat(lastdata), (nw - lastdata).total_seconds()))
-                self.slf.select2(curs, 'seq > %(mseq)s', ['ORDER BY stamp DESC'],
-                                 sqla={'mseq': mseq},
-                                outer='SELECT * FROM (%s) AS x ORDER BY x.stamp')
-                lastpoll = now()
-                data = curs.fetchall()
-                if data:
-                    if self.output_progress:
-                        if clrn is not None:
-                            print '\r%s' % (' ' * clrn),
-                        print '\r',
-                        delta = nw - lastdata
-                        if self.elapsenote > 0 and delta.seconds >= self.elapsenote:
-                            print '%s %s elapsed...' % ('=' * 70, delta)
-                    mseq = max(x[0] for x in data)
-                    lastdata = nw
-                    self.slf.logprinter.precs(data)
-        finally:
-            curs.close()
+                group = list(itertools.islice(rows, ARCHIVE_GROUP_ROWS))
+                if not group:
+                    break
+                offsets = []
+                for values, encode in zip(zip(*group), codecs):
+                    if encode is not None:
+                        values = map(encode, values)
+                    data = zlib.compress(marshal.dumps(list(values)))
+                    offsets.append((f.tell(), len(data)))
+                    f.write(data)
+                hosts.update(x[hi] for x in group)
+                groups.append({'rows': len(group), 'offsets': offsets,
+                               'min': epochmicros(group[0][si]),
+                               'max': epochmicros(group[-1][si])})
+            footer = json.dumps({'cols': cols, 'groups': groups})
+            f.write(footer)
+            f.write(struct.pack('>Q', len(footer)))
+            f.flush()
+            os.fsync(f.fileno())
+        if not groups:
+            os.unlink(tmp)
+            return 0
+        os.rename(tmp, fn)
+        hosts.discard(None)
+        self.index[name] = {
+            'rows': sum(g['rows'] for g in groups),
+            'min': stampstr(fromepochmicros(groups[0]['min'])),
+            'max': stampstr(fromepochmicros(groups[-1]['max'])),
+            'hosts': sorted(hosts),
+        }
+        savestate(self.indexfile, self.index)
+        return self.index[name]['rows']
+
+    def hosts(self, patterns):
+        """The hosts of patterns, with -h wildcards matched against the
+        hosts in the index"""
+        r = set(x for x in patterns if not isglob(x))
+        globs = [globre(x) for x in patterns if isglob(x)]
+        if globs:
+            for e in self.index.itervalues():
+                r.update(h for h in e['hosts'] if any(g.match(h) for g in globs))
+        return r
+
+    def files(self, lo=None, hi=None, hosts=None, xhosts=()):
+        """Return the names of the files that may have rows stamped
+        between lo and hi (None for unbounded) from one of hosts (None
+        for any) other than xhosts"""
+        r = []
+        for name, e in sorted(self.index.iteritems(), key=lambda x: x[1]['min']):
+            if lo is not None and parsestamp(e['max']) < lo:
+                continue
+            if hi is not None and parsestamp(e['min']) > hi:
+                continue
+            if hosts is not None and not set(hosts).intersection(e['hosts']):
+                continue
+            if xhosts and set(e['hosts']) <= set(xhosts):
+                continue
+            r.append(name)
+        return r
+
+    def scan(self, name, lo=None, hi=None, hosts=None, xhosts=()):
+        """Yield (cols, rows) for each row group of file name with rows
+        in the range and from the hosts that files selects by; rows
+        outside it may be included"""
+        with open(os.path.join(self.path, name), 'rb') as f:
+            if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+                raise ApplicationError, '%s: not a pgsyslog archive' % f.name
+            f.seek(-8, os.SEEK_END)
+            n, = struct.unpack('>Q', f.read(8))
+            f.seek(-8 - n, os.SEEK_END)
+            footer = json.loads(f.read(n))
+            cols = [str(x) for x in footer['cols']]
+            si, hi_ = cols.index('stamp'), cols.index('host')
+            elo = epochmicros(lo) if lo is not None else None
+            ehi = epochmicros(hi) if hi is not None else None
+            def column(g, i, decode=True):
+                off, length = g['offsets'][i]
+                f.seek(off)
+                values = marshal.loads(zlib.decompress(f.read(length)))
+                codec = ARCHIVE_CODECS.get(cols[i])
+                if decode and codec is not None:
+                    values = map(codec[1], values)
+                return values
+            for g in footer['groups']:
+                if elo is not None and g['max'] < elo or ehi is not None and g['min'] > ehi:
+                    continue
+                keep = xrange(g['rows'])
+                if elo is not None or ehi is not None:
+                    stamps = column(g, si, False)
+                    keep = xrange(0 if elo is None else bisect.bisect_left(stamps, elo),
+                                  len(stamps) if ehi is None else bisect.bisect_right(stamps, ehi))
+                if hosts is not None or xhosts:
+                    hs = column(g, hi_)
+                    keep = [i for i in keep if (hosts is None or hs[i] in hosts) and
+                            hs[i] not in xhosts]
+                if not keep:
+                    continue
+                values = [column(g, i) for i in xrange(len(cols))]
+                yield cols, [tuple(v[i] for v in values) for i in keep]
+
+
+class dbsource(object):
+    """One logs database; -d may be given several times"""
+
+    def __init__(self, label, fn, pool=None):
+        self.label = label
+        self.fn = fn
+        self.pool = pool
+        self.poolkey = None
+        self.pgdb = None
+        self.ncursors = 0
+        self.use_rollup = None
+        self.sealed = None
+        self.listening = False
+        self.prepared = False
+        self.archived = False
+        # Hot standby: the replay position at the last poll
+        self.standby = False
+        self.replayed = None
+        self.lastseq = self.maxseq = 0
+        self.connect()
+
+    def connect(self):
+        if self.pool is not None:
+            self.poolkey, self.pgdb = self.pool.get(self.fn)
+        else:
+            self.pgdb = dbconnect(self.fn)
+
+    def ensure(self):
+        """Reconnect if an earlier failure closed the connection"""
+        if self.pgdb.closed:
+            self.connect()
+        elif self.pgdb.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            self.pgdb.rollback()
+
+    def close(self):
+        if self.pgdb is not None:
+            if self.pool is not None:
+                self.pool.put(self.poolkey, self.pgdb, self.listening, self.prepared)
+            else:
+                self.pgdb.close()
+            self.pgdb = None
 
 
 class syslogfilter(object):
 
-    def __init__(self, options, logstable='logs'):
+    def __init__(self, options, logstable='logs', pool=None):
         self.verbose = options.verbose
+        self.explain_on = options.explain or options.explain_analyze
+        self.explain_analyze = options.explain_analyze
+        self.profile = queryprofile() if options.profile else None
         self.logstable = logstable
+        self.itersize = options.itersize
+        self.rolluptable = '%s_rollup' % logstable
+        self.use_rollup = options.rollup
+        self.prepare = options.prepare is not False
+        # (connection, statement) -> (name, parameters), or None if it
+        # could not be prepared
+        self.prepared = {}
+        self.threadpool = None
+        # stream merges not yet finished, whose readers must be stopped
+        # before their connections are let go
+        self.merges = weakref.WeakSet()
+        self.dbpool = pool
+        self.cache = None
+        if options.cache is not False and options.mode != 'poller':
+            self.cache = resultcache(options.cache_dir or defaultcachedir(),
+                                     options.cache_size << 20)
         self.connect(options)
         self.setfilter(options)
-        self.logprinter = logprinter(options)
         self.needed_cols = list(self.gen_needed_cols(options))
+        self.archives = {}
+        if options.archive and options.mode != 'poller':
+            self.archives = archivespecs(options, [src.label for src in self.sources])
+            self.attacharchives(options)
+        self.logprinter = logprinter(options, self.needed_cols, labels=self.multi)
 
     def shutdown(self):
-        if self.pgdb is not None:
-            self.pgdb.close()
-            self.pgdb = None
+        for merged in list(self.merges):
+            merged.close()
+        if self.threadpool is not None:
+            self.threadpool.terminate()
+            self.threadpool = None
+        for src in self.sources:
+            if src.archived:
+                self.droparchivetable(src)
+            src.close()
         if self.logprinter is not None:
+            self.logprinter.close()
             self.logprinter.print_summary()
             self.logprinter = None
+        if self.profile is not None:
+            linesep(sys.stderr)
+            print >> sys.stderr, self.profile.report()
+
+    def siginfo(self, signum, frame):
+        """Report progress so far (SIGINFO, SIGUSR1)"""
+        if self.logprinter is not None:
+            self.logprinter.print_stats()
+        if self.profile is not None:
+            linesep(sys.stderr)
+            print >> sys.stderr, self.profile.report()
 
     def connect(self, options):
-        fn = options.dbconnfile
-        if not fn:
-            fn = os.getenv('SYSLOG_PGDB')
-        if not fn:
-            raise EnvironmentError, '-d option is required to specify database'
-        with open(fn) as f:
-            self.pgdb = psycopg2.connect(f.read())
+        self.sources = []
+        try:
+            for label, fn in dbspecs(options):
+                self.sources.append(dbsource(label, fn, self.dbpool))
+        except:
+            for src in self.sources:
+                src.close()
+            raise
+        self.multi = len(self.sources) > 1
+
+    def srcprefix(self, src):
+        return '[%s] ' % src.label if self.multi else ''
+
+    def pool(self):
+        if self.threadpool is None:
+            self.threadpool = multiprocessing.pool.ThreadPool(len(self.sources))
+        return self.threadpool
+
+    def fanout(self, fn):
+        """Call fn(src) for every source, concurrently if there are several.
+
+        Returns [(src, result)]. With several sources, a source that fails
+        is reported and left out rather than failing the whole run.
+        """
+        if not self.multi:
+            src = self.sources[0]
+            return [(src, fn(src))]
+        def call(src):
+            try:
+                src.ensure()
+                return True, fn(src)
+            except (psycopg2.Error, EnvironmentError), e:
+                return False, e
+        rs = []
+        for src, (ok, r) in zip(self.sources, self.pool().map(call, self.sources)):
+            if ok:
+                rs.append((src, r))
+            else:
+                self.srcfailed(src, r)
+        if not rs:
+            raise ApplicationError, 'no database could be queried'
+        return rs
+
+    def stream(self, fn, key=None):
+        """Yield (src, record) for the records of fn(src) from every source.
+
+        With several sources, each is read in its own thread through a
+        bounded queue and the streams are merged by key (each must
+        already be ordered by it), or concatenated if key is None. A
+        source that fails is reported and its stream ends early.
+
+        If the merge is closed before the end (the reader stopped early,
+        or shutdown), the threads are stopped and waited for, so that
+        none is left holding a cursor on a connection.
+        """
+        if not self.multi:
+            src = self.sources[0]
+            return ((src, rec) for rec in fn(src))
+        merged = self.merge(fn, key)
+        self.merges.add(merged)
+        return merged
+
+    def merge(self, fn, key):
+        cancel = threading.Event()
+        readers = []
+        try:
+            streams = []
+            for i, src in enumerate(self.sources):
+                q = Queue.Queue(STREAM_QUEUE_PAGES)
+                t = threading.Thread(target=self.produce, args=(src, fn, q, cancel))
+                t.daemon = True
+                t.start()
+                readers.append((src, t, q))
+                streams.append(self.consume(i, src, q, key))
+            if key is None:
+                merged = itertools.chain(*streams)
+            else:
+                merged = heapq.merge(*streams)
+            for x in merged:
+                yield x[-2:]
+        finally:
+            cancel.set()
+            for src, t, q in readers:
+                waited = 0
+                while t.is_alive():
+                    # Make room for a put it may be blocked in
+                    drain(q)
+                    t.join(STREAM_CANCEL_CHECK)
+                    waited += STREAM_CANCEL_CHECK
+                    if waited >= STREAM_CANCEL_WAIT and t.is_alive():
+                        # Still in a query; the error it gets is dropped
+                        src.pgdb.cancel()
+                        waited = 0
+                drain(q)
+
+    def produce(self, src, fn, q, cancel):
+        """Read fn(src) into q a page at a time, until it ends or cancel
+        is set; then put None"""
+        page = []
+        recs = None
+        try:
+            src.ensure()
+            recs = fn(src)
+            for rec in recs:
+                page.append(rec)
+                if len(page) >= STREAM_PAGE:
+                    if not offer(q, page, cancel):
+                        return
+                    page = []
+            if page:
+                offer(q, page, cancel)
+        except Exception, e:
+            if page:
+                offer(q, page, cancel)
+            offer(q, e, cancel)
+        finally:
+            # When cancelled, its cursor is closed here rather than
+            # whenever it is collected; the query may have failed
+            close = getattr(recs, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except psycopg2.Error:
+                    pass
+        offer(q, None, cancel)
+
+    def consume(self, i, src, q, key):
+        n = 0
+        while True:
+            page = q.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                if not isinstance(page, (psycopg2.Error, EnvironmentError)):
+                    raise page
+                self.srcfailed(src, page)
+                return
+            for rec in page:
+                # i and n keep heapq.merge from ever comparing records
+                yield (key(rec) if key else None), i, n, src, rec
+                n += 1
+
+    def srcfailed(self, src, e):
+        self.warn('%sskipped: %s' % (self.srcprefix(src), str(e).strip()))
+        try:
+            src.pgdb.rollback()
+        except psycopg2.Error:
+            pass
+
+    def getcursor(self, src, named=False):
+        """Return a cursor for the logs database src.
+
+        A named cursor is a server-side portal: iterating over it fetches
+        itersize rows per round trip, so arbitrarily large results are
+        streamed in constant memory. It can only execute one statement.
+        """
+        if not named:
+            return src.pgdb.cursor(cursor_factory=recordcursor)
+        src.ncursors += 1
+        c = src.pgdb.cursor('pgsyslog_%d' % src.ncursors,
+                            cursor_factory=recordcursor)
+        c.itersize = self.itersize
+        return c
+
+    def endquery(self, src):
+        """End the current transaction, releasing its snapshot (and
+        letting pending notifications through)"""
+        src.pgdb.commit()
+
+    def has_trigger(self, src, name):
+        c = src.pgdb.cursor()
+        try:
+            self.cexec(c, 'SELECT 1 FROM pg_trigger WHERE tgrelid = %(relname)s::regclass '
+                          'AND tgname = %(tgname)s AND NOT tgisinternal',
+                       sqla={'relname': self.logstable, 'tgname': name})
+            return c.fetchone() is not None
+        finally:
+            c.close()
 
-    def getcursor(self):
-        return self.pgdb.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    def has_column(self, src, name):
+        c = src.pgdb.cursor()
+        try:
+            self.cexec(c, 'SELECT 1 FROM pg_attribute WHERE attrelid = %(relname)s::regclass '
+                          'AND attname = %(attname)s AND NOT attisdropped',
+                       sqla={'relname': self.logstable, 'attname': name})
+            return c.fetchone() is not None
+        finally:
+            c.close()
+
+    def listen(self, src, channel):
+        c = src.pgdb.cursor()
+        try:
+            self.cexec(c, 'LISTEN %s' % channel, sqla={})
+        finally:
+            c.close()
+        src.pgdb.commit()
+        src.listening = True
+
+    def waitnotify(self, timeout):
+        """Block on the connection sockets for up to timeout seconds.
+
+        Returns true if any notifications arrived; these are discarded
+        since the caller re-queries for new rows anyway.
+        """
+        conns = [src.pgdb for src in self.sources]
+        if not any(x.notifies for x in conns):
+            ready = select.select(conns, [], [], timeout)[0]
+            if not ready:
+                return False
+            for x in ready:
+                x.poll()
+        got = False
+        for x in conns:
+            if x.notifies:
+                del x.notifies[:]
+                got = True
+        return got
 
     def filteraddwhere(self, key, values, *args, **kwargs):
         if values is not None:
@@ -283,6 +1764,7 @@ class syslogfilter(object):
             self.sqla[k] = value
 
     def filteraddwhere_in(self, key, values, negsign='-'):
+        values = list(values or ())
         if not values:
             return
         pos = [x for x in values if not x.startswith(negsign)]
@@ -294,11 +1776,43 @@ class syslogfilter(object):
         self.filteraddwhere_in_1(key, neg, 'NOT IN')
 
     def filteraddwhere_in_1(self, key, values, inop='IN'):
-        if values:
+        if not values:
+            return
+        exact = [x for x in values if not isglob(x)]
+        clauses = []
+        if exact:
             skey = key if key.endswith('s') else key + 's'
             k = self.sqlvarname('%s_%s' % (skey, inop.replace(' ', '')))
-            self.wcl.append('%s %s %%(%s)s' % (key, inop, k))
-            self.sqla[k] = tuple(values)
+            # An array, unlike an IN list, is one parameter when prepared
+            clauses.append('%s %s(%%(%s)s)' % (key, IN_ARRAY_OPS[inop], k))
+            self.sqla[k] = exact
+        for x in values:
+            if isglob(x):
+                clauses.append(self.globclause(key, x, inop != 'IN'))
+        if inop != 'IN':
+            self.wcl.extend(clauses)
+        elif len(clauses) == 1:
+            self.wcl.append(clauses[0])
+        else:
+            self.wcl.append('(%s)' % ' OR '.join(clauses))
+
+    def globclause(self, key, pattern, negate=False):
+        """Match key against a pattern with * and ? wildcards. Its
+        literal prefix, if any, is also given as a range in byte order,
+        which a text_pattern_ops index on key serves (as does any btree
+        index on key with the C collation)."""
+        k = self.sqlvarname('%s_like' % key)
+        self.sqla[k] = globlike(pattern)
+        if negate:
+            return '%s NOT LIKE %%(%s)s' % (key, k)
+        like = '%s LIKE %%(%s)s' % (key, k)
+        prefix = globprefix(pattern)
+        if not prefix:
+            return like
+        lo, hi = self.sqlvarname('%s_from' % key), self.sqlvarname('%s_to' % key)
+        self.sqla[lo] = prefix
+        self.sqla[hi] = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return '(%s ~>=~ %%(%s)s AND %s ~<~ %%(%s)s AND %s)' % (key, lo, key, hi, like)
 
     def sqlacounter(self):
         # Yes this will return 1 first, who cares
@@ -312,26 +1826,53 @@ class syslogfilter(object):
         self.sqla = {}
         self.sqlc = 0
         self.wcl = []
+        # Time bounds are compared as plain timestamps (the type of
+        # stamp) so that partitions of logs can be pruned.
+        begin = '%(begindate)s::date::timestamp'
+        end = '%(enddate)s::date::timestamp'
         if options.begindate and options.enddate:
-            self.wcl.append('stamp BETWEEN %(begindate)s::date AND %(enddate)s::date')
+            self.wcl.append('stamp BETWEEN %s AND %s' % (begin, end))
             self.sqla['begindate'] = options.begindate
             self.sqla['enddate'] = options.enddate
+            self.timerange = (begin, end)
         elif options.begindate:
-            self.wcl.append('stamp > %(begindate)s::date')
+            self.wcl.append('stamp > %s' % begin)
             self.sqla['begindate'] = options.begindate
+            self.timerange = (begin, None)
         elif options.enddate:
-            self.wcl.append('stamp < %(enddate)s::date')
+            self.wcl.append('stamp < %s' % end)
             self.sqla['enddate'] = options.enddate
+            self.timerange = (None, end)
         elif options.interval:
-            self.wcl.append('stamp > (now() - %(interval)s::interval)')
+            begin = '(localtimestamp - %(interval)s::interval)'
+            self.wcl.append('stamp > %s' % begin)
             self.sqla['interval'] = options.interval
+            self.timerange = (begin, None)
+        else:
+            self.timerange = (None, None)
+        n = len(self.wcl)
         self.filteraddwhere_in('host',
             (quote_implied_domains(options, x) for x in options.filter_host))
         self.filteraddwhere_in('facility', options.filter_facility)
         self.filteraddwhere_in('program', options.filter_program)
+        self.filteraddwhere_in('priority', options.filter_priority)
+        self.colwcl = self.wcl[n:]
+        n = len(self.wcl)
         self.filteraddwhere('msg', options.filter_posixre, '~*')
         self.filteraddwhere('msg', options.filter_like, 'LIKE', False)
         self.filteraddwhere('msg', options.filter_similar, 'SIMILAR TO', False)
+        self.searchrank = None
+        if options.search:
+            k = self.sqlvarname('search')
+            q = "%s('simple', %%(%s)s)" % (SEARCH_SYNTAX_FUNCS[options.search_syntax], k)
+            self.wcl.append('%s @@ %s' % (SEARCH_VECTOR, q))
+            self.sqla[k] = options.search
+            self.searchrank = 'ts_rank(%s, %s)' % (SEARCH_VECTOR, q)
+        self.msgfiltered = len(self.wcl) > n
+
+    def filterkey(self):
+        """Identify the filter set, e.g. to tie saved state to it"""
+        return '%s %r' % (' AND '.join(self.wcl), sorted(self.sqla.items()))
 
     def mkstmt(self, cols, where='', clauses=()):
         ss = ['SELECT %s FROM %s' % (colslist(cols), self.logstable)]
@@ -343,7 +1884,9 @@ class syslogfilter(object):
         ss.extend(clauses)
         return ' '.join(ss)
 
-    def cexec(self, c, statement, sqla=None):
+    def cexec(self, c, statement, sqla=None, prepare=False):
+        """Run statement on cursor c; with prepare, as a server-side
+        prepared statement, planned once per connection"""
         if sqla is None:
             sqla = self.sqla
         else:
@@ -351,7 +1894,89 @@ class syslogfilter(object):
             d.update(sqla)
             sqla = d
         self.vlogsql(statement, sqla)
-        c.execute(statement, sqla)
+        if self.explain_on and statement.startswith('SELECT'):
+            self.explain(c, statement, sqla)
+        run = statement
+        if prepare and self.prepare and c.name is None:
+            run = self.prepared_exec(c, statement)
+        start = time.time()
+        try:
+            c.execute(run, sqla)
+        except (psycopg2.ProgrammingError, psycopg2.DataError), e:
+            if run is statement:
+                raise
+            # The arguments did not fit the parameter types PREPARE
+            # inferred; prepare is only asked for at the start of a
+            # transaction, so nothing else is lost by rolling back
+            self.vprint('prepared statement failed, executing as is: %s' % str(e).strip())
+            c.connection.rollback()
+            self.prepared[c.connection, statement] = None
+            start = time.time()
+            c.execute(statement, sqla)
+        if self.profile is None:
+            return
+        entry = self.profile.executed(statement, time.time() - start)
+        if isinstance(c, recordcursor):
+            c.profile = self.profile, entry
+
+    def prepared_exec(self, c, statement):
+        """Return the EXECUTE of statement, PREPAREd on c's connection
+        the first time; statement itself if it cannot be prepared"""
+        key = c.connection, statement
+        try:
+            p = self.prepared[key]
+        except KeyError:
+            p = self.prepared[key] = self.prepare_stmt(c, statement)
+        if p is None:
+            return statement
+        name, params = p
+        if not params:
+            return 'EXECUTE %s' % name
+        return 'EXECUTE %s (%s)' % (name, ', '.join('%%(%s)s' % x for x in params))
+
+    def prepare_stmt(self, c, statement):
+        name = 'pgsyslog_%d' % (len(self.prepared) + 1)
+        text, params = preparedtext(statement)
+        prepare = 'PREPARE %s AS %s' % (name, text)
+        self.vprint(prepare)
+        # Failing (a parameter of unknown type) must not abort the transaction
+        c.execute('SAVEPOINT pgsyslog_prepare')
+        start = time.time()
+        try:
+            c.execute(prepare)
+        except psycopg2.Error, e:
+            c.execute('ROLLBACK TO SAVEPOINT pgsyslog_prepare')
+            self.vprint('cannot prepare, executing as is: %s' % str(e).strip())
+            return None
+        if self.profile is not None:
+            self.profile.executed('PREPARE %s' % statement, time.time() - start)
+        c.execute('RELEASE SAVEPOINT pgsyslog_prepare')
+        for src in self.sources:
+            if src.pgdb is c.connection:
+                src.prepared = True
+        return name, params
+
+    def explain(self, cursor, statement, sqla):
+        """Print the plan for statement, and which indexes it uses; with
+        --explain-analyze, run it to get actual times and row counts"""
+        c = cursor.connection.cursor()
+        try:
+            if self.explain_analyze:
+                c.execute('EXPLAIN (ANALYZE, BUFFERS) %s' % statement, sqla)
+            else:
+                c.execute('EXPLAIN %s' % statement, sqla)
+            plan = [x for x, in c.fetchall()]
+        finally:
+            c.close()
+        ixs = set()
+        print >> sys.stderr, '=' * 40
+        for line in plan:
+            print >> sys.stderr, 'PLAN: %s' % line
+            m = plan_index_re.search(line)
+            if m:
+                ixs.add(m.group(1))
+        print >> sys.stderr, 'INDEXES: %s' % (', '.join(sorted(ixs)) or 'none')
+        print >> sys.stderr, '=' * 40
 
     def warn(self, s):
         print >> sys.stderr, 'WARNING: %s' % s
@@ -371,18 +1996,282 @@ class syslogfilter(object):
         self.select2(cursor, clauses=clauses, cols=cols, outer=outer)
 
     def select2(self, cursor, where='', clauses=(), outer='',
-                cols=None, sqla=None):
+                cols=None, sqla=None, prepare=False):
+        self.cexec(cursor, self.selectstmt(where, clauses, outer, cols), sqla=sqla,
+                   prepare=prepare)
+
+    def selectstmt(self, where='', clauses=(), outer='', cols=None):
         if cols is None:
             cols = self.needed_cols
         s = self.mkstmt(cols, where, clauses)
         if outer:
             s = outer % s
-        self.cexec(cursor, s, sqla=sqla)
+        return s
+
+    def query(self, src, statement, sqla=None, named=False):
+        """Yield the rows of statement run on src, or stored in the
+        result cache if the filtered time range is sealed"""
+        c = self.getcursor(src, named)
+        try:
+            key = self.cachekey(src, c, statement, sqla)
+            if key is not None:
+                rows = self.cache.get(key)
+                if rows is not None:
+                    self.vprint('%s%d rows from the result cache' % (self.srcprefix(src), len(rows)))
+                    for rec in rows:
+                        yield rec
+                    return
+            self.cexec(c, statement, sqla)
+            if key is None:
+                for rec in c:
+                    yield rec
+                return
+            keep = []
+            for rec in c:
+                if keep is not None:
+                    keep.append(rec)
+                    if len(keep) > CACHE_MAX_ROWS:
+                        keep = None
+                yield rec
+            if keep is not None:
+                self.cache.put(key, [d[0] for d in c.description], keep)
+        finally:
+            c.close()
+
+    def cachekey(self, src, c, statement, sqla):
+        """Return the result cache key for statement, or None if its
+        result may still change"""
+        if self.cache is None or self.explain_on:
+            return None
+        sealed = self.sealedrange(src)
+        if sealed is None:
+            return None
+        d = self.sqla.copy()
+        d.update(sqla or {})
+        return self.cache.key(src.pgdb.dsn, ' '.join(c.mogrify(statement, d).split()),
+                              repr(sealed))
+
+    def sealedrange(self, src):
+        """Return the filtered time range of src as (begin, end) stamps
+        if it ended long enough ago that no more rows can show up, else
+        False; relative dates like 'yesterday' are resolved by the server"""
+        if src.sealed is None:
+            src.sealed = False
+            if 'enddate' in self.sqla:
+                c = src.pgdb.cursor()
+                try:
+                    c.execute('SELECT %s, %s, %s <= localtimestamp - %s::interval' % (
+                        self.timerange[0] or 'NULL', self.timerange[1],
+                        self.timerange[1], '%(sealdelay)s'),
+                        dict(self.sqla, sealdelay=CACHE_SEAL_DELAY))
+                    begin, end, sealed = c.fetchone()
+                finally:
+                    c.close()
+                if sealed:
+                    src.sealed = (begin, end)
+        return src.sealed or None
+
+    def resolverange(self, src):
+        """Return the filtered time range as (begin, end) stamps, None
+        where unbounded"""
+        c = src.pgdb.cursor()
+        try:
+            c.execute('SELECT %s, %s' % (self.timerange[0] or 'NULL::timestamp',
+                                         self.timerange[1] or 'NULL::timestamp'), self.sqla)
+            return c.fetchone()
+        finally:
+            c.close()
+
+    def attacharchives(self, options):
+        """Have queries read the archived rows the filter may select
+        along with logs (--archive).
+
+        Archive files are chosen by their time range and hosts, and the
+        rows of the chosen ones loaded into a temporary table; from
+        then on logstable stands for both, so every mode sees them and
+        filters them as it would logs.
+        """
+        hosts = [quote_implied_domains(options, x) for x in options.filter_host]
+        pos = [x for x in hosts if not x.startswith('-')]
+        neg = [x[1:] for x in hosts if x.startswith('-')]
+        loads = []
+        for src in self.sources:
+            arch = self.archives.get(src.label)
+            if arch is None:
+                continue
+            lo, hi = self.resolverange(src)
+            # Not the whole archive for want of a time filter
+            if lo is None and hi is None:
+                continue
+            attached = self.partitions(src)
+            apos = arch.hosts(pos) if pos else None
+            aneg = arch.hosts(neg)
+            names = [x for x in arch.files(lo, hi, apos, aneg)
+                     if x[:-len(ARCHIVE_SUFFIX)] not in attached]
+            if names:
+                loads.append((src, arch, names, lo, hi, apos, aneg))
+        if not loads:
+            return
+        for src in self.sources:
+            c = src.pgdb.cursor()
+            try:
+                c.execute('DROP TABLE IF EXISTS pg_temp.%s' % ARCHIVE_TABLE)
+                c.execute('CREATE TEMP TABLE %s (LIKE %s)' % (ARCHIVE_TABLE, self.logstable))
+            finally:
+                c.close()
+            src.archived = True
+        for src, arch, names, lo, hi, pos, neg in loads:
+            c = src.pgdb.cursor()
+            n = 0
+            try:
+                for name in names:
+                    for cols, rows in arch.scan(name, lo, hi, pos, neg):
+                        c.copy_expert('COPY pg_temp.%s (%s) FROM STDIN' % (
+                            ARCHIVE_TABLE, colslist(cols)), cStringIO.StringIO(''.join(
+                                '\t'.join(map(copytext, row)) + '\n' for row in rows)))
+                        n += len(rows)
+                c.execute('ANALYZE pg_temp.%s' % ARCHIVE_TABLE)
+            finally:
+                c.close()
+            self.vprint('%sloaded %d archived rows from %d of %d files' % (
+                self.srcprefix(src), n, len(names), len(arch.index)))
+        for src in self.sources:
+            self.endquery(src)
+        self.logstable = '(SELECT * FROM %s UNION ALL SELECT * FROM pg_temp.%s) AS %s' % (
+            self.logstable, ARCHIVE_TABLE, self.logstable)
+
+    def partitions(self, src):
+        """Names of the partitions of logs, which are read live even if
+        archived (they are archived before being dropped)"""
+        c = src.pgdb.cursor()
+        try:
+            c.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                      'WHERE i.inhparent = %s::regclass', (self.logstable,))
+            return set(x for x, in c.fetchall())
+        finally:
+            c.close()
+
+    def droparchivetable(self, src):
+        """Keep a pooled connection from carrying the table over"""
+        try:
+            src.ensure()
+            c = src.pgdb.cursor()
+            c.execute('DROP TABLE IF EXISTS pg_temp.%s' % ARCHIVE_TABLE)
+            c.close()
+            src.pgdb.commit()
+        except psycopg2.Error:
+            pass
+        src.archived = False
 
     def selectrow(self, cursor, cols):
         self.cexec(cursor, self.mkstmt(cols))
         return cursor.fetchone()
 
+    def has_rollup(self, src, c):
+        if src.use_rollup is None:
+            src.use_rollup = self.use_rollup
+        if src.use_rollup is None:
+            self.cexec(c, 'SELECT to_regclass(%(rolluptable)s)',
+                       sqla={'rolluptable': self.rolluptable})
+            src.use_rollup = c.fetchone()[0] is not None
+            if not src.use_rollup:
+                self.vprint('%sno %s table, summarizing raw rows' % (
+                    self.srcprefix(src), self.rolluptable))
+        return src.use_rollup
+
+    def rollupbounds(self, src, c):
+        """Return the bucket range [lo, hi) the rollup can answer for.
+
+        Buckets only partially inside the filtered time range, and the
+        first bucket in the rollup (which may have been partially
+        rolled up), are left to the raw rows. hi is None for an open
+        range; None is returned if message filters are in effect or
+        no whole bucket is covered.
+        """
+        if self.msgfiltered or not self.has_rollup(src, c):
+            return None
+        lo, hi = self.timerange
+        self.cexec(c, 'SELECT %s, %s, (SELECT MIN(bucket) FROM %s)' % (
+            "date_trunc('minute', %s) + interval '1 minute'" % lo if lo else 'NULL::timestamp',
+            "date_trunc('minute', %s)" % hi if hi else 'NULL::timestamp',
+            self.rolluptable))
+        rlo, rhi, minbucket = c.fetchone()
+        if minbucket is None:
+            return None
+        minbucket += datetime.timedelta(minutes=1)
+        if rlo is None or rlo < minbucket:
+            rlo = minbucket
+        if rhi is not None and rlo >= rhi:
+            return None
+        return rlo, rhi
+
+    def rollupfrom(self):
+        """The rollup table with its key columns NULL where logs has them
+        NULL (see ROLLUP_KEY_COLS)"""
+        return "(SELECT bucket, %s, n, first, last FROM %s) AS r" % (
+            ', '.join('CASE WHEN nulls & %d = 0 THEN %s END AS %s' % (1 << i, x, x)
+                      for i, x in enumerate(ROLLUP_KEY_COLS)),
+            self.rolluptable)
+
+    def hostsummary(self, src):
+        """Return (host, count, first stamp, last stamp) for each host in
+        the filtered view of src, most records first"""
+        c = self.getcursor(src)
+        try:
+            return self.hostsummary1(src, c)
+        finally:
+            c.close()
+
+    def hostsummary1(self, src, c):
+        rawcols = 'host, COUNT(*), MIN(stamp), MAX(stamp)'
+        bounds = self.rollupbounds(src, c)
+        if bounds is None:
+            return list(self.query(src, self.mkstmt(
+                rawcols, clauses=['GROUP BY host', 'ORDER BY 2 DESC'])))
+        rlo, rhi = bounds
+        rwcl = self.colwcl + ['bucket >= %(rollup_lo)s']
+        edges = ['stamp < %(rollup_lo)s']
+        if rhi is not None:
+            rwcl.append('bucket < %(rollup_hi)s')
+            edges.append('stamp >= %(rollup_hi)s')
+        return list(self.query(src,
+            'SELECT host, SUM(n)::bigint, MIN(first), MAX(last) FROM ('
+            'SELECT host, SUM(n) AS n, MIN(first) AS first, MAX(last) AS last '
+            'FROM %s WHERE %s GROUP BY host UNION ALL %s) AS x '
+            'GROUP BY host ORDER BY 2 DESC' % (
+                self.rollupfrom(), ' AND '.join(rwcl),
+                self.mkstmt(rawcols, '(%s)' % ' OR '.join(edges), ['GROUP BY host'])),
+            sqla={'rollup_lo': rlo, 'rollup_hi': rhi}))
+
+    def serverstats(self):
+        """Return a statcounter for the whole filtered view, counted by
+        the database with one GROUPING SETS query per source"""
+        cols = [cnx[0] for tabname, cnx in statcounter.tab_cols_map]
+        n = len(cols)
+        def grouped(src):
+            return list(self.query(src, self.mkstmt(
+                '%s, COUNT(*), MIN(stamp), GROUPING(%s)' % (colslist(cols), colslist(cols)),
+                clauses=['GROUP BY GROUPING SETS (%s, ())' % ', '.join('(%s)' % x for x in cols)])))
+        counts = dict((col, {}) for col in cols)
+        nrec = 0
+        firststamp = None
+        for src, rows in self.fanout(grouped):
+            for row in rows:
+                count, first, mask = row[n:]
+                for i, col in enumerate(cols):
+                    # GROUPING() sets the bits of the columns not grouped by
+                    if not mask & 1 << (n - 1 - i):
+                        tab = counts[col]
+                        tab[row[i]] = tab.get(row[i], 0) + count
+                        break
+                else:
+                    nrec += count
+                    if first is not None and (firststamp is None or first < firststamp):
+                        firststamp = first
+        stats = statcounter(cols)
+        stats.load(nrec, firststamp, counts)
+        return stats
+
     def gen_needed_cols(self, options):
         """Determine columns which we actually need"""
         if options.mode == 'poller':
@@ -395,6 +2284,11 @@ class syslogfilter(object):
             yield 'priority'
         if options.print_full:
             yield 'tag'
+        # Rows collapsed by pgingest.py --collapse, shown with their
+        # count with or without --collapse here
+        if all(self.has_column(src, 'repeats') for src in self.sources):
+            for x in SYSLOG_REPEAT_COLS:
+                yield x
 
 class runmodeswitch(object):
 
@@ -412,88 +2306,122 @@ class runmodeswitch(object):
         poller(self.slf, options).start()
 
     def start_tail(self, options):
-        c = self.slf.getcursor()
-        try:
-            clauses = ['ORDER BY stamp DESC']
+        if options.search_rank:
+            clauses = ['ORDER BY %s DESC' % self.slf.searchrank]
             if options.tailcount > 0:
                 clauses.append('LIMIT %d' % options.tailcount)
-            self.slf.select(c, clauses,
-                        outer='SELECT * FROM (%s) AS x ORDER BY x.stamp')
-            recs = c.fetchall()
-            self.slf.logprinter.precs(recs)
-            if options.tailcount_defaulted and len(recs) >= options.tailcount:
-                z, = self.slf.selectrow(c, cols='COUNT(*)')
-                self.slf.warn('tailcount output limited [%d/%d]' % (len(recs), z))
-        finally:
-            c.close()
+            statement = self.slf.selectstmt(clauses=clauses)
+        elif options.tailcount > 0:
+            statement = self.slf.selectstmt(clauses=['ORDER BY stamp DESC', 'LIMIT %d' % options.tailcount],
+                                            outer='SELECT * FROM (%s) AS x ORDER BY x.stamp')
+        else:
+            statement = self.slf.selectstmt(clauses=['ORDER BY stamp'])
+        def query(src):
+            return self.slf.query(src, statement, named=True)
+        # Relevance ranks are not comparable across databases
+        key = None if options.search_rank else stampkey
+        n = self.slf.logprinter.precs(self.slf.stream(query, key))
+        stats = self.slf.serverstats() if options.print_stats else None
+        if options.tailcount_defaulted and n >= options.tailcount:
+            def count(src):
+                return list(self.slf.query(src, self.slf.mkstmt('COUNT(*)')))[0][0]
+            if stats is not None:
+                z = stats.nrec
+            else:
+                z = sum(x for src, x in self.slf.fanout(count))
+            self.slf.warn('tailcount output limited [%d/%d]' % (n, z))
+        if stats is not None and stats.nrec:
+            self.slf.logprinter.print_stats(stats)
 
     def start_view(self, options, simple=False):
-        def summary(labelfmt, sqlcols):
-            self.slf.select(c, cols=sqlcols)
-            print labelfmt % c.fetchone()[0]
         if 'interval' in self.slf.sqla:
             print '[Interval]:\t\t\t\t%s' % self.slf.sqla['interval']
-        c = self.slf.getcursor()
-        try:
-            summary('Records in filtered view (total):\t%d', 'count(*)')
-            if not simple:
-                summary('Distinct hosts:\t\t\t\t%d', 'count(distinct host)')
-                summary('First record:\t\t\t\t%s', 'min(stamp)')
-                summary('Last record:\t\t\t\t%s', 'max(stamp)')
-        finally:
-            c.close()
+        data = self.hostsummary()
+        print 'Records in filtered view (total):\t%d' % sum(x[1] for x in data)
+        if not simple:
+            print 'Distinct hosts:\t\t\t\t%d' % len([x for x in data if x[0] is not None])
+            print 'First record:\t\t\t\t%s' % (min(x[2] for x in data) if data else None)
+            print 'Last record:\t\t\t\t%s' % (max(x[3] for x in data) if data else None)
+        if options.print_stats:
+            stats = self.slf.serverstats()
+            if stats.nrec:
+                self.slf.logprinter.print_stats(stats)
 
     def start_hosts(self, options):
-        c = self.slf.getcursor()
-        try:
-            self.slf.select(c, cols='DISTINCT host')
-            hosts = [x[0] for x in c.fetchall()]
-        finally:
-            c.close()
+        hosts = sorted(x[0] for x in self.hostsummary())
         for host in hosts:
             print host
         print >> sys.stderr, '(%d host%s)' % (len(hosts), len(hosts) != 1 and 's' or '')
 
     def start_hstats(self, options):
-        c = self.slf.getcursor()
-        try:
-            self.slf.cexec(c, 'SELECT x.host, (%s) FROM (%s) AS x ORDER BY COUNT DESC' % (
-                self.slf.mkstmt('COUNT(*)', 'host = x.host'),
-                self.slf.mkstmt('DISTINCT host')))
-            data = c.fetchall()
-            hosts, counts = zip(*data)
-            w = max(map(len, hosts))
-            fmt = '%%%ds\t%%d' % w
-            for host, count in data:
-                print fmt % (host, count)
-            print >> sys.stderr, '[%s]' % domainstatsf(hosts)
-            print >> sys.stderr, '(%d hosts, %d records)' % (len(hosts), sum(counts))
-        finally:
-            c.close()
+        data = self.hostsummary()
+        if not data:
+            return
+        hosts = [x[0] for x in data]
+        w = max(len('%s' % x) for x in hosts)
+        fmt = '%%%ds\t%%d' % w
+        for host, count, first, last in data:
+            print fmt % (host, count)
+        print >> sys.stderr, '[%s]' % domainstatsf([x for x in hosts if x is not None])
+        print >> sys.stderr, '(%d hosts, %d records)' % (len(hosts), sum(x[1] for x in data))
+
+    def hostsummary(self):
+        """Combine the per-host summaries of every source"""
+        tab = {}
+        for src, rows in self.slf.fanout(self.slf.hostsummary):
+            for host, count, first, last in rows:
+                if host in tab:
+                    _, xcount, xfirst, xlast = tab[host]
+                    tab[host] = (host, xcount + count, min(xfirst, first), max(xlast, last))
+                else:
+                    tab[host] = (host, count, first, last)
+        return sorted(tab.itervalues(), key=operator.itemgetter(1), reverse=True)
 
     def start_changes(self, options):
-        c = self.slf.getcursor()
-        def gethosts():
-            self.slf.select2(c, 'stamp BETWEEN timestamp %(curr)s AND timestamp %(cend)s',
-                             cols='DISTINCT host',
-                             sqla={'curr': curr, 'cend': cend})
-            return set(map(operator.itemgetter(0), c.fetchall()))
         td = datetime.timedelta(hours=options.chours)
-        try:
-            curr, = self.slf.selectrow(c, 'MIN(stamp)')
+        filterkey = self.slf.filterkey()
+        state = None
+        if options.changes_state:
+            state = loadstate(options.changes_state)
+            if state and (state.get('hours') != options.chours or
+                          state.get('filter') != filterkey):
+                self.slf.warn('%s is for a different --changes report; starting over' %
+                              options.changes_state)
+                state = None
+        if state:
+            origin = parsestamp(state['origin'])
+            xhs = set(state['hosts'])
+            start = origin + (state['bucket'] + 1) * td
+        else:
+            def first(src):
+                return list(self.slf.query(src, self.slf.mkstmt('MIN(stamp)')))[0][0]
+            origin = min([x for src, x in self.slf.fanout(first) if x is not None] or [None])
+            if origin is None:
+                print >> sys.stderr, '(no records)'
+                return
             xhs = None
-            buf = []
-            while True:
+            start = origin
+        # Each window's diff is held back until a later window shows up,
+        # since the last one is likely still filling up.
+        statement = self.slf.selectstmt(
+            'stamp >= %(cstart)s', ['ORDER BY bucket'],
+            cols='DISTINCT floor(extract(epoch FROM stamp - %(corigin)s) / %(cwidth)s)::bigint '
+                 'AS bucket, host')
+        def query(src):
+            return self.slf.query(src, statement, named=True,
+                                  sqla={'cstart': start, 'corigin': origin,
+                                        'cwidth': td.total_seconds()})
+        lastbucket = buf = done = None
+        recs = self.slf.stream(query, operator.itemgetter(0))
+        try:
+            for bucket, xrecs in itertools.groupby(recs, lambda x: x[1][0]):
+                hs = set(rec[1] for src, rec in xrecs)
+                curr = origin + bucket * td
                 cend = curr + td
-                hs = gethosts()
-                if not hs:
-                    print '<%s> Ending with %d hosts' % (stampformat(curr), len(xhs))
-                    return
-                if not xhs:
-                    assert not buf
+                if xhs is None:
                     print '<%s> Starting with %d hosts' % (stampformat(curr), len(hs))
                 else:
-                    for x in buf:
+                    for x in buf or ():
                         print x
                     buf = []
                     lost = xhs - hs
@@ -504,10 +2432,21 @@ class runmodeswitch(object):
                             buf.append('- %s' % ' '.join(lost))
                         if boot:
                             buf.append('+ %s' % ' '.join(boot))
+                if lastbucket is not None:
+                    done = (lastbucket, xhs)
+                lastbucket = bucket
                 xhs = hs
-                curr = cend
         finally:
-            c.close()
+            recs.close()
+        if lastbucket is None:
+            return
+        print '<%s> Ending with %d hosts' % (stampformat(cend), len(xhs))
+        if options.changes_state and done is not None:
+            bucket, hosts = done
+            savestate(options.changes_state, {
+                'hours': options.chours, 'filter': filterkey,
+                'origin': stampstr(origin), 'bucket': bucket,
+                'hosts': sorted(hosts)})
 
 
 def set_local_timezone(options):
@@ -578,15 +2517,45 @@ def optparseconfig():
                          help='Provide per-host statistics')
     modegroup.add_option('', '--changes', type='int', action='callback',
                          callback=storeandmode('chours', 'changes'),
-                         help='XXX')
+                         help='Report hosts appearing and disappearing between windows of N hours')
+    modegroup.add_option('', '--changes-state', metavar='FILE',
+                         help='Checkpoint file for --changes; later runs only process new windows')
     parser.add_option_group(modegroup)
 
     dbgroup = optparse.OptionGroup(parser, 'Database connection options')
     dbgroup.add_option('-d', '--dbconnfile', dest='dbconnfile', type='string',
+                      action='append', metavar='[LABEL=]FILE',
                       help='File containing PostgreSQL connection string; '\
-                      'default read from SYSLOG_PGDB environment variable')
+                      'default read from SYSLOG_PGDB environment variable. '
+                      'Repeat to query several databases at once; their records '
+                      'are merged by time and labelled (default label: file name)')
     dbgroup.add_option('', '--sql-verbose', dest='verbose', action='store_true',
         help='Print details about SQL queries')
+    dbgroup.add_option('', '--explain', action='store_true',
+        help='Print the plan of each query, and the indexes it uses')
+    dbgroup.add_option('', '--explain-analyze', action='store_true',
+        help='Like --explain, but run each query an extra time with EXPLAIN ANALYZE '
+             'to print actual times, row counts and buffer use')
+    dbgroup.add_option('', '--profile', action='store_true',
+        help='Print the time spent in, and rows and bytes returned by, each query '
+             'at exit and on SIGUSR1')
+    addboolopt(dbgroup, 'rollup',
+        help='answering --view, --hosts and --hstats from the per-minute rollup table '
+             'when no message filters are given (default: if the table exists)')
+    addboolopt(dbgroup, 'prepare',
+        help='preparing the statements the poller repeats, so they are planned once '
+             '(default: on)')
+    addboolopt(dbgroup, 'cache',
+        help='caching the results of queries whose time range (-E) has passed')
+    dbgroup.add_option('', '--cache-dir', metavar='DIR',
+        help='Result cache directory (default: $XDG_CACHE_HOME/pgsyslog or ~/.cache/pgsyslog)')
+    dbgroup.add_option('', '--cache-size', type='int', default=DEFAULT_CACHE_SIZE, metavar='MB',
+        help='Result cache size limit; least recently used results are removed first (default: %default MB)')
+    dbgroup.add_option('', '--archive', action='append', metavar='[LABEL=]DIR',
+        help='Also read the partitions archived to DIR by pgpartman.py maintain --archive '
+             'when -B/-E reach into them (LABEL= with several databases)')
+    dbgroup.add_option('', '--itersize', type='int', default=DEFAULT_ITERSIZE,
+        help='Rows fetched per round trip when streaming records (default: %d)' % DEFAULT_ITERSIZE)
     dbgroup.add_option('', '--implied-domain', dest='implied_domains',
         type='string', action='append', default=[],
         help='''
@@ -616,12 +2585,14 @@ is SQL DATE expression)
                                      'dash (-) the match sense will be reversed (i.e. NOT)')
     simplefil.add_option('-h', '--host', dest='filter_host', default=[],
                          type='string', action='append',
-                         help='Match syslog source host')
+                         help='Match syslog source host (* and ? match any characters and any one; -HOST excludes)')
     simplefil.add_option('-f', '--facility', dest='filter_facility',
                          type='string', action='append',
-                         help='Match syslog facility')
+                         help='Match syslog facility (wildcards as for -h)')
     simplefil.add_option('-p', '--program', dest='filter_program', action='append',
-                         help='Match program name')
+                         help='Match program name (wildcards as for -h)')
+    simplefil.add_option('', '--priority', dest='filter_priority', action='append',
+                         help='Match syslog priority (wildcards as for -h)')
     parser.add_option_group(simplefil)
 
     advfilter = optparse.OptionGroup(parser, 'Advanced filtering options')
@@ -632,6 +2603,14 @@ is SQL DATE expression)
                          help='Match message content using an SQL LIKE expression')
     advfilter.add_option('', '--similar', dest='filter_similar', action='append',
                          help='Match message content using an SQL SIMILAR TO expression')
+    advfilter.add_option('-s', '--search', dest='search',
+                         help='Match message words using full-text search (indexed; see postgres.sql)')
+    advfilter.add_option('', '--search-syntax', type='choice', default='web',
+                         choices=sorted(SEARCH_SYNTAX_FUNCS),
+                         help='How --search is parsed: web (quoted phrases, or, -word), '
+                              'plain (all words), phrase (words in order) or tsquery (default: %default)')
+    advfilter.add_option('', '--rank', dest='search_rank', action='store_true',
+                         help='In tail mode, order --search matches by relevance instead of time')
     parser.add_option_group(advfilter)
 
     printgroup = optparse.OptionGroup(parser, 'Log message output options')
@@ -653,8 +2632,11 @@ is SQL DATE expression)
         help='Include syslog facility and priority in output')
     printgroup.add_option('', '--print-full', action='store_true',
         help='Break out all syslog details in output')
+    printgroup.add_option('', '--collapse', type='float', default=0, metavar='SECONDS',
+        help='Print a record repeated (same host, program and message) within SECONDS once, '
+             'then how many copies followed; also shows rows collapsed by pgingest.py')
     addboolopt(printgroup, 'stats', dest='print_stats',
-        help='view statistics collection (output at the end or for SIGINFO)')
+        help='view statistics collection (output at the end or for SIGINFO/SIGUSR1)')
     parser.add_option_group(printgroup)
 
     pollergroup = optparse.OptionGroup(parser, 'Polling mode options')
@@ -662,17 +2644,35 @@ is SQL DATE expression)
                help='output of wait progress')
     pollergroup.add_option('', '--poll-interval', dest='poller_interval', type='float', default=0.5,
                       help='How often to poll the database in polling mode')
+    pollergroup.add_option('', '--poll-max-interval', dest='poller_max_interval', type='float',
+                           default=DEFAULT_POLL_MAX_INTERVAL, metavar='SECONDS',
+                           help='Back off to polling this often while nothing arrives (default: %default)')
     pollergroup.add_option('', '--poll-elapsenote', dest='poller_elapsenote', type='float', default=60,
                       help='Print a notice if the time to the previous message exceeds this (seconds)')
     pollergroup.add_option('', '--poller-initial-page', type='int', default='25',
                            help='Number of records to fetch on initial query')
+    pollergroup.add_option('', '--catchup-batch', dest='poller_batch', type='int', default=DEFAULT_CATCHUP_BATCH,
+                           help='Fetch new records at most this many at a time (default: %default)')
+    pollergroup.add_option('', '--poll-state', dest='poller_state', metavar='FILE',
+                           help='Record the last seq seen in FILE and resume from it on restart')
+    pollergroup.add_option('', '--delay-metrics', metavar='FILE',
+                           help='Write ingestion delay percentiles (overall, for the --stats '
+                           'windows and per host) to FILE as JSON every --delay-metrics-interval')
+    pollergroup.add_option('', '--delay-metrics-interval', type='float',
+                           default=DEFAULT_DELAY_METRICS_INTERVAL, metavar='SECONDS',
+                           help='(default: %default)')
+    addboolopt(pollergroup, 'notify', dest='poller_notify',
+               help='LISTEN/NOTIFY driven polling '
+                    '(default: if the %s trigger is installed)' % NOTIFY_TRIGGER)
+    pollergroup.add_option('', '--notify-timeout', dest='poller_notify_timeout', type='float', default=30,
+                      help='With --notify, poll anyway if nothing was signalled for this long (seconds)')
     parser.add_option_group(pollergroup)
 
     return parser
 
-def main():
+def main(argv=None, pool=None):
     parser = optparseconfig()
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(argv)
     if options.mode is None:
         parser.error('at least one running mode option is required')
     options.tailcount_defaulted = options.tailcount is None
@@ -683,24 +2683,128 @@ def main():
     if not options.no_auto_quiet and not sys.stdout.isatty():
         set_quiet_mode(options)
     set_print_verbose(options)
+    if options.poller_batch < 1:
+        parser.error('--catchup-batch must be positive')
+    if options.search_rank and not options.search:
+        parser.error('--rank requires --search')
     try:
         set_local_timezone(options)
     except ApplicationError, e:
         parser.error('%s' % e)
     try:
-        sf = syslogfilter(options)
+        sf = syslogfilter(options, pool=pool)
+        saved = [(x, signal.signal(x, sf.siginfo)) for x in siginfosignals()]
         try:
             runmodeswitch(sf).start(options)
         finally:
+            for x, handler in saved:
+                signal.signal(x, handler)
             sf.shutdown()
     except EnvironmentError, e:
         parser.error('%s' % e)
     except KeyboardInterrupt:
         pass
 
+def siginfosignals():
+    """^T where there is SIGINFO, and SIGUSR1 everywhere"""
+    return [getattr(signal, x) for x in ('SIGINFO', 'SIGUSR1') if hasattr(signal, x)]
+
+def archivespecs(options, labels):
+    """Return {database label: logarchive} for the --archive [LABEL=]DIR
+    given"""
+    r = {}
+    for spec in options.archive or ():
+        label, sep, path = spec.partition('=')
+        if not sep or not dblabel_re.match(label) or label not in labels:
+            if len(labels) > 1:
+                raise EnvironmentError, 'use --archive LABEL=DIR with several databases'
+            label, path = labels[0], spec
+        if not os.path.isdir(path):
+            raise EnvironmentError, 'no archive directory %s' % path
+        r[label] = logarchive(path)
+    return r
+
+def dbspecs(options):
+    """Return (label, connection file) for each -d [LABEL=]FILE given, or
+    for the comma-separated list in SYSLOG_PGDB"""
+    specs = options.dbconnfile
+    if not specs:
+        specs = filter(None, (os.getenv('SYSLOG_PGDB') or '').split(','))
+    if not specs:
+        raise EnvironmentError, '-d option is required to specify database'
+    r = []
+    for spec in specs:
+        label, sep, fn = spec.partition('=')
+        if not sep or not dblabel_re.match(label):
+            label, fn = os.path.splitext(os.path.basename(spec))[0], spec
+        if label in [x for x, _ in r]:
+            raise EnvironmentError, 'duplicate database label %r; use -d LABEL=FILE' % label
+        r.append((label, fn))
+    return r
+
+def stampkey(rec):
+    return rec.stamp
+
+ROWTYPES = {}
+
+def rowtype(cols):
+    """Return the record class for rows with columns cols.
+
+    Records are tuples with no per-instance storage beyond the values;
+    columns are read by position (rec[0]) or as attributes (rec.host).
+    Classes are shared by all results with the same columns.
+    """
+    cols = tuple(cols)
+    try:
+        return ROWTYPES[cols]
+    except KeyError:
+        pass
+    ns = {'__slots__': (), 'cols': cols}
+    for i, col in enumerate(cols):
+        ns.setdefault(col, property(operator.itemgetter(i)))
+    cls = ROWTYPES[cols] = type('record', (tuple,), ns)
+    return cls
+
+def stdoutwriter():
+    """Return a separately buffered file for record output; line
+    buffered on a terminal, in large blocks otherwise. sys.stdout
+    itself if it is not a file (pgsyslogd.py)."""
+    if not isinstance(sys.stdout, file):
+        return sys.stdout
+    fd = sys.stdout.fileno()
+    bufsize = 1 if os.isatty(fd) else OUTPUT_BUFSIZE
+    return os.fdopen(os.dup(fd), 'w', bufsize)
+
+def defaultcachedir():
+    return os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                        'pgsyslog')
+
+def readdsn(fn=None):
+    """Return the connection string in file fn (or SYSLOG_PGDB)"""
+    if not fn:
+        fn = os.getenv('SYSLOG_PGDB')
+    if not fn:
+        raise EnvironmentError, '-d option is required to specify database'
+    with open(fn) as f:
+        return f.read()
+
+def dbconnect(fn=None):
+    """Connect using the connection string in file fn (or SYSLOG_PGDB)"""
+    return psycopg2.connect(readdsn(fn))
+
+def connalive(pgdb):
+    try:
+        c = pgdb.cursor()
+        c.execute('SELECT 1')
+        c.close()
+        pgdb.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def conswaiter(waitstr='\-/|', refresh=.1, noprint=False):
     ix = [0]
-    def iwait(howlong, notice=''):
+    def iwait(howlong, notice='', wakeup=None):
         t = time.time()
         while True:
             s = '%s [%s]' % (notice, waitstr[ix[0]])
@@ -708,16 +2812,36 @@ def conswaiter(waitstr='\-/|', refresh=.1, noprint=False):
                 print '\r%s' % s,
                 sys.stdout.flush()
             ix[0] = (ix[0] + 1) % len(waitstr)
-            if time.time() - t >= howlong:
+            left = howlong - (time.time() - t)
+            if left <= 0:
                 return len(s)
             try:
-                time.sleep(refresh)
+                if wakeup is None:
+                    time.sleep(refresh)
+                elif wakeup(left if noprint else min(refresh, left)):
+                    return len(s)
             except KeyboardInterrupt:
                 if not noprint:
                     print
                 raise
     return iwait
 
+def loadstate(fn):
+    """Read a JSON state file; missing files are empty state"""
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def savestate(fn, state):
+    tmp = '%s.tmp' % fn
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, fn)
+
 def hostdomain(h):
     return '.'.join(h.split('.')[-2:])
 
@@ -743,6 +2867,71 @@ def stampformat(datestamp, format='%b %d %H:%M:%S'):
         datestamp = LOCAL_TIMEZONE.fromutc(datestamp)
     return datestamp.strftime(format)
 
+def stampstr(stamp):
+    return stamp.strftime(STAMP_FORMAT)
+
+def parsestamp(s):
+    return datetime.datetime.strptime(s, STAMP_FORMAT)
+
+def offer(q, item, cancel):
+    """Put item on q, unless cancel is set while waiting for room;
+    returns whether it was"""
+    while not cancel.is_set():
+        try:
+            q.put(item, timeout=STREAM_CANCEL_CHECK)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def drain(q):
+    try:
+        while True:
+            q.get_nowait()
+    except Queue.Empty:
+        pass
+
+def epochseconds(stamp):
+    td = stamp - EPOCH
+    return td.days * 86400 + td.seconds
+
+def epochmicros(stamp):
+    td = stamp - EPOCH
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+def fromepochmicros(n):
+    return EPOCH + datetime.timedelta(microseconds=n)
+
+def nullable(f):
+    return lambda x: None if x is None else f(x)
+
+# How logarchive stores the columns that marshal cannot
+ARCHIVE_CODECS = {
+    'stamp': (nullable(epochmicros), nullable(fromepochmicros)),
+    'date': (nullable(datetime.date.toordinal), nullable(datetime.date.fromordinal)),
+    'time': (nullable(lambda t: ((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 +
+                      t.microsecond),
+             nullable(lambda n: datetime.time(n // 3600000000, n // 60000000 % 60,
+                                              n // 1000000 % 60, n % 1000000))),
+}
+# When the copies of a pgingest.py --collapse row arrived
+ARCHIVE_CODECS['repeat_first'] = ARCHIVE_CODECS['repeat_last'] = ARCHIVE_CODECS['stamp']
+
+def copytext(x):
+    """x as a field of COPY text format"""
+    if x is None:
+        return '\\N'
+    if not isinstance(x, basestring):
+        x = str(x)
+    return x.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+def shortdelta(seconds):
+    for unit, n in ('h', 3600), ('m', 60):
+        if seconds % n == 0:
+            return '%d%s' % (seconds // n, unit)
+    return '%ds' % seconds
+
 def deltaformat(td):
     s = []
     if td.days:
@@ -795,6 +2984,40 @@ def unquote_implied_domains(options, s):
             break
     return s
 
+def isglob(s):
+    return '*' in s or '?' in s
+
+def globlike(pattern):
+    """The LIKE pattern for a pattern with * and ? wildcards"""
+    return pattern.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_').replace('*', '%').replace('?', '_')
+
+def globprefix(pattern):
+    """The literal start of a pattern with * and ? wildcards, up to the
+    first character that is not ASCII (to keep its successor valid)"""
+    prefix = []
+    for c in pattern:
+        if c in '*?' or c >= '\x7f':
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+def globre(pattern):
+    return re.compile(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c)
+                              for c in pattern) + r'\Z', re.S)
+
+def preparedtext(statement):
+    """Return statement with its %(name)s parameters numbered for
+    PREPARE, and the names in order"""
+    params = []
+    def number(m):
+        if m.group(1) is None:
+            return '%'
+        if m.group(1) not in params:
+            params.append(m.group(1))
+        return '$%d' % (params.index(m.group(1)) + 1)
+    return param_re.sub(number, statement), params
+
 def colslist(x):
     if isinstance(x, str):
         return x
@@ -0,0 +1,807 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Micro-benchmarks for pgsyslog.
+
+usage: pgsyslogbench.py [options] benchmark...
+
+  format    records/s of the record formatter against the old
+            print-based one, writing to /dev/null
+  rows      memory per row and construction/format throughput of
+            rowtype records against psycopg2 DictRow rows
+  stats     statcounter records/s, with and without the polling-mode
+            windows, and report time as the number of hosts grows
+  daemon    latency of --query run cold (a pgsyslog.py process each
+            time) and warm (pgsyslogc.py against a pgsyslogd.py with
+            connections already open); needs a database, from -d or
+            SYSLOG_PGDB
+  suite     time every mode and filter combination of pgsyslog.py,
+            and poller catch-up and insert-to-print latency, against a
+            throwaway PostgreSQL cluster loaded with a synthetic, skewed
+            logs table of --size rows; writes JSON (-o)
+
+Only daemon needs a database; suite makes its own with the initdb,
+pg_ctl and psql in --pg-bin, or on PATH, or per pg_config.
+"""
+
+__version__ = '$Id$'
+
+DEFAULT_ROWS = 200000
+DEFAULT_HOSTS = 200
+DEFAULT_QUERY = '--view'
+DEFAULT_REPEAT = 20
+DAEMON_START_TIMEOUT = 10
+
+DEFAULT_SUITE_SIZE = '1M'
+DEFAULT_SUITE_REPEAT = 3
+DEFAULT_SUITE_DAYS = 7
+DEFAULT_SUITE_HOSTS = 2000
+DEFAULT_POLLER_ROWS = 100000
+POLLER_SAMPLES = 20
+POLLER_TIMEOUT = 60
+LOAD_CHUNK = 1000000
+SUITE_SEED = 0.42
+SUITE_DBNAME = 'syslog'
+SUITE_USER = 'pgsyslogbench'
+SUITE_MARKER_HOST = 'pgsyslogbench.invalid'
+SUITE_META = 'pgsyslogbench.json'
+# Settings for a cluster nobody cares to recover
+SUITE_PGCONF = [
+    "listen_addresses = ''",
+    'fsync = off',
+    'full_page_writes = off',
+    'synchronous_commit = off',
+    'shared_buffers = 256MB',
+    'maintenance_work_mem = 512MB',
+    'max_wal_size = 4GB',
+]
+
+BENCH_COLS = ['seq', 'stamp', 'date', 'time', 'host', 'msg', 'program',
+              'facility', 'priority', 'tag']
+
+import bisect
+import collections
+import datetime
+import functools
+import itertools
+import json
+import optparse
+import os
+import psycopg2.extras
+import random
+import select
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pgsyslog
+
+# (program, facility, facility code, message) in decreasing order of
+# frequency; the %s are filled with random numbers
+SUITE_TEMPLATES = [
+    ('sshd', 'auth', 4, 'Connection closed by 10.%s.%s.%s port %s [preauth]'),
+    ('CRON', 'cron', 9, 'pam_unix(cron:session): session opened for user job%s by (uid=%s)'),
+    ('kernel', 'kern', 0, '[UFW BLOCK] IN=eth0 OUT= SRC=192.0.2.%s DST=10.%s.%s.1 LEN=%s PROTO=TCP'),
+    ('postfix/smtpd', 'mail', 2, 'connect from unknown[198.51.%s.%s] port %s'),
+    ('sshd', 'auth', 4, 'Accepted publickey for deploy from 10.%s.%s.%s port %s ssh2'),
+    ('systemd', 'daemon', 3, 'Started Session %s of user u%s.'),
+    ('named', 'daemon', 3, 'client 10.%s.%s.%s#%s: query (cache) denied'),
+    ('postfix/smtpd', 'mail', 2, 'NOQUEUE: reject: RCPT from unknown[203.0.%s.%s]: 554 5.7.1 Relay access denied'),
+    ('ntpd', 'daemon', 3, 'adjusting local clock by %s.%ss'),
+    ('sudo', 'authpriv', 10, 'ops%s : TTY=pts/%s ; PWD=/home/ops ; USER=root ; COMMAND=/usr/bin/systemctl restart app%s'),
+    ('kernel', 'kern', 0, 'nfs: server fs%s not responding, timed out'),
+    ('sshd', 'auth', 4, 'error: connect to 10.%s.%s.%s port %s failed: Connection refused'),
+    ('', 'user', 1, 'app%s[%s]: request %s took %sms'),
+    ('kernel', 'kern', 0, 'Out of memory: Killed process %s (java) total-vm:%skB'),
+]
+SUITE_PRIORITIES = [('info', 6), ('notice', 5), ('warning', 4), ('err', 3), ('crit', 2)]
+
+# Rows are spread evenly over the last --days days before the load;
+# hosts, templates and priorities are each drawn with floor(n ** r),
+# r uniform in [0, 1), so low indexes are much more common (log-uniform,
+# about Zipf with exponent 1). setseed makes a load reproducible.
+SUITE_LOAD = """
+INSERT INTO logs (stamp, host, facility, priority, level, tag, date, time, program, msg)
+SELECT stamp,
+       'host' || lpad(h::text, 5, '0') || (%(domains)s::text[])[1 + h %% 3],
+       (%(facilities)s::text[])[m], (%(priorities)s::text[])[q], (%(priorities)s::text[])[q],
+       lpad(to_hex((%(faccodes)s::int[])[m] * 8 + (%(severities)s::int[])[q]), 2, '0'),
+       (stamp - delay)::date, (stamp - delay)::time,
+       nullif((%(programs)s::text[])[m], ''),
+       format((%(messages)s::text[])[m], a, b, c, d)
+FROM (SELECT %(start)s::timestamp + i * %(step)s::interval AS stamp,
+             floor(power(%(nhosts)s + 1, random()))::int AS h,
+             floor(power(%(nmessages)s + 1, random()))::int AS m,
+             floor(power(%(npriorities)s + 1, random()))::int AS q,
+             random() * interval '2 seconds' AS delay,
+             (random() * 255)::int AS a, (random() * 255)::int AS b,
+             (random() * 255)::int AS c, (random() * 65535)::int AS d
+      FROM generate_series(%(lo)s::bigint, %(hi)s::bigint) AS i) AS x
+"""
+
+# (mode, pgsyslog.py arguments, seconds of data before the end of the
+# dataset to select with -i, or None for no time bound)
+SUITE_CASES = [
+    ('tail', ['-n', '100'], None),
+    ('tail', ['-n', '10000'], None),
+    ('tail', ['-n', '0'], 3600),
+    ('view', ['--view'], 3600),
+    ('view', ['--view'], 86400),
+    ('view', ['--view'], None),
+    ('hosts', ['--hosts'], 86400),
+    ('hstats', ['-H'], 86400),
+    ('hstats', ['-H'], None),
+    ('changes', ['--changes', '24'], None),
+]
+
+# (name, pgsyslog.py arguments); %(tophost)s and %(rarehost)s are the
+# most and least common hosts of the dataset
+SUITE_FILTERS = [
+    ('none', []),
+    ('tophost', ['-h', '%(tophost)s']),
+    ('rarehost', ['-h', '%(rarehost)s']),
+    ('program', ['-p', 'sshd']),
+    ('regex', ['-j', 'timed out']),
+    ('search', ['-s', 'refused']),
+]
+
+
+def synthrows(n, nhosts=DEFAULT_HOSTS, seed=0):
+    """Return n tuples of BENCH_COLS shaped like logs rows, about ten
+    per second from nhosts hosts with a skewed (Zipf-like) distribution"""
+    rnd = random.Random(seed)
+    hosts = ['host%03d.example.com' % i for i in xrange(nhosts)]
+    weights = [1. / (i + 1) for i in xrange(nhosts)]
+    total = sum(weights)
+    cum = []
+    acc = 0.
+    for w in weights:
+        acc += w / total
+        cum.append(acc)
+    programs = ['sshd', 'cron', 'kernel', 'postfix/smtpd', '']
+    facilities = ['auth', 'cron', 'kern', 'mail', 'daemon']
+    priorities = ['info', 'notice', 'warning', 'err']
+    start = datetime.datetime(2019, 3, 10, 0, 0, 0)
+    rows = []
+    for i in xrange(n):
+        h = min(bisect.bisect_left(cum, rnd.random()), nhosts - 1)
+        slstamp = start + datetime.timedelta(seconds=i // 10)
+        rows.append((
+            i + 1,
+            slstamp + datetime.timedelta(microseconds=rnd.randint(0, 999999)),
+            slstamp.date(),
+            slstamp.time(),
+            hosts[h],
+            'message %d from %s with some payload text' % (i, hosts[h]),
+            rnd.choice(programs),
+            rnd.choice(facilities),
+            rnd.choice(priorities),
+            '1e',
+        ))
+    return rows
+
+
+def records(rows):
+    """Wrap rows the way pgsyslog.recordcursor does"""
+    return map(functools.partial(tuple.__new__, pgsyslog.rowtype(BENCH_COLS)), rows)
+
+
+class dictcursor(object):
+    """Just enough of a DictCursor for DictRow"""
+    def __init__(self, cols):
+        self.index = collections.OrderedDict((c, i) for i, c in enumerate(cols))
+        self.description = [(c,) for c in cols]
+
+
+def dictrows(rows):
+    """Build DictRow rows the way psycopg2.extras.DictCursor does"""
+    curs = dictcursor(BENCH_COLS)
+    r = []
+    for t in rows:
+        row = psycopg2.extras.DictRow(curs)
+        for i, v in enumerate(t):
+            row[i] = v
+        r.append(row)
+    return r
+
+
+def legacy_prec(options, rec):
+    """The print-per-field formatter logprinter used before recformatter"""
+    slstamp = datetime.datetime.combine(rec['date'], rec['time'])
+    print pgsyslog.stampformat(slstamp, options.date_format),
+    if options.no_hostname:
+        fmt = ''
+    else:
+        fmt = '%(host)s '
+    if options.print_full:
+        td = rec['stamp'] - slstamp
+        fmt += '%(facility)s.%(priority)s prog=%(program)s tag=%(tag)s'
+        print fmt % rec,
+        print 'delay=%d' % td.total_seconds()
+        print '\t%(msg)s' % rec
+        print '-' * 40
+    else:
+        pr = dict(rec)
+        pr['host'] = pgsyslog.unquote_implied_domains(options, pr['host'])
+        if pr['program']:
+            pr['_print_program'] = ': '
+        else:
+            pr['program'] = ''
+            pr['_print_program'] = ''
+        if options.print_priority:
+            fmt += '[%(facility)s.%(priority)s] %(program)s%(_print_program)s%(msg)s'
+        else:
+            fmt += '%(program)s%(_print_program)s%(msg)s'
+        print fmt % pr
+
+
+def timeit(fn):
+    t = time.time()
+    fn()
+    return time.time() - t
+
+
+def timed(fn, *args):
+    t = time.time()
+    r = fn(*args)
+    return r, time.time() - t
+
+
+def report(name, n, elapsed, base=None):
+    rate = n / max(elapsed, 1e-9)
+    s = '%-24s %10d rows %8.3f s %12.0f rows/s' % (name, n, elapsed, rate)
+    if base is not None:
+        s += '  x%.2f' % (base / max(elapsed, 1e-9))
+    print s
+
+
+def printeropts(options):
+    popts = pgsyslog.optparseconfig().get_default_values()
+    popts.print_full = options.full
+    popts.print_priority = options.priority
+    popts.local_timezone = options.timezone
+    pgsyslog.set_local_timezone(popts)
+    return popts
+
+
+class benchsource(object):
+    """Just enough of a dbsource for the poller's seq tracking"""
+    label = 'bench'
+    lastseq = maxseq = 0
+
+
+def printall(popts, recs):
+    p = pgsyslog.logprinter(popts, BENCH_COLS,
+                            out=open(os.devnull, 'w', pgsyslog.OUTPUT_BUFSIZE))
+    src = benchsource()
+    p.precs((src, rec) for rec in recs)
+    p.close()
+
+
+def bench_format(options):
+    popts = printeropts(options)
+    rows = synthrows(options.rows)
+    dicts = [dict(zip(BENCH_COLS, t)) for t in rows]
+    recs = records(rows)
+    devnull = open(os.devnull, 'w')
+
+    def legacy():
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for rec in dicts:
+                legacy_prec(popts, rec)
+        finally:
+            sys.stdout = stdout
+
+    base = timeit(legacy)
+    report('format legacy', len(rows), base)
+    report('format recformatter', len(rows), timeit(lambda: printall(popts, recs)), base)
+
+
+def bench_rows(options):
+    popts = printeropts(options)
+    rows = synthrows(options.rows)
+    drows, dbuild = timed(dictrows, rows)
+    recs, rbuild = timed(records, rows)
+    # Column values are shared by both; only the row objects differ
+    dsize = sum(map(sys.getsizeof, drows)) / float(len(rows))
+    rsize = sum(map(sys.getsizeof, recs)) / float(len(rows))
+    print '%-24s %10.1f bytes/row' % ('size DictRow', dsize)
+    print '%-24s %10.1f bytes/row  x%.2f' % ('size rowtype', rsize, dsize / rsize)
+    report('build DictRow', len(rows), dbuild)
+    report('build rowtype', len(rows), rbuild, dbuild)
+    base = timeit(lambda: printall(popts, drows))
+    report('format DictRow', len(rows), base)
+    rbase = timeit(lambda: printall(popts, recs))
+    report('format rowtype', len(rows), rbase, base)
+    # Statistics are only counted as records are printed in polling
+    # mode, from rowtype attributes (rec.stamp), which DictRow lacks
+    popts.mode = 'poller'
+    popts.print_stats = True
+    report('format+stats rowtype', len(rows), timeit(lambda: printall(popts, recs)), rbase)
+
+
+def bench_stats(options):
+    rows = synthrows(options.rows, nhosts=options.hosts)
+    # Stamps about ten per second ending now, so every window is filled
+    start = pgsyslog.now() - datetime.timedelta(seconds=len(rows) // 10)
+    rows = [t[:1] + (start + datetime.timedelta(seconds=i // 10),) + t[2:]
+            for i, t in enumerate(rows)]
+    recs = records(rows)
+    for name, windows in ('stats', ()), ('stats+windows', pgsyslog.STATS_WINDOWS):
+        st = pgsyslog.statcounter(BENCH_COLS, windows)
+        report(name, len(recs), timeit(lambda: map(st.enter, recs)))
+        elapsed = timeit(st.report)
+        print '%-24s %10d hosts %8.3f ms' % (name + ' report', options.hosts, elapsed * 1000)
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+
+def bench_daemon(options):
+    here = os.path.dirname(os.path.abspath(__file__))
+    argv = shlex.split(options.query)
+    for spec in options.dbconnfile or ():
+        argv += ['-d', spec]
+    tmpdir = tempfile.mkdtemp(prefix='pgsyslogbench')
+    sockpath = os.path.join(tmpdir, 'pgsyslogd.sock')
+    daemon = subprocess.Popen(
+        [sys.executable, os.path.join(here, 'pgsyslogd.py'), '-S', sockpath, '-w', '1'] +
+        sum((['-d', x] for x in options.dbconnfile or ()), []))
+    devnull = open(os.devnull, 'w')
+    env = dict(os.environ, SYSLOG_PGSOCK=sockpath)
+
+    def run(script):
+        t = time.time()
+        status = subprocess.call([sys.executable, os.path.join(here, script)] + argv,
+                                 stdout=devnull, env=env)
+        if status:
+            raise EnvironmentError, '%s %s failed with status %d' % (
+                script, ' '.join(argv), status)
+        return time.time() - t
+
+    try:
+        t = time.time()
+        while not os.path.exists(sockpath):
+            if daemon.poll() is not None or time.time() - t > DAEMON_START_TIMEOUT:
+                raise EnvironmentError, 'pgsyslogd.py did not start'
+            time.sleep(.05)
+        # Let the worker open its connections and warm its backend
+        run('pgsyslogc.py')
+        for name, script in ('cold', 'pgsyslog.py'), ('warm', 'pgsyslogc.py'):
+            ts = [run(script) for i in xrange(options.repeat or DEFAULT_REPEAT)]
+            print '%-24s %s: min %.1f ms median %.1f ms p90 %.1f ms' % (
+                'daemon ' + name, options.query, min(ts) * 1000,
+                percentile(ts, .5) * 1000, percentile(ts, .9) * 1000)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class pgcluster(object):
+    """A PostgreSQL cluster of our own in path, reachable only through
+    a socket in a private temporary directory"""
+
+    def __init__(self, path, bindir):
+        self.path = path
+        self.bindir = bindir
+        self.datadir = os.path.join(path, 'data')
+        self.logfile = os.path.join(path, 'postgres.log')
+        self.sockdir = None
+
+    def cmd(self, name, *args, **kwargs):
+        argv = [os.path.join(self.bindir, name)] + list(args)
+        with open(self.logfile, 'a') as log:
+            try:
+                status = subprocess.call(argv, stdout=log, stderr=log, **kwargs)
+            except OSError, e:
+                raise EnvironmentError, '%s: %s' % (argv[0], e.strerror)
+        if status:
+            raise EnvironmentError, '%s failed; see %s' % (' '.join(argv), self.logfile)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.datadir, 'PG_VERSION'))
+
+    def initdb(self):
+        self.cmd('initdb', '-D', self.datadir, '-U', SUITE_USER, '-A', 'trust',
+                 '-E', 'UTF8', '--no-locale', '-N')
+        with open(os.path.join(self.datadir, 'postgresql.conf'), 'a') as f:
+            for x in SUITE_PGCONF:
+                print >> f, x
+
+    def start(self):
+        self.sockdir = tempfile.mkdtemp(prefix='pgsb')
+        self.cmd('pg_ctl', '-D', self.datadir, '-l', self.logfile, '-w',
+                 '-o', '-k %s' % self.sockdir, 'start')
+
+    def stop(self):
+        if self.sockdir is None:
+            return
+        try:
+            self.cmd('pg_ctl', '-D', self.datadir, '-m', 'fast', '-w', 'stop')
+        finally:
+            shutil.rmtree(self.sockdir, ignore_errors=True)
+            self.sockdir = None
+
+    def dsn(self, dbname=SUITE_DBNAME):
+        return 'host=%s dbname=%s user=%s' % (self.sockdir, dbname, SUITE_USER)
+
+    def connect(self, dbname=SUITE_DBNAME):
+        return psycopg2.connect(self.dsn(dbname))
+
+
+def pgbindir(options):
+    if options.pg_bin:
+        return options.pg_bin
+    for d in os.getenv('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(d, 'initdb'), os.X_OK):
+            return d
+    try:
+        d = subprocess.check_output(['pg_config', '--bindir']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        d = None
+    if d is None or not os.access(os.path.join(d, 'initdb'), os.X_OK):
+        raise EnvironmentError, 'cannot find initdb; use --pg-bin'
+    return d
+
+def parsesize(s):
+    """'10M' -> 10000000"""
+    mult = {'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9}.get(s[-1:].lower(), 1)
+    try:
+        n = int(s[:-1] if mult > 1 else s) * mult
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise ValueError, 'bad --size: %r' % s
+    return n
+
+def loadsuite(cl, options, nrows):
+    """Create and fill the logs table; returns the dataset description"""
+    timings = collections.OrderedDict()
+    pgdb = cl.connect('postgres')
+    pgdb.autocommit = True
+    pgdb.cursor().execute('CREATE DATABASE %s' % SUITE_DBNAME)
+    pgdb.close()
+    here = os.path.dirname(os.path.abspath(__file__))
+    t = time.time()
+    cl.cmd('psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1', '-d', cl.dsn(),
+           '-f', os.path.join(here, 'postgres.sql'))
+    timings['schema'] = time.time() - t
+
+    pgdb = cl.connect()
+    curs = pgdb.cursor()
+    # Indexes are built after the load, which is much faster than
+    # maintaining them row by row
+    curs.execute("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'logs' "
+                 "AND indexname <> 'logs_pkey'")
+    indexes = curs.fetchall()
+    for name, _ in indexes:
+        curs.execute('DROP INDEX %s' % name)
+    pgdb.commit()
+    end = pgsyslog.now()
+    step = datetime.timedelta(days=options.days) / nrows
+    sqla = {
+        'domains': ['.example.com', '.example.net', '.corp.example.org'],
+        'programs': [x[0] for x in SUITE_TEMPLATES],
+        'facilities': [x[1] for x in SUITE_TEMPLATES],
+        'faccodes': [x[2] for x in SUITE_TEMPLATES],
+        'messages': [x[3] for x in SUITE_TEMPLATES],
+        'priorities': [x[0] for x in SUITE_PRIORITIES],
+        'severities': [x[1] for x in SUITE_PRIORITIES],
+        'nhosts': options.suite_hosts,
+        'nmessages': len(SUITE_TEMPLATES),
+        'npriorities': len(SUITE_PRIORITIES),
+        'start': end - step * nrows,
+        'step': step,
+    }
+    t = time.time()
+    curs.execute('SELECT setseed(%s)', (SUITE_SEED,))
+    for lo in xrange(1, nrows + 1, LOAD_CHUNK):
+        sqla['lo'] = lo
+        sqla['hi'] = min(lo + LOAD_CHUNK - 1, nrows)
+        curs.execute(SUITE_LOAD, sqla)
+        pgdb.commit()
+        print >> sys.stderr, 'suite: loaded %d/%d rows (%.0f s)' % (
+            sqla['hi'], nrows, time.time() - t)
+    timings['rows'] = time.time() - t
+    t = time.time()
+    for name, indexdef in indexes:
+        curs.execute(indexdef)
+        pgdb.commit()
+    timings['indexes'] = time.time() - t
+    t = time.time()
+    pgdb.autocommit = True
+    curs.execute('VACUUM ANALYZE logs')
+    curs.execute('VACUUM ANALYZE logs_rollup')
+    timings['vacuum'] = time.time() - t
+    curs.execute('SELECT host FROM logs_rollup GROUP BY host ORDER BY sum(n) DESC, host')
+    hosts = [x[0] for x in curs.fetchall()]
+    curs.execute("SELECT pg_size_pretty(pg_total_relation_size('logs'))")
+    size = curs.fetchone()[0]
+    pgdb.close()
+    return collections.OrderedDict([
+        ('rows', nrows),
+        ('hosts', options.suite_hosts),
+        ('distinct_hosts', len(hosts)),
+        ('days', options.days),
+        ('seed', SUITE_SEED),
+        ('end', end.strftime(pgsyslog.STAMP_FORMAT)),
+        ('tophost', hosts[0]),
+        ('rarehost', hosts[-1]),
+        ('size', size),
+        ('load', timings),
+    ])
+
+def timingsummary(ts):
+    return collections.OrderedDict([
+        ('min', min(ts)),
+        ('median', percentile(ts, .5)),
+        ('p90', percentile(ts, .9)),
+        ('times', ts),
+    ])
+
+def runpgsyslog(argv):
+    """Run pgsyslog.py argv; returns (seconds, stdout lines, stdout
+    bytes, exit status, stderr)"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    err = tempfile.TemporaryFile()
+    t = time.time()
+    p = subprocess.Popen([sys.executable, os.path.join(here, 'pgsyslog.py')] + argv,
+                         stdout=subprocess.PIPE, stderr=err)
+    nlines = nbytes = 0
+    while True:
+        data = p.stdout.read(pgsyslog.OUTPUT_BUFSIZE)
+        if not data:
+            break
+        nlines += data.count('\n')
+        nbytes += len(data)
+    status = p.wait()
+    elapsed = time.time() - t
+    err.seek(0)
+    return elapsed, nlines, nbytes, status, err.read()
+
+def suitecase(mode, filtername, argv, repeat):
+    r = collections.OrderedDict([('mode', mode), ('filter', filtername), ('argv', argv)])
+    ts = []
+    for i in xrange(repeat):
+        elapsed, nlines, nbytes, status, err = runpgsyslog(argv)
+        if status:
+            r['status'] = status
+            r['error'] = err.strip().splitlines()[-1:]
+            print >> sys.stderr, 'suite: %s failed: %s' % (' '.join(argv), err.strip())
+            return r
+        ts.append(elapsed)
+    r['lines'] = nlines
+    r['bytes'] = nbytes
+    r.update(timingsummary(ts))
+    print >> sys.stderr, 'suite: %-8s %-9s %8d lines  median %8.1f ms  %s' % (
+        mode, filtername, nlines, r['median'] * 1000, ' '.join(argv))
+    return r
+
+def readlines(f, n, marker=None, timeout=POLLER_TIMEOUT):
+    """Read from f until n lines, or a line containing marker, have
+    been seen; unbuffered, so nothing is read past the point"""
+    t = time.time()
+    fd = f.fileno()
+    line = []
+    while True:
+        if not select.select([fd], [], [], max(0, t + timeout - time.time()))[0]:
+            raise EnvironmentError, 'poller: no output for %d s' % timeout
+        c = os.read(fd, 1 if marker else pgsyslog.OUTPUT_BUFSIZE)
+        if not c:
+            raise EnvironmentError, 'poller exited'
+        if marker is None:
+            n -= c.count('\n')
+            if n <= 0:
+                return
+        elif c == '\n':
+            if marker in ''.join(line):
+                return
+            line = []
+        else:
+            line.append(c)
+
+def suitepoller(cl, connfile, options, notify):
+    """Time catching up on the last --poller-rows rows, then from
+    INSERT to printed line for a few rows, with a pgsyslog.py -P"""
+    mode = 'poller' if notify else 'poller-poll'
+    label = os.path.splitext(os.path.basename(connfile))[0]
+    statefile = os.path.join(os.path.dirname(connfile), 'poll.state')
+    pgdb = cl.connect()
+    curs = pgdb.cursor()
+    curs.execute('SELECT max(seq) FROM logs')
+    maxseq = curs.fetchone()[0]
+    nrows = min(options.poller_rows, maxseq - 1)
+    pgsyslog.savestate(statefile, {'seq': {label: maxseq - nrows}})
+    here = os.path.dirname(os.path.abspath(__file__))
+    argv = ['-P', '-d', connfile, '--poll-state', statefile, '--no-progress',
+            '--no-cache', '--notify' if notify else '--no-notify']
+    p = subprocess.Popen([sys.executable, os.path.join(here, 'pgsyslog.py')] + argv,
+                         stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    r = collections.OrderedDict([('mode', mode), ('filter', 'none'), ('argv', argv)])
+    try:
+        t = time.time()
+        readlines(p.stdout, nrows)
+        r['catchup_rows'] = nrows
+        r['catchup'] = time.time() - t
+        ts = []
+        for i in xrange(POLLER_SAMPLES):
+            marker = 'pgsyslogbench latency %d %s' % (i, time.time())
+            t = time.time()
+            curs.execute("INSERT INTO logs (host, program, msg) VALUES (%s, 'bench', %s)",
+                         (SUITE_MARKER_HOST, marker))
+            pgdb.commit()
+            readlines(p.stdout, 1, marker)
+            ts.append(time.time() - t)
+        r['latency'] = timingsummary(ts)
+    finally:
+        p.terminate()
+        p.wait()
+        # Keep the dataset as loaded for later runs
+        pgdb.rollback()
+        curs.execute('DELETE FROM logs WHERE host = %s', (SUITE_MARKER_HOST,))
+        curs.execute('DELETE FROM logs_rollup WHERE host = %s', (SUITE_MARKER_HOST,))
+        pgdb.commit()
+        pgdb.close()
+    print >> sys.stderr, 'suite: %-8s catch-up %d rows %.3f s  latency median %.1f ms' % (
+        mode, nrows, r['catchup'], r['latency']['median'] * 1000)
+    return r
+
+def bench_suite(options):
+    nrows = parsesize(options.size)
+    repeat = options.repeat or DEFAULT_SUITE_REPEAT
+    bindir = pgbindir(options)
+    path = options.cluster or tempfile.mkdtemp(prefix='pgsyslogbench')
+    cl = pgcluster(path, bindir)
+    metafile = os.path.join(path, SUITE_META)
+    try:
+        meta = None
+        if cl.exists():
+            cl.start()
+            with open(metafile) as f:
+                meta = json.load(f, object_pairs_hook=collections.OrderedDict)
+            if (meta['rows'], meta['hosts'], meta['days']) != (
+                    nrows, options.suite_hosts, options.days):
+                raise EnvironmentError, '%s holds a different dataset (%d rows); ' \
+                    'use another --cluster' % (path, meta['rows'])
+            print >> sys.stderr, 'suite: reusing %d rows in %s' % (nrows, path)
+        else:
+            cl.initdb()
+            cl.start()
+            meta = loadsuite(cl, options, nrows)
+            pgsyslog.savestate(metafile, meta)
+        connfile = os.path.join(path, 'syslog.conn')
+        with open(connfile, 'w') as f:
+            f.write(cl.dsn())
+        pgdb = cl.connect()
+        server = pgdb.server_version
+        pgdb.close()
+
+        # Time bounds are relative to now for pgsyslog.py but to the end
+        # of the dataset here, which is older for a reused cluster
+        lag = (pgsyslog.now() - pgsyslog.parsestamp(meta['end'])).total_seconds()
+        ts = [runpgsyslog(['--version'])[0] for i in xrange(repeat)]
+        results = collections.OrderedDict([
+            ('pgsyslog', gitrevision()),
+            ('python', sys.version.split()[0]),
+            ('server_version', server),
+            ('dataset', meta),
+            ('startup', timingsummary(ts)),
+            ('cases', []),
+        ])
+        for (mode, args, span), (fname, fargs) in itertools.product(SUITE_CASES, SUITE_FILTERS):
+            if options.suite_mode and mode not in options.suite_mode:
+                continue
+            argv = args + [x % meta for x in fargs] + ['-d', connfile, '--no-cache']
+            if span is not None:
+                argv += ['-i', '%d seconds' % (lag + span)]
+            results['cases'].append(suitecase(mode, fname, argv, repeat))
+        for notify in True, False:
+            mode = 'poller' if notify else 'poller-poll'
+            if not options.suite_mode or mode in options.suite_mode:
+                results['cases'].append(suitepoller(cl, connfile, options, notify))
+    finally:
+        cl.stop()
+        if not options.cluster:
+            shutil.rmtree(path, ignore_errors=True)
+    out = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(results, out, indent=2, default=str)
+    print >> out
+    if out is not sys.stdout:
+        out.close()
+
+def gitrevision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                           cwd=here, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return pgsyslog.__version__
+
+
+BENCHMARKS = {
+    'format': bench_format,
+    'rows': bench_rows,
+    'stats': bench_stats,
+    'daemon': bench_daemon,
+    'suite': bench_suite,
+}
+
+def optparseconfig():
+    parser = optparse.OptionParser('usage: %prog [options] benchmark...',
+                                   version=__version__)
+    parser.add_option('-n', '--rows', type='int', default=DEFAULT_ROWS,
+                      help='Synthetic records per run (default: %default)')
+    parser.add_option('--hosts', type='int', default=DEFAULT_HOSTS,
+                      help='Distinct hosts in the synthetic records (default: %default)')
+    parser.add_option('-d', '--dbconnfile', action='append', metavar='[LABEL=]FILE',
+                      help='daemon: database to query (may be repeated; default SYSLOG_PGDB)')
+    parser.add_option('--query', default=DEFAULT_QUERY,
+                      help='daemon: pgsyslog.py arguments to time (default: %default)')
+    parser.add_option('--repeat', type='int',
+                      help='daemon, suite: runs of each (default: %d, %d)' % (
+                          DEFAULT_REPEAT, DEFAULT_SUITE_REPEAT))
+    parser.add_option('--full', action='store_true',
+                      help='format, rows: benchmark the --full layout')
+    parser.add_option('--priority', action='store_true',
+                      help='format, rows: benchmark the --priority layout')
+    parser.add_option('--timezone', metavar='TZ',
+                      help='format, rows: render stamps in this time zone (requires pytz)')
+    parser.add_option('--size', default=DEFAULT_SUITE_SIZE,
+                      help='suite: rows in the dataset, e.g. 1M, 10M, 100M (default: %default)')
+    parser.add_option('--suite-hosts', type='int', default=DEFAULT_SUITE_HOSTS, metavar='N',
+                      help='suite: hosts in the dataset (default: %default)')
+    parser.add_option('--days', type='int', default=DEFAULT_SUITE_DAYS,
+                      help='suite: days the dataset spans (default: %default)')
+    parser.add_option('--poller-rows', type='int', default=DEFAULT_POLLER_ROWS, metavar='N',
+                      help='suite: rows for the poller to catch up on (default: %default)')
+    parser.add_option('--suite-mode', action='append', metavar='MODE',
+                      help='suite: only time this mode (tail, view, hosts, hstats, changes, '
+                      'poller, poller-poll; may be repeated)')
+    parser.add_option('--cluster', metavar='DIR',
+                      help='suite: keep the cluster in DIR, and reuse the dataset there '
+                      'on later runs, instead of a temporary one')
+    parser.add_option('--pg-bin', metavar='DIR',
+                      help='suite: directory with initdb, pg_ctl and psql')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='suite: write the JSON results here instead of stdout')
+    return parser
+
+def main():
+    parser = optparseconfig()
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('specify one or more of: %s' % ', '.join(sorted(BENCHMARKS)))
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+    try:
+        for name in args:
+            BENCHMARKS[name](options)
+    except EnvironmentError, e:
+        parser.error('%s' % e)
+
+if __name__ == '__main__':
+    main()
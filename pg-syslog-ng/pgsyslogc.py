@@ -0,0 +1,110 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Thin client for pgsyslogd.py.
+
+Takes the same arguments as pgsyslog.py and has the daemon listening on
+SYSLOG_PGSOCK (default ~/.pgsyslogd.sock) run them, copying its output
+as it arrives. If no daemon is listening, runs pgsyslog.py instead.
+
+The request is one JSON line:
+
+    {"argv": [...], "cwd": ..., "env": {...}, "isatty": [stdout, stderr]}
+
+and the answer a series of "<tag><length>\\n<data>" frames, tag o for
+stdout and e for stderr, ended by "x<exit status>\\n".
+"""
+
+__version__ = '$Id$'
+
+DEFAULT_SOCKET = '~/.pgsyslogd.sock'
+
+# Environment pgsyslog.py depends on, passed along with each request
+ENV_VARS = ['SYSLOG_PGDB', 'TZ']
+
+import errno
+import json
+import os
+import socket
+import sys
+
+
+class ProtocolError(EnvironmentError):
+    pass
+
+
+def socketpath(path=None):
+    return os.path.expanduser(path or os.getenv('SYSLOG_PGSOCK') or DEFAULT_SOCKET)
+
+def connect(path=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath(path))
+    except:
+        sock.close()
+        raise
+    return sock
+
+def request(sock, argv, out=sys.stdout, err=sys.stderr):
+    """Run pgsyslog.py argv on the daemon at sock; returns the exit status"""
+    req = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict((x, os.environ[x]) for x in ENV_VARS if x in os.environ),
+        'isatty': [out.isatty(), err.isatty()],
+    }
+    sock.sendall(json.dumps(req) + '\n')
+    f = sock.makefile('rb')
+    files = {'o': out, 'e': err}
+    while True:
+        head = f.readline()
+        if not head.endswith('\n'):
+            raise ProtocolError, 'pgsyslogd closed the connection'
+        tag, arg = head[0], head[1:-1]
+        if tag == 'x':
+            return int(arg)
+        if tag not in files:
+            raise ProtocolError, 'unexpected reply from pgsyslogd: %r' % head
+        data = f.read(int(arg))
+        files[tag].write(data)
+        files[tag].flush()
+
+def main():
+    argv = sys.argv[1:]
+    try:
+        sock = connect()
+    except socket.error, e:
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            raise
+        pgsyslog = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pgsyslog.py')
+        os.execv(sys.executable, [sys.executable, pgsyslog] + argv)
+    try:
+        status = request(sock, argv)
+    except KeyboardInterrupt:
+        status = 0
+    except EnvironmentError, e:
+        # Quietly when output is cut short (| head)
+        if e.errno != errno.EPIPE:
+            print >> sys.stderr, '%s: %s' % (os.path.basename(sys.argv[0]), e)
+        status = 1
+    finally:
+        sock.close()
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Query daemon for pgsyslog.py.
+
+Runs pgsyslog.py command lines sent by pgsyslogc.py over a Unix-domain
+socket, streaming their output back as it is produced (see pgsyslogc.py
+for the protocol). Each of --workers processes serves one request at a
+time and keeps the connections it has opened in a pgsyslog.connpool,
+so only the first query to a database pays for connection setup and a
+cold backend. The socket is only accessible to the user running the
+daemon, which reads the connection files on the clients' behalf.
+"""
+
+__version__ = '$Id$'
+
+DEFAULT_WORKERS = 4
+LISTEN_BACKLOG = 64
+RESPAWN_DELAY = 1
+# How often a request's watcher checks whether the request is over
+WATCH_INTERVAL = .2
+
+import errno
+import json
+import optparse
+import os
+import psycopg2
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import pgsyslog
+import pgsyslogc
+
+
+class framedwriter(object):
+    """File-like object sending what is written to a client as tagged
+    frames; buffers up to bufsize bytes"""
+
+    def __init__(self, sock, tag, bufsize, tty):
+        self.sock = sock
+        self.tag = tag
+        self.bufsize = bufsize
+        self.tty = tty
+        self.softspace = 0
+        self.buf = []
+        self.buflen = 0
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.buf.append(s)
+        self.buflen += len(s)
+        if self.buflen >= self.bufsize:
+            self.flush()
+
+    def writelines(self, lines):
+        for x in lines:
+            self.write(x)
+
+    def flush(self):
+        if self.buflen:
+            data = ''.join(self.buf)
+            self.buf = []
+            self.buflen = 0
+            self.sock.sendall('%s%d\n%s' % (self.tag, len(data), data))
+
+    def close(self):
+        # The connection belongs to the worker
+        self.flush()
+
+    def isatty(self):
+        return self.tty
+
+
+class worker(object):
+
+    def __init__(self, listener, options):
+        self.listener = listener
+        self.verbose = options.verbose
+        self.pool = pgsyslog.connpool()
+        # Set when the request being served is over, and the one a
+        # watcher sent SIGINT for; one Event per request, so that a
+        # watcher outliving its request cannot interrupt the next
+        self.done = None
+        self.hungup = None
+        self.lock = threading.Lock()
+        self.nrequests = 0
+
+    def log(self, s):
+        print >> sys.stderr, 'pgsyslogd[%d]: %s' % (os.getpid(), s)
+
+    def preconnect(self, specs):
+        for label, fn in specs:
+            try:
+                self.pool.put(*self.pool.get(fn))
+            except (EnvironmentError, psycopg2.Error), e:
+                self.log('cannot connect to %s: %s' % (label, str(e).strip()))
+
+    def interrupt(self, signum, frame):
+        done = self.done
+        if done is not None and self.hungup is done and not done.is_set():
+            raise KeyboardInterrupt
+
+    def run(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, self.interrupt)
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                self.serve(conn)
+            finally:
+                conn.close()
+
+    def watch(self, conn, done):
+        """Interrupt the request if the client goes away before done is set"""
+        try:
+            while not done.is_set():
+                r, w, x = select.select([conn], [], [], WATCH_INTERVAL)
+                if r and not conn.recv(1 << 10):
+                    break
+            else:
+                return
+        except (select.error, socket.error):
+            pass
+        with self.lock:
+            if not done.is_set():
+                self.hungup = done
+                os.kill(os.getpid(), signal.SIGINT)
+
+    def finish(self):
+        """End the request being served, if any"""
+        with self.lock:
+            if self.done is not None:
+                self.done.set()
+                self.done = None
+
+    def serve(self, conn):
+        try:
+            req = json.loads(conn.makefile('rb').readline())
+            argv = [x.encode('utf-8') for x in req['argv']]
+            env = dict((k.encode('utf-8'), v.encode('utf-8'))
+                       for k, v in req.get('env', {}).iteritems()
+                       if k in pgsyslogc.ENV_VARS)
+            cwd = req['cwd']
+            isatty = req.get('isatty', (False, False))
+        except (ValueError, KeyError, TypeError, AttributeError, socket.error), e:
+            self.log('bad request: %s' % e)
+            return
+        t = time.time()
+        saved = sys.argv, sys.stdout, sys.stderr, os.getcwd(), \
+            dict((x, os.environ.get(x)) for x in pgsyslogc.ENV_VARS)
+        out = framedwriter(conn, 'o', pgsyslog.OUTPUT_BUFSIZE, isatty[0])
+        err = framedwriter(conn, 'e', 0, isatty[1])
+        status = 1
+        try:
+            setenv(env)
+            pgsyslog.LOCAL_TIMEZONE = None
+            # For optparse's usage and error messages
+            sys.argv = ['pgsyslog.py'] + argv
+            sys.stdout, sys.stderr = out, err
+            done = self.done = threading.Event()
+            watch = threading.Thread(target=self.watch, args=(conn, done))
+            watch.daemon = True
+            watch.start()
+            try:
+                os.chdir(cwd)
+                pgsyslog.main(argv, pool=self.pool)
+                status = 0
+            except OSError, e:
+                print >> err, 'pgsyslogd: %s' % e
+            except SystemExit, e:
+                status = exitstatus(e, err)
+            except KeyboardInterrupt:
+                status = 0
+            except Exception:
+                traceback.print_exc(file=err)
+            finally:
+                self.finish()
+            out.flush()
+            conn.sendall('x%d\n' % status)
+            conn.shutdown(socket.SHUT_RDWR)
+        except (EnvironmentError, socket.error), e:
+            # Mostly the client going away (EPIPE)
+            status = 'error: %s' % e
+        finally:
+            self.finish()
+            sys.argv, sys.stdout, sys.stderr, cwd, env = saved
+            os.chdir(cwd)
+            setenv(env)
+        self.nrequests += 1
+        if self.verbose:
+            self.log('%s -> %s in %.3f s (%d idle connections)' % (
+                ' '.join(argv), status, time.time() - t, self.pool.size()))
+
+
+class daemon(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.path = pgsyslogc.socketpath(options.socket)
+        self.listener = None
+        self.workers = {}
+
+    def listen(self):
+        if os.path.exists(self.path):
+            try:
+                pgsyslogc.connect(self.path).close()
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise pgsyslog.ApplicationError, 'already running on %s' % self.path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(LISTEN_BACKLOG)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                w = worker(self.listener, self.options)
+                if self.options.dbconnfile:
+                    w.preconnect(pgsyslog.dbspecs(self.options))
+                w.run()
+            except KeyboardInterrupt:
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        self.workers[pid] = time.time()
+
+    def run(self):
+        def stop(signum, frame):
+            raise SystemExit
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        try:
+            for i in xrange(self.options.workers):
+                self.spawn()
+            while True:
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                started = self.workers.pop(pid, None)
+                if started is None:
+                    continue
+                print >> sys.stderr, 'pgsyslogd: worker %d exited with status %d; restarting' % (
+                    pid, status)
+                if time.time() - started < RESPAWN_DELAY:
+                    time.sleep(RESPAWN_DELAY)
+                self.spawn()
+        finally:
+            self.stop()
+
+    def stop(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def setenv(env):
+    for k, v in env.iteritems():
+        if v is None:
+            os.environ.pop(k, None)
+        else:
+            os.environ[k] = v
+    time.tzset()
+
+def exitstatus(e, err):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, (int, long)):
+        return e.code
+    print >> err, e.code
+    return 1
+
+def optparseconfig():
+    parser = optparse.OptionParser('usage: %prog [options]',
+                                   version=__version__)
+    parser.add_option('-S', '--socket', metavar='PATH',
+                      help='Socket to listen on; default from SYSLOG_PGSOCK or %s' %
+                      pgsyslogc.DEFAULT_SOCKET)
+    parser.add_option('-w', '--workers', type='int', default=DEFAULT_WORKERS,
+                      help='Requests served at once (default: %default)')
+    parser.add_option('-d', '--dbconnfile', action='append', metavar='[LABEL=]FILE',
+                      help='Connect each worker to this database at startup (may be repeated)')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='Log every request')
+    return parser
+
+def main():
+    parser = optparseconfig()
+    options, args = parser.parse_args()
+    if args:
+        parser.error('no arguments expected')
+    if options.workers < 1:
+        parser.error('--workers must be positive')
+    d = daemon(options)
+    try:
+        d.listen()
+        d.run()
+    except EnvironmentError, e:
+        parser.error('%s' % e)
+    except SystemExit:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#! /usr/bin/env python2
+#
+# Copyright (c) 2019 Dima Dorfman.
+# All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Follow several filtered streams of new records from one process.
+
+Each stream is an output (a file, FIFO or terminal; - for stdout) and
+pgsyslog.py filter and print options, e.g.
+
+    pgsyslogfollow.py -d db.conn \\
+        --stream '/dev/pts/3 -h web1 -h web2' \\
+        --stream 'panes/db.log -p postgres -j ERROR --print-priority'
+
+or one such line per stream in a -f file. It is like running pgsyslog.py
+-P for each, but all streams share one asynchronous connection per
+database, driven from a single select loop: each time logs_insert is
+signalled (or every --poll-interval without the trigger), one query per
+database fetches the new records matching any stream's filter, with a
+flag per stream, and each record is written to the streams it matched.
+Records from several databases are written as they arrive, labelled but
+not merged by time. --local-timezone, if any stream asks for it, applies
+to all of them.
+"""
+
+__version__ = '$Id$'
+
+DEFAULT_INITIAL = 25
+PREPARED_NAME = 'pgsyslogfollow_new'
+
+import optparse
+import psycopg2
+import psycopg2.extensions
+import re
+import select
+import shlex
+import sys
+import time
+
+import pgsyslog
+
+
+class streamfilter(pgsyslog.syslogfilter):
+    """Just the filter of a syslogfilter: the WHERE clauses of setfilter,
+    with parameters renamed by prefix so that the clauses of several
+    filters can share a statement"""
+
+    def __init__(self, options, prefix, logstable='logs'):
+        self.logstable = logstable
+        self.verbose = options.verbose
+        self.setfilter(options)
+        names = dict((k, '%s%s' % (prefix, k)) for k in self.sqla)
+        def rename(clause):
+            return re.sub(r'%\((\w+)\)s', lambda m: '%%(%s)s' % names[m.group(1)], clause)
+        self.wcl = map(rename, self.wcl)
+        self.sqla = dict((names[k], v) for k, v in self.sqla.iteritems())
+
+    def condition(self):
+        return ' AND '.join('(%s)' % x for x in self.wcl) or 'TRUE'
+
+
+class stream(object):
+    """One filtered, formatted output"""
+
+    def __init__(self, index, spec):
+        args = shlex.split(spec)
+        if not args:
+            raise pgsyslog.ApplicationError, 'empty stream'
+        self.output = args.pop(0)
+        self.spec = spec
+        options, rest = streamparser(self.output).parse_args(args)
+        if rest:
+            raise pgsyslog.ApplicationError, 'stream %s: unexpected arguments: %s' % (
+                self.output, ' '.join(rest))
+        options.mode = 'follow'
+        pgsyslog.set_print_verbose(options)
+        pgsyslog.set_local_timezone(options)
+        self.options = options
+        self.filter = streamfilter(options, 's%d_' % index)
+        self.printer = None
+
+    def open(self, cols, labels):
+        if self.output == '-':
+            out = pgsyslog.stdoutwriter()
+        else:
+            out = open(self.output, 'a', pgsyslog.OUTPUT_BUFSIZE)
+        self.printer = pgsyslog.logprinter(self.options, cols, labels=labels, out=out)
+
+    def close(self):
+        if self.printer is not None:
+            self.printer.close()
+            self.printer = None
+
+
+class dbfeed(object):
+    """New records from one database over an asynchronous connection.
+
+    Only one statement at a time runs on it: start sends one, and step,
+    called when the connection is ready (waitfor), advances it and
+    returns its rows once it is done. Notifications seen on the way
+    set pending.
+    """
+
+    def __init__(self, label, fn):
+        self.label = label
+        self.conn = psycopg2.connect(pgsyslog.readdsn(fn), async=1)
+        wait(self.conn)
+        self.curs = self.conn.cursor(cursor_factory=pgsyslog.recordcursor)
+        self.maxseq = 0
+        self.listening = False
+        self.busy = False
+        self.pending = True
+        self.waitfor = 'r'
+        self.nextpoll = 0
+        # The query for new records, or the EXECUTE of it once prepared
+        self.statement = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def run(self, statement, sqla=None):
+        """Run statement to completion; for setting up"""
+        self.curs.execute(statement, sqla)
+        wait(self.conn)
+        if self.curs.description is not None:
+            return self.curs.fetchall()
+
+    def start(self, statement, sqla):
+        self.curs.execute(statement, sqla)
+        self.busy = True
+        return self.step()
+
+    def step(self):
+        state = self.conn.poll()
+        if self.conn.notifies:
+            del self.conn.notifies[:]
+            self.pending = True
+        if state == psycopg2.extensions.POLL_WRITE:
+            self.waitfor = 'w'
+        else:
+            self.waitfor = 'r'
+        if state == psycopg2.extensions.POLL_OK and self.busy:
+            self.busy = False
+            return self.curs.fetchall()
+        return None
+
+    def close(self):
+        self.conn.close()
+
+
+class follower(object):
+
+    def __init__(self, options, streams):
+        self.options = options
+        self.streams = streams
+        self.verbose = options.verbose
+        self.batch = options.poller_batch
+        self.feeds = []
+        try:
+            for label, fn in pgsyslog.dbspecs(options):
+                self.feeds.append(dbfeed(label, fn))
+        except:
+            self.close()
+            raise
+        multi = len(self.feeds) > 1
+        # Rows collapsed by pgingest.py --collapse are shown with their
+        # count, where every database has the columns
+        self.basecols = list(pgsyslog.SYSLOG_ALL_COLS)
+        if all(feed.run("SELECT 1 FROM pg_attribute WHERE attrelid = 'logs'::regclass "
+                        "AND attname = 'repeats' AND NOT attisdropped") for feed in self.feeds):
+            self.basecols += pgsyslog.SYSLOG_REPEAT_COLS
+        self.cols = self.basecols + ['m%d' % i for i in xrange(len(streams))]
+        for s in streams:
+            s.open(self.cols, multi)
+        self.statement, self.sqla = self.mkstatement()
+
+    def mkstatement(self):
+        """The query for new records, with a column for each stream
+        saying whether the record matches its filter"""
+        conds = [s.filter.condition() for s in self.streams]
+        sqla = {}
+        for s in self.streams:
+            sqla.update(s.filter.sqla)
+        cols = self.basecols + ['(%s) AS m%d' % (x, i) for i, x in enumerate(conds)]
+        statement = 'SELECT %s FROM logs WHERE seq > %%(mseq)s AND (%s) ORDER BY seq LIMIT %d' % (
+            ', '.join(cols), ' OR '.join(conds), self.batch)
+        return statement, sqla
+
+    def vlogsql(self, statement, sqla):
+        if self.verbose:
+            print >> sys.stderr, '=' * 40
+            print >> sys.stderr, 'ARG: %r' % sqla
+            print >> sys.stderr, 'SQL: %s' % statement
+            print >> sys.stderr, '=' * 40
+
+    def setup(self, feed):
+        """Listen for inserts, and print each stream's last few records"""
+        notify = self.options.poller_notify
+        if notify is not False:
+            rows = feed.run("SELECT 1 FROM pg_trigger WHERE tgrelid = 'logs'::regclass "
+                            "AND tgname = %s AND NOT tgisinternal", (pgsyslog.NOTIFY_TRIGGER,))
+            if rows:
+                feed.run('LISTEN %s' % pgsyslog.NOTIFY_CHANNEL)
+                feed.listening = True
+            elif notify:
+                print >> sys.stderr, 'WARNING: [%s] no %s trigger, polling every %.3f s' % (
+                    feed.label, pgsyslog.NOTIFY_TRIGGER, self.options.poller_interval)
+        feed.maxseq = feed.run('SELECT coalesce(max(seq), 0) FROM logs')[0][0]
+        feed.statement = self.statement
+        if self.options.prepare is not False:
+            feed.statement = self.prepare(feed)
+        if not self.options.initial:
+            return
+        for s in self.streams:
+            statement = s.filter.mkstmt(
+                self.basecols, 'seq <= %(mseq)s',
+                ['ORDER BY stamp DESC', 'LIMIT %d' % self.options.initial])
+            statement = 'SELECT * FROM (%s) AS x ORDER BY x.stamp' % statement
+            sqla = dict(s.filter.sqla, mseq=feed.maxseq)
+            self.vlogsql(statement, sqla)
+            s.printer.precs((feed, rec) for rec in feed.run(statement, sqla))
+
+    def prepare(self, feed):
+        """Have feed's server plan the query for new records once"""
+        text, params = pgsyslog.preparedtext(self.statement)
+        statement = 'PREPARE %s AS %s' % (PREPARED_NAME, text)
+        self.vlogsql(statement, None)
+        try:
+            feed.run(statement)
+        except psycopg2.Error, e:
+            print >> sys.stderr, 'WARNING: [%s] cannot prepare, executing as is: %s' % (
+                feed.label, str(e).strip())
+            return self.statement
+        return 'EXECUTE %s (%s)' % (PREPARED_NAME, ', '.join('%%(%s)s' % x for x in params))
+
+    def dispatch(self, feed, rows):
+        if rows is None:
+            return
+        if len(rows) >= self.batch:
+            feed.pending = True
+        if not rows:
+            return
+        feed.maxseq = rows[-1].seq
+        base = len(self.basecols)
+        for i, s in enumerate(self.streams):
+            recs = [rec for rec in rows if rec[base + i]]
+            if recs:
+                s.printer.precs((feed, rec) for rec in recs)
+
+    def run(self):
+        for feed in self.feeds:
+            self.setup(feed)
+        while True:
+            t = time.time()
+            for feed in self.feeds:
+                if not feed.busy and (feed.pending or t >= feed.nextpoll):
+                    feed.pending = False
+                    if feed.listening:
+                        feed.nextpoll = t + self.options.poller_notify_timeout
+                    else:
+                        feed.nextpoll = t + self.options.poller_interval
+                    sqla = dict(self.sqla, mseq=feed.maxseq)
+                    self.vlogsql(feed.statement, sqla)
+                    self.dispatch(feed, feed.start(feed.statement, sqla))
+            idle = [feed.nextpoll for feed in self.feeds if not feed.busy]
+            timeout = max(0, min(idle) - time.time()) if idle else None
+            r, w, x = select.select([f for f in self.feeds if f.waitfor == 'r'],
+                                    [f for f in self.feeds if f.waitfor == 'w'], [], timeout)
+            for feed in r + w:
+                self.dispatch(feed, feed.step())
+            nw = pgsyslog.now()
+            for s in self.streams:
+                s.printer.expire(nw)
+
+    def close(self):
+        for s in self.streams:
+            s.close()
+        for feed in self.feeds:
+            feed.close()
+        self.feeds = []
+
+
+def wait(conn):
+    """Block until the asynchronous operation on conn is done"""
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            select.select([conn], [], [])
+        elif state == psycopg2.extensions.POLL_WRITE:
+            select.select([], [conn], [])
+        else:
+            raise psycopg2.OperationalError, 'unexpected poll state %r' % state
+
+def streamparser(output):
+    """pgsyslog.py's options, erroring out as this stream's"""
+    parser = pgsyslog.optparseconfig()
+    def error(msg):
+        raise pgsyslog.ApplicationError, 'stream %s: %s' % (output, msg)
+    parser.error = error
+    return parser
+
+def readstreams(fn):
+    with open(fn) as f:
+        return [x.strip() for x in f if x.strip() and not x.lstrip().startswith('#')]
+
+def optparseconfig():
+    parser = optparse.OptionParser('usage: %prog [options]', version=__version__)
+    parser.add_option('-d', '--dbconnfile', action='append', metavar='[LABEL=]FILE',
+                      help='Database to follow (may be repeated; default SYSLOG_PGDB)')
+    parser.add_option('', '--stream', action='append', default=[], metavar="'OUTPUT ARGS'",
+                      help='Write records matching pgsyslog.py options ARGS to OUTPUT '
+                      '(- for stdout; may be repeated)')
+    parser.add_option('-f', '--streams', action='append', default=[], metavar='FILE',
+                      help='Read streams from FILE, one OUTPUT ARGS line each')
+    parser.add_option('-n', '--initial', type='int', default=DEFAULT_INITIAL, metavar='N',
+                      help='Start each stream with its last N records (default: %default)')
+    parser.add_option('--poll-interval', dest='poller_interval', type='float', default=0.5,
+                      help='Polling interval without LISTEN/NOTIFY (default: %default)')
+    pgsyslog.addboolopt(parser, 'notify', dest='poller_notify',
+                        help='LISTEN/NOTIFY driven polling (default: if the trigger is installed)')
+    parser.add_option('--notify-timeout', dest='poller_notify_timeout', type='float', default=30,
+                      help='With LISTEN, query anyway after this many seconds (default: %default)')
+    parser.add_option('--catchup-batch', dest='poller_batch', type='int',
+                      default=pgsyslog.DEFAULT_CATCHUP_BATCH,
+                      help='Records fetched per query (default: %default)')
+    pgsyslog.addboolopt(parser, 'prepare',
+                        help='preparing the query for new records, so it is planned once '
+                             'per database (default: on)')
+    parser.add_option('--sql-verbose', dest='verbose', action='store_true',
+                      help='Print details about SQL queries')
+    return parser
+
+def main():
+    parser = optparseconfig()
+    options, args = parser.parse_args()
+    if args:
+        parser.error('no arguments expected; give streams with --stream')
+    if options.poller_batch < 1:
+        parser.error('--catchup-batch must be positive')
+    f = None
+    try:
+        specs = list(options.stream)
+        for fn in options.streams:
+            specs.extend(readstreams(fn))
+        if not specs:
+            parser.error('at least one --stream is required')
+        streams = [stream(i, x) for i, x in enumerate(specs)]
+        f = follower(options, streams)
+        f.run()
+    except (EnvironmentError, psycopg2.Error), e:
+        parser.error(str(e).strip())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if f is not None:
+            f.close()
+
+if __name__ == '__main__':
+    main()
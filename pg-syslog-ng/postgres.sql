@@ -1,3 +1,5 @@
+-- Version 1 of the schema; pgmigrate.py migrate brings it up to date.
+
 CREATE TABLE logs (
    seq serial not null,
    stamp timestamp not null default current_timestamp,
@@ -11,20 +13,107 @@ CREATE TABLE logs (
    time time default NULL,
    program varchar default NULL,
    msg text,
+   -- Set on the row pgingest.py --collapse writes for the copies of a
+   -- repeated message: how many, and when the first and last arrived.
+   -- To add to an existing table:
+   --   ALTER TABLE logs ADD repeats integer, ADD repeat_first timestamp,
+   --       ADD repeat_last timestamp;
+   repeats integer default NULL,
+   repeat_first timestamp default NULL,
+   repeat_last timestamp default NULL,
    PRIMARY KEY (seq)
 );
 
 CREATE INDEX logs_stamp_ix ON logs USING btree (stamp);
 
+-- Wakes up pgsyslog.py -P followers (LISTEN logs_insert) once per
+-- inserting statement instead of having them poll.
+CREATE FUNCTION logs_notify() RETURNS trigger AS $$
+BEGIN
+    NOTIFY logs_insert;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER logs_notify AFTER INSERT ON logs
+    FOR EACH STATEMENT EXECUTE PROCEDURE logs_notify();
+
+-- Per-minute counts for pgsyslog.py --view, --hosts and --hstats,
+-- maintained once per inserting statement (PostgreSQL 10+). The primary
+-- key cannot hold NULL, so NULL columns are rolled up as '' with their
+-- bit set in nulls (host 1, facility 2, priority 4, program 8), and
+-- pgsyslog.py reads them back as NULL; '' stays ''. Rows already in
+-- logs are not rolled up; pgsyslog.py reads them raw until backfilled,
+-- e.g. before creating the trigger, in the same transaction:
+--   LOCK TABLE logs IN SHARE MODE;
+--   INSERT INTO logs_rollup (bucket, host, facility, priority, program,
+--           nulls, n, first, last)
+--       SELECT date_trunc('minute', stamp), coalesce(host, ''),
+--           coalesce(facility, ''), coalesce(priority, ''),
+--           coalesce(program, ''), (host IS NULL)::int
+--           + 2 * (facility IS NULL)::int + 4 * (priority IS NULL)::int
+--           + 8 * (program IS NULL)::int, count(*), min(stamp), max(stamp)
+--       FROM logs GROUP BY 1, 2, 3, 4, 5, 6;
+-- To add nulls to an existing rollup table, in one transaction with
+-- the new logs_rollup_update() below:
+--   ALTER TABLE logs_rollup ADD nulls smallint NOT NULL DEFAULT 0,
+--       DROP CONSTRAINT logs_rollup_pkey,
+--       ADD PRIMARY KEY (bucket, host, facility, priority, program, nulls);
+-- Its NULL columns were rolled up as '' before, and stay so.
+CREATE TABLE logs_rollup (
+   bucket timestamp not null,
+   host varchar not null,
+   facility varchar not null,
+   priority varchar not null,
+   program varchar not null,
+   nulls smallint not null default 0,
+   n bigint not null,
+   first timestamp not null,
+   last timestamp not null,
+   PRIMARY KEY (bucket, host, facility, priority, program, nulls)
+);
+
+CREATE FUNCTION logs_rollup_update() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO logs_rollup AS r (bucket, host, facility, priority,
+            program, nulls, n, first, last)
+        SELECT date_trunc('minute', stamp), coalesce(host, ''),
+               coalesce(facility, ''), coalesce(priority, ''),
+               coalesce(program, ''), (host IS NULL)::int
+               + 2 * (facility IS NULL)::int + 4 * (priority IS NULL)::int
+               + 8 * (program IS NULL)::int, count(*), min(stamp), max(stamp)
+        FROM new_rows GROUP BY 1, 2, 3, 4, 5, 6 ORDER BY 1, 2, 3, 4, 5, 6
+    ON CONFLICT (bucket, host, facility, priority, program, nulls) DO UPDATE
+        SET n = r.n + EXCLUDED.n,
+            first = least(r.first, EXCLUDED.first),
+            last = greatest(r.last, EXCLUDED.last);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER logs_rollup AFTER INSERT ON logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE logs_rollup_update();
+
+-- Message search. The trigram index serves pgsyslog.py -j, --like and
+-- --similar; the full-text one serves --search (the expression must
+-- stay in sync with SEARCH_VECTOR in pgsyslog.py).
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX logs_msg_trgm_ix ON logs USING gin (msg gin_trgm_ops);
+CREATE INDEX logs_msg_fts_ix ON logs USING gin (to_tsvector('simple', msg));
+
 CREATE ROLE syslogserver LOGIN;
 ALTER ROLE syslogserver SET synchronous_commit TO off;
 GRANT INSERT ON logs TO syslogserver;
 GRANT USAGE, UPDATE ON SEQUENCE logs_seq_seq TO syslogserver;
+GRANT SELECT, INSERT, UPDATE ON logs_rollup TO syslogserver;
 
 CREATE ROLE syslogreader LOGIN;
 GRANT SELECT ON logs TO syslogreader;
+GRANT SELECT ON logs_rollup TO syslogreader;
 
 
+-- Dropped by pgmigrate.py (version 6)
 CREATE INDEX logs_stamp_msg_ix ON logs USING btree (stamp,host,msg);
 
 
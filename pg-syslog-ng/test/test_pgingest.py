@@ -0,0 +1,132 @@
+import os
+import sys
+import unittest
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+import pgingest
+
+tests = []
+
+
+def fields(msg, host='h'):
+    f = [''] * len(pgingest.INGEST_COLS)
+    f[pgingest.INGEST_COLS.index('host')] = host
+    f[pgingest.INGEST_COLS.index('msg')] = msg
+    return f
+
+def line(msg, host='h'):
+    return '\t'.join(fields(msg, host))
+
+
+class connection(object):
+
+    def rollback(self):
+        pass
+
+
+class recorder(pgingest.ingester):
+    """Keeps each batch instead of copying it into a database; a batch
+    holding a row in bad is refused"""
+
+    def __init__(self, args, bad=()):
+        options, _ = pgingest.optparseconfig().parse_args(args)
+        pgingest.ingester.__init__(self, options)
+        self.bad = bad
+        self.batches = []
+        self.warnings = []
+
+    def connect(self):
+        self.pgdb = connection()
+
+    def copy(self, rows):
+        if any(x in self.bad for x in rows):
+            raise psycopg2.DataError, 'bad row'
+        self.batches.append(rows)
+
+    def warn(self, s):
+        self.warnings.append(s)
+
+    def report(self):
+        self.stats.reset()
+
+
+class IngesterTest(unittest.TestCase):
+
+    def test_copyescape(self):
+        self.assertEqual(pgingest.copyescape('a\tb\\c\r\nd\0'), 'a\\tb\\\\c\\r\\nd')
+
+    def test_parse(self):
+        ing = recorder([])
+        self.assertEqual(ing.parse(line('a\tb')), fields('a\tb'))
+        self.assertEqual(ing.parse('h\tuser'), None)
+        ing.add('h\tuser')
+        self.assertEqual((ing.rows, ing.stats.nreject), ([], 1))
+
+    def test_copyrow(self):
+        ing = recorder([])
+        self.assertEqual(ing.copyrow(fields('x\\y')),
+                         '\t'.join(fields('x\\\\y')) + '\n')
+
+    def test_batches(self):
+        ing = recorder(['-b', '2'])
+        for msg in 'abc':
+            ing.add(line(msg))
+        self.assertEqual(ing.batches, [[ing.copyrow(fields('a')), ing.copyrow(fields('b'))]])
+        ing.flush()
+        self.assertEqual(len(ing.batches), 2)
+        self.assertEqual((ing.stats.nrows, ing.stats.nbatch), (3, 2))
+
+    def test_copyeach(self):
+        bad = recorder([]).copyrow(fields('b'))
+        ing = recorder([], bad=[bad])
+        for msg in 'abc':
+            ing.add(line(msg))
+        ing.flush()
+        # The batch is retried a row at a time, and only b is lost
+        self.assertEqual(ing.batches, [[ing.copyrow(fields('a'))], [ing.copyrow(fields('c'))]])
+        self.assertEqual(ing.stats.nreject, 1)
+
+    def test_run(self):
+        r, w = os.pipe()
+        os.write(w, '%s\n%s\n%s' % (line('a'), 'bad', line('c')))
+        os.close(w)
+        ing = recorder([])
+        try:
+            ing.run(r)
+        finally:
+            os.close(r)
+        # The last line needs no newline
+        self.assertEqual(ing.batches, [[ing.copyrow(fields('a')), ing.copyrow(fields('c'))]])
+
+tests.append(IngesterTest)
+
+
+class CollapserTest(unittest.TestCase):
+
+    def test_counts(self):
+        c = pgingest.collapser(10)
+        out = []
+        for t, msg in (0, 'x'), (1, 'x'), (2, 'y'), (4, 'x'):
+            out.extend(c.add(fields(msg), 100 + t))
+        self.assertEqual([(f[-1], n) for f, n, first, last in out], [('x', None), ('y', None)])
+        self.assertEqual(c.deadline(), 110)
+        self.assertEqual(c.expire(109), [])
+        out = c.expire(111)
+        self.assertEqual([(f[-1], n, first, last) for f, n, first, last in out],
+                         [('x', 2, 101, 104)])
+        # y had no copies
+        self.assertEqual(c.expire(), [])
+        self.assertEqual(c.deadline(), None)
+
+tests.append(CollapserTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()
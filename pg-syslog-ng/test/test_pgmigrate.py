@@ -0,0 +1,123 @@
+import StringIO
+import os
+import re
+import sys
+import unittest
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pgmigrate
+import pgsyslog
+
+tests = []
+
+
+class cursor(object):
+    """Records statements; fetches return the given results in turn"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = []
+
+    def execute(self, stmt, args=None):
+        self.statements.append(stmt)
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+def migrator(**kw):
+    m = object.__new__(pgmigrate.migrator)
+    m.table = 'logs'
+    m.schema = 'logs_schema'
+    m.verbose = False
+    m.dry_run = False
+    m.concurrently = None
+    m.force_index = False
+    m.__dict__.update(kw)
+    return m
+
+
+class MigrationsTest(unittest.TestCase):
+
+    def test_order(self):
+        versions = [v for v, name in pgmigrate.MIGRATIONS]
+        self.assertEqual(versions, range(1, len(versions) + 1))
+        for v in versions:
+            self.assert_(callable(getattr(pgmigrate.migrator, 'v%d' % v, None)), v)
+        self.failIf(hasattr(pgmigrate.migrator, 'v%d' % (len(versions) + 1)))
+
+    def test_migrate(self):
+        m = migrator()
+        # No schema table, no invalid index left over, and not partitioned
+        c = cursor(None, None, ('r',))
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            m.do_migrate(c, to=2)
+            out = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(out, '1: postgres.sql\n2: BRIN index on stamp and seq\n')
+        self.assertEqual(c.results, [])
+        inserts = [x for x in c.statements if x.startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assert_('CREATE INDEX CONCURRENTLY IF NOT EXISTS logs_stamp_seq_brin_ix ON logs '
+                     'USING brin (stamp, seq)' in c.statements, c.statements)
+
+    def test_applied(self):
+        m = migrator()
+        applied = dict((v, None) for v, name in pgmigrate.MIGRATIONS)
+        c = cursor(('r',), applied.items())
+        m.do_migrate(c)
+        self.failIf([x for x in c.statements if x.startswith(('CREATE INDEX', 'INSERT'))])
+
+    def test_partitioned(self):
+        m = migrator()
+        self.assertEqual(m.concurrent(cursor(('p',))), '')
+        self.assertEqual(m.concurrent(cursor(('r',))), ' CONCURRENTLY')
+        self.assertEqual(migrator(concurrently=False).concurrent(cursor()), '')
+
+tests.append(MigrationsTest)
+
+
+class IndexTest(unittest.TestCase):
+
+    def test_plain_stamp(self):
+        r = pgmigrate.plain_stamp_re
+        self.assert_(r.match('CREATE INDEX logs_stamp_ix ON public.logs USING btree (stamp)'))
+        self.assert_(r.match('CREATE INDEX logs_stamp_idx ON ONLY public.logs USING btree (stamp)'))
+        self.failIf(r.match('CREATE INDEX logs_stamp_cover_ix ON public.logs '
+                            'USING btree (stamp) INCLUDE (host, facility, priority, program)'))
+        self.failIf(r.match('CREATE INDEX logs_stamp_severe_ix ON public.logs '
+                            "USING btree (stamp) WHERE (priority = ANY ('{err}'::text[]))"))
+        self.failIf(r.match('CREATE UNIQUE INDEX logs_pkey ON public.logs USING btree (stamp)'))
+
+    def test_cover(self):
+        for idef in ('USING btree (stamp) INCLUDE (host, facility, priority, program)',
+                     'USING btree (stamp, host, facility, priority, program)'):
+            self.assert_(re.search(pgmigrate.COVER_INDEX, idef), idef)
+        self.failIf(re.search(pgmigrate.COVER_INDEX, 'USING btree (stamp)'))
+
+    def test_plan_checks(self):
+        values = {'host': 'web1', 'prefix': 'web'}
+        for name, args, where, clauses, want, most in pgmigrate.PLAN_CHECKS:
+            options, rest = pgsyslog.optparseconfig().parse_args(
+                ['-n', '1'] + [x % values for x in args])
+            self.assertEqual(rest, [])
+            pf = pgmigrate.planfilter(options, 'logs')
+            statement = pf.mkstmt(pgsyslog.SYSLOG_BASE_COLS + ['program'], where, clauses)
+            self.assert_(' FROM logs ' in statement, statement)
+            re.compile(want)
+
+tests.append(IndexTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,143 @@
+import datetime
+import os
+import sys
+import unittest
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pgpartman
+import pgsyslog
+
+tests = []
+
+DAY = datetime.timedelta(days=1)
+
+
+def day(n):
+    return datetime.datetime(2019, 3, 10) + n * DAY
+
+
+class cursor(object):
+    """Records statements; fetches return the given results in turn"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = []
+
+    def execute(self, stmt, args=None):
+        self.statements.append(stmt)
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+def partman(**kw):
+    pm = object.__new__(pgpartman.partman)
+    pm.table = 'logs'
+    pm.legacy = 'logs_legacy'
+    pm.default = 'logs_default'
+    pm.granularity = None
+    pm.ahead = pgpartman.DEFAULT_AHEAD
+    pm.retain = None
+    pm.detach = False
+    pm.verbose = False
+    pm.dry_run = False
+    pm.archive = None
+    pm.__dict__.update(kw)
+    return pm
+
+
+class BoundTest(unittest.TestCase):
+
+    def test_parse(self):
+        m = pgpartman.bound_re.search(
+            "FOR VALUES FROM ('2019-03-10 00:00:00') TO ('2019-03-11 00:00:00')")
+        self.assertEqual(map(pgpartman.parsebound, m.groups()), [day(0), day(1)])
+        m = pgpartman.bound_re.search("FOR VALUES FROM (MINVALUE) TO ('2019-03-10 00:00:00')")
+        self.assertEqual(pgpartman.parsebound(m.group(1)), None)
+
+    def test_literal(self):
+        t = datetime.datetime(2019, 3, 10, 13)
+        self.assertEqual(pgpartman.boundliteral(t), "'2019-03-10 13:00:00'")
+        self.assertEqual(pgpartman.parsebound(pgpartman.boundliteral(t)), t)
+
+    def test_truncstamp(self):
+        t = datetime.datetime(2019, 3, 10, 13, 14, 15, 16)
+        self.assertEqual(pgpartman.truncstamp(t, 'hourly'), datetime.datetime(2019, 3, 10, 13))
+        self.assertEqual(pgpartman.truncstamp(t, 'daily'), day(0))
+
+tests.append(BoundTest)
+
+
+class PartmanTest(unittest.TestCase):
+
+    def bounds(self, lo, hi):
+        return "FOR VALUES FROM ('%s') TO ('%s')" % (lo, hi)
+
+    def test_legacyname(self):
+        pm = partman()
+        self.assertEqual(pm.legacyname('logs_stamp_ix'), 'logs_legacy_stamp_ix')
+        self.assertEqual(pm.legacyname('stamp_ix'), 'stamp_ix_legacy')
+
+    def test_partitions(self):
+        pm = partman()
+        c = cursor([('logs_p20190311', self.bounds(day(1), day(2)), 1),
+                    ('logs_default', 'DEFAULT', 1),
+                    ('logs_legacy', "FOR VALUES FROM (MINVALUE) TO ('%s')" % day(0), 1),
+                    ('logs_p20190310', self.bounds(day(0), day(1)), 1)])
+        parts = pm.partitions(c)
+        self.assertEqual([p.name for p in parts],
+                         ['logs_legacy', 'logs_p20190310', 'logs_p20190311', 'logs_default'])
+        self.assertEqual((parts[0].lo, parts[0].hi), (None, day(0)))
+        self.assertEqual(parts[-1].boundstr(), 'DEFAULT')
+        self.assertEqual(pm.getgranularity(parts), 'daily')
+        pm.granularity = 'hourly'
+        self.assertRaises(pgsyslog.ApplicationError, pm.getgranularity, parts)
+        self.assertEqual(pm.getgranularity(parts[:1]), 'hourly')
+
+    def test_premake(self):
+        pm = partman()
+        parts = [pgpartman.partition('logs_p20190310', day(0), day(1), 1)]
+        c = cursor((day(0) + DAY / 2, day(3) + DAY / 2))
+        pm.premake(c, parts, 'daily')
+        attached = [x.split()[5] for x in c.statements if 'ATTACH' in x]
+        self.assertEqual(attached, ['logs_p20190311', 'logs_p20190312', 'logs_p20190313'])
+        self.failIf([x for x in c.statements if 'logs_default' in x])
+
+    def test_premake_default(self):
+        pm = partman()
+        parts = [pgpartman.partition('logs_default', None, None, 1, default=True)]
+        now = datetime.datetime(2019, 3, 10, 12, 10)
+        c = cursor((now, now + datetime.timedelta(minutes=30)))
+        pm.premake(c, parts, 'hourly')
+        # From the current hour, moving its rows out of the default
+        self.assertEqual(len(c.statements), 4)
+        self.assert_('logs_p2019031012' in c.statements[1])
+        self.assert_('DELETE FROM logs_default' in c.statements[2])
+
+    def test_expire(self):
+        parts = [pgpartman.partition('logs_legacy', None, day(0), 1),
+                 pgpartman.partition('logs_p20190310', day(0), day(1), 1),
+                 pgpartman.partition('logs_p20190311', day(1), day(2), 1),
+                 pgpartman.partition('logs_default', None, None, 1, default=True)]
+        pm = partman(retain='1 day')
+        c = cursor((day(1) + DAY / 2,))
+        pm.expire(c, parts)
+        self.assertEqual(c.statements[1:], ['DROP TABLE logs_legacy', 'DROP TABLE logs_p20190310'])
+        pm = partman(retain='1 day', detach=True)
+        c = cursor((day(0),))
+        pm.expire(c, parts)
+        self.assertEqual(c.statements[1:], ['ALTER TABLE logs DETACH PARTITION logs_legacy'])
+
+tests.append(PartmanTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()
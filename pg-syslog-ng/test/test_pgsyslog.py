@@ -0,0 +1,1221 @@
+import StringIO
+import cStringIO
+import datetime
+import itertools
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import weakref
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2, psycopg2.extensions
+
+import pgsyslog
+import pgsyslogbench
+
+tests = []
+
+START = datetime.datetime(2019, 3, 10, 12, 0, 0)
+
+
+def stamp(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+class source(object):
+
+    def __init__(self, label='db'):
+        self.label = label
+
+
+class filteronly(pgsyslog.syslogfilter):
+    """Just the filter pgsyslog.py builds from args, with no database"""
+
+    def __init__(self, *args):
+        options, _ = pgsyslog.optparseconfig().parse_args(list(args))
+        self.logstable = 'logs'
+        self.verbose = False
+        self.setfilter(options)
+
+
+class SearchTest(unittest.TestCase):
+
+    def test_search(self):
+        f = filteronly('--search', 'disk full')
+        k, = [x for x in f.sqla if x.endswith('_search')]
+        self.assertEqual(f.wcl[-1], "%s @@ websearch_to_tsquery('simple', %%(%s)s)" % (
+            pgsyslog.SEARCH_VECTOR, k))
+        self.assertEqual(f.sqla[k], 'disk full')
+        self.assert_(f.msgfiltered)
+        self.assert_(f.searchrank.startswith('ts_rank('))
+
+    def test_syntax(self):
+        f = filteronly('--search', 'disk full', '--search-syntax', 'phrase')
+        self.assert_("phraseto_tsquery('simple', " in f.wcl[-1])
+
+    def test_msgfiltered(self):
+        self.failIf(filteronly('-h', 'a', '-p', 'cron').msgfiltered)
+        for args in ['-j', 'x'], ['--like', '%x%'], ['--similar', 'x%']:
+            self.assert_(filteronly(*args).msgfiltered, args)
+
+    def test_index(self):
+        # The full-text index must be on the expression --search uses
+        with open(os.path.join(os.path.dirname(pgsyslog.__file__), 'postgres.sql')) as f:
+            self.assert_('USING gin (%s)' % pgsyslog.SEARCH_VECTOR in f.read())
+
+    def test_plan_index(self):
+        for line, name in (
+                ('Index Only Scan Backward using logs_stamp_ix on logs', 'logs_stamp_ix'),
+                ('  ->  Bitmap Index Scan on logs_msg_fts_ix  (cost=0.00..12.00)',
+                 'logs_msg_fts_ix')):
+            self.assertEqual(pgsyslog.plan_index_re.search(line).group(1), name)
+        self.assertEqual(pgsyslog.plan_index_re.search('Seq Scan on logs'), None)
+
+tests.append(SearchTest)
+
+
+class pagedsource(object):
+    """A syslogfilter stand-in holding the rows of one source"""
+
+    def __init__(self, recs):
+        self.recs = recs
+        self.sources = [source()]
+        self.sources[0].standby = False
+        self.sources[0].maxseq = 0
+        self.multi = False
+        self.queries = 0
+
+    def getcursor(self, src):
+        return pagedcursor()
+
+    def select2(self, curs, where, clauses, sqla, prepare):
+        self.queries += 1
+        limit = int(clauses[-1].split()[1])
+        curs.rows = [x for x in self.recs if x.seq > sqla['mseq']][:limit]
+
+    def endquery(self, src):
+        pass
+
+
+class pagedcursor(object):
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class specs(object):
+
+    def __init__(self, dbconnfile=(), archive=()):
+        self.dbconnfile = list(dbconnfile)
+        self.archive = list(archive)
+
+
+class SpecsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_pgsyslog')
+        self.env = os.environ.pop('SYSLOG_PGDB', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        os.environ.pop('SYSLOG_PGDB', None)
+        if self.env is not None:
+            os.environ['SYSLOG_PGDB'] = self.env
+
+    def test_dbspecs(self):
+        self.assertEqual(pgsyslog.dbspecs(specs(['/etc/db1.conf', 'b=/etc/db2.conf', '/x=y'])),
+                         [('db1', '/etc/db1.conf'), ('b', '/etc/db2.conf'), ('x=y', '/x=y')])
+        self.assertRaises(EnvironmentError, pgsyslog.dbspecs, specs(['a=/x', '/y/a.conf']))
+        self.assertRaises(EnvironmentError, pgsyslog.dbspecs, specs())
+        os.environ['SYSLOG_PGDB'] = '/etc/db1.conf,,/etc/db2.conf'
+        self.assertEqual([x for x, _ in pgsyslog.dbspecs(specs())], ['db1', 'db2'])
+
+    def test_archivespecs(self):
+        d = os.path.join(self.dir, 'a')
+        os.mkdir(d)
+        self.assertEqual(pgsyslog.archivespecs(specs(), ['db']), {})
+        self.assertEqual(pgsyslog.archivespecs(specs(archive=[d]), ['db'])['db'].path, d)
+        self.assertEqual(pgsyslog.archivespecs(specs(archive=['b=' + d]), ['a', 'b']).keys(), ['b'])
+        for archive, labels in ([d], ['a', 'b']), (['c=' + d], ['a', 'b']), \
+                ([os.path.join(self.dir, 'none')], ['db']):
+            self.assertRaises(EnvironmentError, pgsyslog.archivespecs,
+                              specs(archive=archive), labels)
+
+tests.append(SpecsTest)
+
+
+class connection(object):
+
+    def rollback(self):
+        pass
+
+    def cancel(self):
+        pass
+
+
+class dbstub(source):
+
+    def __init__(self, label, stamps, fail=False):
+        source.__init__(self, label)
+        self.stamps = stamps
+        self.fail = fail
+        self.pgdb = connection()
+        self.archived = False
+
+    def ensure(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MergeTest(unittest.TestCase):
+
+    rowtype = pgsyslog.rowtype(['stamp', 'msg'])
+
+    def setUp(self):
+        self.warnings = []
+        self.slf = None
+
+    def tearDown(self):
+        if self.slf is not None:
+            self.slf.shutdown()
+
+    def syslogfilter(self, *sources):
+        slf = self.slf = object.__new__(pgsyslog.syslogfilter)
+        slf.sources = list(sources)
+        slf.multi = True
+        slf.merges = weakref.WeakSet()
+        slf.threadpool = None
+        slf.logprinter = slf.profile = None
+        slf.warn = self.warnings.append
+        return slf
+
+    def recs(self, src):
+        for i, t in enumerate(src.stamps):
+            if src.fail and i == len(src.stamps) // 2:
+                raise psycopg2.OperationalError, 'connection lost'
+            yield self.rowtype((stamp(t), '%s%d' % (src.label, i)))
+
+    def test_merge(self):
+        slf = self.syslogfilter(dbstub('a', [0, 2, 2, 5]), dbstub('b', [1, 2, 3]))
+        got = [(src.label, rec.msg) for src, rec in slf.stream(self.recs, pgsyslog.stampkey)]
+        # Equal stamps in source order
+        self.assertEqual([x for _, x in got], ['a0', 'b0', 'a1', 'a2', 'b1', 'b2', 'a3'])
+        self.assertEqual([x for x, _ in got][:2], ['a', 'b'])
+
+    def test_concatenate(self):
+        slf = self.syslogfilter(dbstub('a', [5, 6]), dbstub('b', [1]))
+        self.assertEqual([rec.msg for src, rec in slf.stream(self.recs)], ['a0', 'a1', 'b0'])
+
+    def test_failed(self):
+        slf = self.syslogfilter(dbstub('a', range(10), fail=True), dbstub('b', [3, 7]))
+        got = [rec.msg for src, rec in slf.stream(self.recs, pgsyslog.stampkey)]
+        self.assertEqual(got, ['a0', 'a1', 'a2', 'a3', 'b0', 'a4', 'b1'])
+        self.assertEqual(self.warnings, ['[a] skipped: connection lost'])
+
+    def test_close(self):
+        n = pgsyslog.STREAM_PAGE * (pgsyslog.STREAM_QUEUE_PAGES + 2)
+        slf = self.syslogfilter(dbstub('a', range(n)), dbstub('b', range(n)))
+        before = threading.active_count()
+        merged = slf.stream(self.recs, pgsyslog.stampkey)
+        self.assertEqual(len(list(itertools.islice(merged, 3))), 3)
+        # Both readers are blocked on a full queue until closed
+        self.assertEqual(threading.active_count(), before + 2)
+        merged.close()
+        self.assertEqual(threading.active_count(), before)
+        del merged
+        self.assertEqual(list(slf.merges), [])
+
+    def test_fanout(self):
+        slf = self.syslogfilter(dbstub('a', [1]), dbstub('b', [2], fail=True), dbstub('c', [3]))
+        got = slf.fanout(lambda src: [rec.msg for rec in self.recs(src)])
+        self.assertEqual([(src.label, x) for src, x in got], [('a', ['a0']), ('c', ['c0'])])
+        self.assertEqual(self.warnings, ['[b] skipped: connection lost'])
+
+tests.append(MergeTest)
+
+
+class PollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_pgsyslog')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def poller(self, nrecs, *args):
+        rt = pgsyslog.rowtype(['seq', 'stamp'])
+        slf = pagedsource([rt((i, stamp(i))) for i in xrange(1, nrecs + 1)])
+        options, _ = pgsyslog.optparseconfig().parse_args(list(args))
+        return pgsyslog.poller(slf, options)
+
+    def test_pages(self):
+        for nrecs, queries in (7, 3), (6, 3), (0, 1):
+            p = self.poller(nrecs, '--catchup-batch', '3')
+            recs = list(p.pages(p.slf.sources[0]))
+            self.assertEqual([x.seq for x in recs], range(1, nrecs + 1))
+            self.assertEqual(p.slf.queries, queries)
+            self.assertEqual(p.newest, stamp(nrecs) if nrecs else None)
+
+    def test_resume(self):
+        p = self.poller(7, '--catchup-batch', '3')
+        src = p.slf.sources[0]
+        src.maxseq = 5
+        self.assertEqual([x.seq for x in p.pages(src)], [6, 7])
+
+    def test_state(self):
+        fn = os.path.join(self.dir, 'state')
+        self.assertEqual(pgsyslog.loadstate(fn), None)
+        p = self.poller(0, '--poll-state', fn)
+        p.slf.sources[0].maxseq = 42
+        p.savestate()
+        self.assertEqual(pgsyslog.loadstate(fn), {'seq': {'db': 42}})
+        self.assertEqual(os.listdir(self.dir), ['state'])
+        # Only written when it changes
+        os.unlink(fn)
+        p.savestate()
+        self.failIf(os.path.exists(fn))
+
+tests.append(PollerTest)
+
+
+class RecFormatterTest(unittest.TestCase):
+
+    def options(self, **kw):
+        options = pgsyslog.optparseconfig().get_default_values()
+        for k, v in kw.iteritems():
+            setattr(options, k, v)
+        return options
+
+    def check(self, options):
+        rows = pgsyslogbench.synthrows(200, nhosts=5)
+        recs = pgsyslogbench.records(rows)
+        f = pgsyslog.recformatter(options, pgsyslogbench.BENCH_COLS)
+        got = ''.join(map(f.format, recs))
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            for t in rows:
+                pgsyslogbench.legacy_prec(options, dict(zip(pgsyslogbench.BENCH_COLS, t)))
+            want = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(got.splitlines(), want.splitlines())
+
+    def test_brief(self):
+        self.check(self.options())
+
+    def test_priority(self):
+        self.check(self.options(print_priority=True))
+
+    def test_full(self):
+        self.check(self.options(print_full=True))
+
+    def test_no_hostname(self):
+        self.check(self.options(no_hostname=True))
+
+    def test_stampcache(self):
+        f = pgsyslog.recformatter(self.options(), pgsyslogbench.BENCH_COLS)
+        size = pgsyslog.STAMP_CACHE_SIZE
+        pgsyslog.STAMP_CACHE_SIZE = 2
+        try:
+            ts = [stamp(i) for i in 0, 0, 1, 2]
+            got = [f.stamp(t.date(), t.time()) for t in ts]
+        finally:
+            pgsyslog.STAMP_CACHE_SIZE = size
+        self.assertEqual([x[1] for x in got], ts)
+        self.assert_(got[0] is got[1])
+        # Cleared when full rather than grown
+        self.assertEqual(f.stampcache.values(), [got[3]])
+
+    def test_repeats(self):
+        cols = pgsyslogbench.BENCH_COLS + pgsyslog.SYSLOG_REPEAT_COLS
+        f = pgsyslog.recformatter(self.options(), cols)
+        row = pgsyslogbench.synthrows(1)[0]
+        self.assertEqual(f.format(row + (None, None, None)).split(': ', 1)[1],
+                         row[5] + '\n')
+        self.assertEqual(f.format(row + (3, row[1], row[1])).split(': ', 1)[1],
+                         pgsyslog.REPEAT_FORMAT % (3, row[5]) + '\n')
+
+tests.append(RecFormatterTest)
+
+
+class listcursor(psycopg2.extensions.cursor):
+    """Serves a query's rows from a list, with no connection"""
+
+    def __init__(self, results):
+        self.results = results
+
+    @property
+    def description(self):
+        return [(x,) for x in self.cols]
+
+    def execute(self, query, vars=None):
+        self.cols, rows = self.results[query]
+        self.pending = list(rows)
+
+    def fetchone(self):
+        return self.pending.pop(0) if self.pending else None
+
+    def fetchmany(self, size=2):
+        r, self.pending = self.pending[:size], self.pending[size:]
+        return r
+
+    def fetchall(self):
+        r, self.pending = self.pending, []
+        return r
+
+
+class listrecordcursor(pgsyslog.recordcursor, listcursor):
+    pass
+
+
+class RowTypeTest(unittest.TestCase):
+
+    def test_rowtype(self):
+        rt = pgsyslog.rowtype(['seq', 'host', 'index'])
+        self.assert_(pgsyslog.rowtype(('seq', 'host', 'index')) is rt)
+        self.failIf(pgsyslog.rowtype(['host', 'seq']) is rt)
+        rec = rt((1, 'h', 'x'))
+        self.assertEqual((rec.seq, rec.host, rec[0], rec[-1]), (1, 'h', 1, 'x'))
+        self.assertEqual(rec, (1, 'h', 'x'))
+        self.assertEqual(rt.cols, ('seq', 'host', 'index'))
+        # Columns win over tuple's own attributes; nothing per record
+        self.assertEqual(rec.index, 'x')
+        self.failIf(hasattr(rec, '__dict__'))
+        self.assertRaises(AttributeError, setattr, rec, 'host', 'g')
+
+    def test_cursor(self):
+        c = listrecordcursor({
+            'a': (['seq', 'host'], [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')]),
+            'b': (['msg'], [('m',)]),
+        })
+        c.execute('a')
+        rec = c.fetchone()
+        self.assertEqual((rec.seq, rec.host), (1, 'a'))
+        self.assertEqual([x.host for x in c.fetchmany()], ['b', 'c'])
+        self.assertEqual([x.seq for x in c.fetchall()], [4])
+        self.assertEqual(c.fetchone(), None)
+        self.assert_(type(rec) is pgsyslog.rowtype(['seq', 'host']))
+        # A new statement, a new record type
+        c.execute('b')
+        self.assertEqual([x.msg for x in c.fetchall()], ['m'])
+
+tests.append(RowTypeTest)
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    def stream(self, n=20000, keys=200, seed=0):
+        """A few common keys over a long uniform tail"""
+        rnd = random.Random(seed)
+        return [rnd.randrange(keys) if rnd.random() < .3 else
+                min(int(rnd.expovariate(.05)), keys - 1) for i in xrange(n)]
+
+    def test_bounds(self):
+        items = self.stream()
+        k = 20
+        ss = pgsyslog.spacesaving(k)
+        exact = {}
+        for x in items:
+            ss.add(x)
+            exact[x] = exact.get(x, 0) + 1
+        n = len(items)
+        self.assertEqual(ss.n, n)
+        self.assert_(len(ss) <= k)
+        for key, c, err in ss.top(k):
+            self.assert_(err <= n / float(k))
+            self.assert_(exact[key] <= c <= exact[key] + err, (key, exact[key], c, err))
+        # Anything more frequent than n/k is kept
+        for key, c in exact.iteritems():
+            if c > n / float(k):
+                self.assert_(key in ss.counts, key)
+
+    def test_top_order(self):
+        ss = pgsyslog.spacesaving(10)
+        for key, c in ('a', 5), ('b', 3), ('c', 9):
+            ss.add(key, c)
+        self.assertEqual(ss.top(2), [('c', 9, 0), ('a', 5, 0)])
+
+    def test_load(self):
+        ss = pgsyslog.spacesaving(2)
+        ss.load({'a': 10, 'b': 7, 'c': 1}, 18)
+        self.assertEqual(ss.n, 18)
+        self.assertEqual(ss.top(5), [('a', 10, 0), ('b', 7, 0)])
+
+    def test_update(self):
+        a, b = pgsyslog.spacesaving(5), pgsyslog.spacesaving(5)
+        for x in 'aaabbc':
+            a.add(x)
+        for x in 'aadd':
+            b.add(x)
+        a.update(b)
+        self.assertEqual(a.n, 10)
+        self.assertEqual(a.top(1), [('a', 5, 0)])
+
+tests.append(SpaceSavingTest)
+
+
+class StatWindowTest(unittest.TestCase):
+
+    def test_summary(self):
+        w = pgsyslog.statwindow(60, 10, 1)
+        w.enter(0, ['a'])
+        w.enter(35, ['b'])
+        w.enter(38, ['b'])
+        nrec, tabs, delays = w.summary(40)
+        self.assertEqual(nrec, 3)
+        self.assertEqual(tabs[0].top(2), [('b', 2, 0), ('a', 1, 0)])
+        # Only the slots overlapping the last minute
+        nrec, tabs, delays = w.summary(95)
+        self.assertEqual((nrec, tabs[0].top(2)), (2, [('b', 2, 0)]))
+
+    def test_expire(self):
+        w = pgsyslog.statwindow(60, 10, 1)
+        w.enter(0, ['a'])
+        w.enter(35, ['b'])
+        w.enter(100, ['c'])
+        self.assertEqual(sorted(w.slots), [10])
+        # Too late for the window
+        w.enter(30, ['d'])
+        self.assertEqual(sorted(w.slots), [10])
+        # Late, but inside it
+        w.enter(55, ['e'], .5)
+        nrec, tabs, delays = w.summary(100)
+        self.assertEqual((nrec, delays.n), (2, 1))
+
+tests.append(StatWindowTest)
+
+
+class ServerStatsTest(unittest.TestCase):
+
+    def test_grouping(self):
+        # GROUPING(host, facility, priority, program) has a bit set for
+        # each column not grouped by, host's the highest
+        rows = {
+            'a': [('a', None, None, None, 3, stamp(20), 7),
+                  (None, None, None, None, 2, stamp(10), 7),
+                  (None, 'user', None, None, 5, stamp(10), 11),
+                  (None, None, 'err', None, 5, stamp(10), 13),
+                  (None, None, None, 'cron', 4, stamp(10), 14),
+                  (None, None, None, None, 1, stamp(10), 14),
+                  (None, None, None, None, 5, stamp(10), 15)],
+            'b': [('a', None, None, None, 1, stamp(5), 7),
+                  (None, None, None, 'cron', 1, stamp(5), 14),
+                  (None, None, None, None, 1, stamp(5), 15)],
+        }
+        statements = []
+        def query(src, statement):
+            statements.append(statement)
+            return rows[src.label]
+        slf = object.__new__(pgsyslog.syslogfilter)
+        slf.logstable = 'logs'
+        slf.wcl = []
+        slf.query = query
+        slf.fanout = lambda fn: [(src, fn(src)) for src in source('a'), source('b')]
+        stats = slf.serverstats()
+        self.assert_(statements[0].endswith(
+            'GROUP BY GROUPING SETS ((host), (facility), (priority), (program), ())'))
+        self.assertEqual((stats.nrec, stats.firststamp), (6, stamp(5)))
+        top = [tab.top(3) for tab in stats.tabs]
+        # A NULL value grouped by is counted, as the NULLs of the
+        # columns not grouped by are not
+        self.assertEqual(top[0], [('a', 4, 0), (None, 2, 0)])
+        self.assertEqual(top[1], [('user', 5, 0)])
+        self.assertEqual(top[2], [('err', 5, 0)])
+        self.assertEqual(top[3], [('cron', 5, 0), (None, 1, 0)])
+
+tests.append(ServerStatsTest)
+
+
+class sealcursor(object):
+
+    def __init__(self, row):
+        self.row = row
+        self.executed = []
+
+    def execute(self, stmt, args):
+        self.executed.append((stmt, args))
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+class sealconnection(object):
+
+    def __init__(self, row):
+        self.c = sealcursor(row)
+
+    def cursor(self):
+        return self.c
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        cache = pgsyslog.resultcache(os.path.join(self.dir, 'cache'), 1 << 20)
+        key = cache.key('dsn', 'SELECT 1', '()')
+        self.assertEqual(key, cache.key('dsn', 'SELECT 1', '()'))
+        self.assertNotEqual(key, cache.key('dsn', 'SELECT 2', '()'))
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, ['host', 'n'], [('a', 1), ('b', 2)])
+        rows = cache.get(key)
+        self.assertEqual(rows, [('a', 1), ('b', 2)])
+        self.assertEqual([x.host for x in rows], ['a', 'b'])
+        # A damaged entry is a miss
+        with open(cache.filename(key), 'wb') as f:
+            f.write('junk')
+        self.assertEqual(cache.get(key), None)
+
+    def test_evict(self):
+        r = random.Random(0)
+        rows = [(r.random(),) for i in range(50)]
+        cache = pgsyslog.resultcache(self.dir, 1 << 20)
+        cache.put('a', ['x'], rows[:10])
+        size = os.path.getsize(cache.filename('a'))
+        cache.maxbytes = size * 9 // 2
+        # Over a quarter of maxbytes is not kept
+        cache.put('big', ['x'], rows)
+        self.assertEqual(cache.get('big'), None)
+        for i, key in enumerate('abcd'):
+            if key != 'a':
+                cache.put(key, ['x'], rows[i * 10:i * 10 + 10])
+            os.utime(cache.filename(key), (i, i))
+        # Read, so no longer the least recently used
+        self.assert_(cache.get('a'))
+        cache.put('e', ['x'], rows[40:])
+        self.assertEqual(sorted(os.listdir(self.dir)), ['a.z', 'c.z', 'd.z', 'e.z'])
+
+    def test_sealedrange(self):
+        f = filteronly('-B', '2019-03-10', '-E', '2019-03-11')
+        src = source()
+        src.sealed = None
+        src.pgdb = sealconnection((START, START + datetime.timedelta(days=1), True))
+        self.assertEqual(f.sealedrange(src), (START, START + datetime.timedelta(days=1)))
+        stmt, args = src.pgdb.c.executed[0]
+        self.assertEqual(args['sealdelay'], pgsyslog.CACHE_SEAL_DELAY)
+        self.assertEqual(args['enddate'], '2019-03-11')
+        # Asked once per source
+        f.sealedrange(src)
+        self.assertEqual(len(src.pgdb.c.executed), 1)
+        src = source()
+        src.sealed = None
+        src.pgdb = sealconnection((START, START, False))
+        self.assertEqual(f.sealedrange(src), None)
+        # No end date, never sealed, and no query
+        src = source()
+        src.sealed = None
+        self.assertEqual(filteronly('-B', '2019-03-10').sealedrange(src), None)
+
+tests.append(ResultCacheTest)
+
+
+class QueryProfileTest(unittest.TestCase):
+
+    def test_counts(self):
+        prof = pgsyslog.queryprofile()
+        entry = prof.executed('SELECT\n  1', 0.5)
+        prof.fetched(entry, 0.25, [('abc', None, 12), (u'd\xe9', 1, 2)])
+        self.assertEqual(entry, [1, 0.5, 0.25, 2, 9, 0.5])
+        self.assert_(prof.executed('SELECT\n  1', 1.5) is entry)
+        self.assertEqual((entry[0], entry[1], entry[5]), (2, 2.0, 1.5))
+        prof.executed('SELECT 2', 0.125)
+        lines = prof.report().splitlines()
+        # Slowest first, with per-call times only when repeated
+        self.assertEqual(lines[2].split(), ['2', '2.000', '0.250', '2', '9',
+                                            '1000.000', '1500.000', 'SELECT', '1'])
+        self.assertEqual(lines[3].split(), ['1', '0.125', '0.000', '0', '0', 'SELECT', '2'])
+        self.assertEqual(lines[4].split(), ['3', '2.125', '0.250', '2', '9', '(total)'])
+
+tests.append(QueryProfileTest)
+
+
+class DelayHistogramTest(unittest.TestCase):
+
+    width = 2 ** (1. / pgsyslog.DELAY_BUCKETS_PER_OCTAVE)
+
+    def test_empty(self):
+        h = pgsyslog.delayhistogram()
+        self.assertEqual(h.percentile(.5), None)
+        self.assertEqual(h.metrics(), {'n': 0, 'p50': None, 'p99': None, 'max': None})
+
+    def test_resolution(self):
+        h = pgsyslog.delayhistogram()
+        for d in 0, -1, pgsyslog.DELAY_RESOLUTION / 2, pgsyslog.DELAY_RESOLUTION:
+            h.add(d)
+        self.assertEqual(h.counts, {0: 4})
+
+    def test_buckets(self):
+        h = pgsyslog.delayhistogram()
+        h.add(pgsyslog.DELAY_RESOLUTION * 1.01)
+        h.add(pgsyslog.DELAY_RESOLUTION * 4.01)
+        # Two octaves apart
+        self.assertEqual(sorted(h.counts),
+                         [1, 2 * pgsyslog.DELAY_BUCKETS_PER_OCTAVE + 1])
+
+    def test_percentiles(self):
+        rnd = random.Random(1)
+        ds = sorted(rnd.expovariate(10) for i in xrange(10000))
+        h = pgsyslog.delayhistogram()
+        map(h.add, ds)
+        self.assertEqual(h.n, len(ds))
+        self.assertEqual(h.max, ds[-1])
+        self.assertEqual(h.percentile(1), ds[-1])
+        for p in .5, .9, .99:
+            exact = ds[int(p * len(ds)) - 1]
+            got = h.percentile(p)
+            # The upper bound of the quantile's bucket
+            self.assert_(exact <= got + 1e-6, (p, exact, got))
+            self.assert_(got <= exact * self.width + 1e-6, (p, exact, got))
+
+    def test_update(self):
+        a, b = pgsyslog.delayhistogram(), pgsyslog.delayhistogram()
+        a.add(.5)
+        b.add(2)
+        b.add(.5)
+        a.update(b)
+        self.assertEqual(a.n, 3)
+        self.assertEqual(a.max, 2)
+        self.assertEqual(sum(a.counts.values()), 3)
+
+tests.append(DelayHistogramTest)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    cols = ['seq', 'stamp', 'date', 'time', 'host', 'msg']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_pgsyslog')
+        self.group_rows = pgsyslog.ARCHIVE_GROUP_ROWS
+        # Several groups out of a few rows
+        pgsyslog.ARCHIVE_GROUP_ROWS = 4
+
+    def tearDown(self):
+        pgsyslog.ARCHIVE_GROUP_ROWS = self.group_rows
+        shutil.rmtree(self.dir)
+
+    def rows(self, n, offset=0):
+        r = []
+        for i in xrange(n):
+            t = stamp(offset + i)
+            r.append((i + 1, t, t.date(), t.time(), ('a', 'b', None)[i % 3],
+                      'msg\t%d\n\\' % i))
+        return r
+
+    def scanall(self, arch, name, *args):
+        r = []
+        for cols, rows in arch.scan(name, *args):
+            self.assertEqual(cols, self.cols)
+            r.extend(rows)
+        return r
+
+    def test_roundtrip(self):
+        arch = pgsyslog.logarchive(self.dir)
+        rows = self.rows(10)
+        self.assertEqual(arch.write('logs_p1.pga', self.cols, rows), 10)
+        self.assertEqual(self.scanall(arch, 'logs_p1.pga'), rows)
+        # The index is saved with the file
+        arch = pgsyslog.logarchive(self.dir)
+        self.assertEqual(arch.index['logs_p1.pga']['hosts'], ['a', 'b'])
+        self.assertEqual(arch.index['logs_p1.pga']['rows'], 10)
+
+    def test_repeats(self):
+        arch = pgsyslog.logarchive(self.dir)
+        cols = self.cols + pgsyslog.SYSLOG_REPEAT_COLS
+        rows = [x + ((2, x[1], x[1] + datetime.timedelta(seconds=3)) if x[0] == 2 else
+                     (None, None, None)) for x in self.rows(6)]
+        arch.write('logs_p1.pga', cols, rows)
+        self.assertEqual([r for c, g in arch.scan('logs_p1.pga') for r in g], rows)
+
+    def test_empty(self):
+        arch = pgsyslog.logarchive(self.dir)
+        self.assertEqual(arch.write('logs_p1.pga', self.cols, []), 0)
+        self.assertEqual(arch.files(), [])
+        self.failIf(os.path.exists(os.path.join(self.dir, 'logs_p1.pga')))
+
+    def test_range(self):
+        arch = pgsyslog.logarchive(self.dir)
+        rows = self.rows(10)
+        arch.write('logs_p1.pga', self.cols, rows)
+        lo, hi = stamp(3), stamp(6)
+        got = self.scanall(arch, 'logs_p1.pga', lo, hi)
+        self.assertEqual(got, [x for x in rows if lo <= x[1] <= hi])
+        got = self.scanall(arch, 'logs_p1.pga', None, None, set(['b']), ())
+        self.assertEqual(got, [x for x in rows if x[4] == 'b'])
+        got = self.scanall(arch, 'logs_p1.pga', None, None, None, set(['a']))
+        self.assertEqual(got, [x for x in rows if x[4] != 'a'])
+
+    def test_files(self):
+        arch = pgsyslog.logarchive(self.dir)
+        arch.write('logs_p1.pga', self.cols, self.rows(5))
+        arch.write('logs_p2.pga', self.cols, self.rows(5, 100))
+        self.assertEqual(arch.files(), ['logs_p1.pga', 'logs_p2.pga'])
+        self.assertEqual(arch.files(stamp(50)), ['logs_p2.pga'])
+        self.assertEqual(arch.files(None, stamp(50)), ['logs_p1.pga'])
+        self.assertEqual(arch.files(hosts=['c']), [])
+        self.assertEqual(arch.files(xhosts=['a', 'b']), [])
+        self.assertEqual(arch.hosts(['?', 'c']), set(['a', 'b', 'c']))
+
+tests.append(ArchiveTest)
+
+
+class RepeatFilterTest(unittest.TestCase):
+
+    cols = ['stamp', 'host', 'program', 'msg']
+
+    def rec(self, t, msg, host='h'):
+        return (stamp(t), host, 'prog', msg)
+
+    def msgs(self, pairs):
+        return [rec[-1] for src, rec in pairs]
+
+    def test_collapse(self):
+        rf = pgsyslog.repeatfilter(self.cols, 10)
+        src = source()
+        out = []
+        for t, msg in (0, 'x'), (1, 'x'), (2, 'y'), (3, 'x'):
+            out.extend(rf.add(self.rec(t, msg), src))
+        self.assertEqual(self.msgs(out), ['x', 'y'])
+        self.assertEqual(self.msgs(rf.expire()), [pgsyslog.REPEAT_FORMAT % (2, 'x')])
+        self.assertEqual(rf.expire(), [])
+
+    def test_window(self):
+        rf = pgsyslog.repeatfilter(self.cols, 10)
+        src = source()
+        out = rf.add(self.rec(0, 'x'), src) + rf.add(self.rec(5, 'x'), src)
+        out += rf.add(self.rec(20, 'x'), src)
+        # The first run closed before the third copy, which starts another
+        self.assertEqual(self.msgs(out), ['x', pgsyslog.REPEAT_FORMAT % (1, 'x'), 'x'])
+        self.assertEqual(rf.expire(), [])
+
+    def test_keys(self):
+        rf = pgsyslog.repeatfilter(self.cols, 10)
+        a, b = source('a'), source('b')
+        out = rf.add(self.rec(0, 'x'), a) + rf.add(self.rec(0, 'x'), b)
+        out += rf.add(self.rec(0, 'x', 'h2'), a)
+        self.assertEqual(len(out), 3)
+
+    def test_collapsed_rows(self):
+        cols = self.cols + ['repeats']
+        rf = pgsyslog.repeatfilter(cols, 10)
+        src = source()
+        out = rf.add(self.rec(0, 'x') + (None,), src)
+        out += rf.add(self.rec(1, 'x') + (5,), src)
+        out += rf.add(self.rec(2, 'x') + (None,), src)
+        self.assertEqual(len(out), 1)
+        rec = rf.expire()[0][1]
+        # The count goes in repeats, for recformatter to show
+        self.assertEqual((rec[-2], rec[-1]), ('x', 6))
+
+tests.append(RepeatFilterTest)
+
+
+class preparecursor(object):
+    """Records statements; PREPARE fails if told to"""
+
+    def __init__(self, fail=False):
+        self.connection = connection()
+        self.fail = fail
+        self.executed = []
+
+    def execute(self, stmt, args=None):
+        self.executed.append(stmt)
+        if self.fail and stmt.startswith('PREPARE'):
+            raise psycopg2.ProgrammingError, 'could not determine data type'
+
+
+class PreparedTest(unittest.TestCase):
+
+    def test_text(self):
+        self.assertEqual(pgsyslog.preparedtext(
+            "seq > %(mseq)s AND host = %(h)s AND msg LIKE 'a%%' AND seq < %(mseq)s + 10"),
+            ("seq > $1 AND host = $2 AND msg LIKE 'a%' AND seq < $1 + 10", ['mseq', 'h']))
+        self.assertEqual(pgsyslog.preparedtext('SELECT 1'), ('SELECT 1', []))
+
+    def test_reuse(self):
+        f = filteronly()
+        f.prepared = {}
+        f.profile = None
+        src = source()
+        c = preparecursor()
+        src.pgdb = c.connection
+        f.sources = [src]
+        stmt = 'SELECT * FROM logs WHERE seq > %(mseq)s'
+        self.assertEqual(f.prepared_exec(c, stmt), 'EXECUTE pgsyslog_1 (%(mseq)s)')
+        self.assertEqual(c.executed, ['SAVEPOINT pgsyslog_prepare',
+                                      'PREPARE pgsyslog_1 AS SELECT * FROM logs WHERE seq > $1',
+                                      'RELEASE SAVEPOINT pgsyslog_prepare'])
+        self.assert_(src.prepared)
+        # Prepared once per connection
+        self.assertEqual(f.prepared_exec(c, stmt), 'EXECUTE pgsyslog_1 (%(mseq)s)')
+        self.assertEqual(len(c.executed), 3)
+        self.assertEqual(f.prepared_exec(preparecursor(), stmt), 'EXECUTE pgsyslog_2 (%(mseq)s)')
+        self.assertEqual(f.prepared_exec(c, 'SELECT 1'), 'EXECUTE pgsyslog_3')
+
+    def test_unprepared(self):
+        f = filteronly()
+        f.prepared = {}
+        f.sources = []
+        c = preparecursor(fail=True)
+        stmt = 'SELECT %(x)s'
+        self.assertEqual(f.prepared_exec(c, stmt), stmt)
+        self.assertEqual(c.executed[-1], 'ROLLBACK TO SAVEPOINT pgsyslog_prepare')
+        # Not tried again
+        self.assertEqual(f.prepared_exec(c, stmt), stmt)
+        self.assertEqual(len(c.executed), 3)
+
+tests.append(PreparedTest)
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def test_backoff(self):
+        ps = pgsyslog.pollscheduler(0.5, 3)
+        intervals = []
+        for i in xrange(5):
+            ps.polled(0)
+            intervals.append(ps.interval)
+        self.assertEqual(intervals, [1, 2, 3, 3, 3])
+        # Records bring it back
+        ps.polled(2)
+        self.assertEqual(ps.interval, 0.5)
+        self.assertEqual((ps.polls, ps.empty), (6, 5))
+        # Never below --poll-interval
+        self.assertEqual(pgsyslog.pollscheduler(2, 1).maxinterval, 2)
+
+    def test_latency(self):
+        ps = pgsyslog.pollscheduler(1, 10)
+        ps.polled(1, pgsyslog.now() - datetime.timedelta(seconds=2))
+        ps.polled(1, pgsyslog.now() + datetime.timedelta(seconds=2))
+        self.assertEqual(ps.latency.n, 2)
+        self.assert_(2 <= ps.latency.max < 3, ps.latency.max)
+        m = ps.metrics()
+        self.assertEqual((m['polls'], m['empty'], m['interval']), (2, 0, 1))
+        self.assertEqual(m['latency']['n'], 2)
+
+    def test_report(self):
+        ps = pgsyslog.pollscheduler(1, 10)
+        self.assertEqual(ps.report(),
+                         ['Polls:\t0, 0.0% empty (0 with nothing replayed), now every 1.000s'])
+        ps.polled(0)
+        ps.polled(3)
+        ps.skipped = 1
+        ps.lag = {'b': None, 'a': 0.25}
+        rs = ps.report()
+        self.assertEqual(rs[0], 'Polls:\t2, 50.0% empty (1 with nothing replayed), now every 1.000s')
+        self.assertEqual(rs[-1], 'Replay lag:\ta 0.250s  b none')
+
+tests.append(PollSchedulerTest)
+
+
+class GlobTest(unittest.TestCase):
+
+    def test_isglob(self):
+        self.assert_(pgsyslog.isglob('web*'))
+        self.assert_(pgsyslog.isglob('web?'))
+        self.failIf(pgsyslog.isglob('web_1%'))
+
+    def test_like(self):
+        self.assertEqual(pgsyslog.globlike('web*'), 'web%')
+        self.assertEqual(pgsyslog.globlike('db?.example'), 'db_.example')
+        # LIKE's own wildcards and escape are literal
+        self.assertEqual(pgsyslog.globlike('50%_off\\*'), '50\\%\\_off\\\\%')
+
+    def test_prefix(self):
+        self.assertEqual(pgsyslog.globprefix('web*.example'), 'web')
+        self.assertEqual(pgsyslog.globprefix('?eb'), '')
+        self.assertEqual(pgsyslog.globprefix('a_b%*'), 'a_b%')
+        self.assertEqual(pgsyslog.globprefix('h\xc3\xa9*'), 'h')
+
+    def test_re(self):
+        r = pgsyslog.globre('web?.ex*')
+        self.assert_(r.match('web1.example.com'))
+        self.failIf(r.match('web12.example.com'))
+        self.failIf(r.match('web1Xexample'))
+        for pattern, s in ('a%b', 'a%b'), ('a_b', 'a_b'), ('a\\b*', 'a\\bc'), ('a*', 'a\nb'):
+            self.assert_(pgsyslog.globre(pattern).match(s), pattern)
+        self.failIf(pgsyslog.globre('a_b').match('axb'))
+        self.failIf(pgsyslog.globre('a%b').match('axxb'))
+        self.failIf(pgsyslog.globre('ab').match('abc'))
+
+    def test_clause(self):
+        f = filteronly('-h', 'web*', '-h', '-db?', '-h', 'mail', '-p', 'post*')
+        # A prefix range the index can use, then LIKE for the rest
+        self.assert_('host ~>=~ %(sa3_host_from)s AND host ~<~ %(sa4_host_to)s' in f.wcl[1],
+                     f.wcl)
+        self.assertEqual(f.wcl[2], 'host NOT LIKE %(sa5_host_like)s')
+        self.assertEqual((f.sqla['sa3_host_from'], f.sqla['sa4_host_to']), ('web', 'wec'))
+        self.assertEqual((f.sqla['sa5_host_like'], f.sqla['sa1_hosts_IN']), ('db_', ['mail']))
+        self.assertEqual(f.sqla['sa8_program_to'], 'posu')
+
+tests.append(GlobTest)
+
+
+class keptoutput(StringIO.StringIO):
+    """Output whose value outlives the logprinter closing it"""
+
+    def close(self):
+        pass
+
+
+class clustertest(unittest.TestCase):
+    """Tests against a PostgreSQL cluster of their own, with the schema
+    of postgres.sql and the rows populate inserts; skipped where there
+    is no initdb (PGBIN, or on PATH)"""
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            bindir = pgsyslogbench.pgbindir(optparse.Values({'pg_bin': os.getenv('PGBIN')}))
+        except EnvironmentError, e:
+            raise unittest.SkipTest('%s (or set PGBIN)' % e)
+        cls.tmpdir = tempfile.mkdtemp(prefix='pgst')
+        cls.cluster = pgsyslogbench.pgcluster(cls.tmpdir, bindir)
+        try:
+            cls.cluster.initdb()
+            cls.cluster.start()
+            pgdb = cls.cluster.connect('postgres')
+            pgdb.autocommit = True
+            pgdb.cursor().execute('CREATE DATABASE %s' % pgsyslogbench.SUITE_DBNAME)
+            pgdb.close()
+            cls.cluster.cmd('psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1', '-d', cls.cluster.dsn(),
+                            '-f', os.path.join(os.path.dirname(pgsyslog.__file__), 'postgres.sql'))
+            pgdb = cls.cluster.connect()
+            cls.populate(pgdb.cursor())
+            pgdb.commit()
+            pgdb.close()
+            cls.dsnfile = os.path.join(cls.tmpdir, 'dsn')
+            with open(cls.dsnfile, 'w') as f:
+                f.write(cls.cluster.dsn())
+        except:
+            cls.tearDownClass()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            cls.cluster.stop()
+        finally:
+            shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    @classmethod
+    def populate(cls, c):
+        pass
+
+    def options(self, *args):
+        options, _ = pgsyslog.optparseconfig().parse_args(['-d', self.dsnfile] + list(args))
+        return options
+
+    def filter(self, *args):
+        return pgsyslog.syslogfilter(self.options(*args))
+
+    def main(self, *args):
+        """pgsyslog.py's output for args; what it printed to stderr is
+        left in self.stderr"""
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = keptoutput(), keptoutput()
+        try:
+            pgsyslog.main(['-d', self.dsnfile] + list(args))
+            return sys.stdout.getvalue()
+        finally:
+            self.stderr = sys.stderr.getvalue()
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+class RollupTest(clustertest):
+    """The rollup's answers against the raw rows'"""
+
+    @classmethod
+    def populate(cls, c):
+        # One statement a minute, as the trigger rolls up per statement
+        for m in xrange(6):
+            c.execute('INSERT INTO logs (stamp, host, facility, priority, program, msg) '
+                      'SELECT %s, h, f, p, g, %s FROM unnest(%s) AS h, unnest(%s) AS f, '
+                      'unnest(%s) AS p, unnest(%s) AS g',
+                      (stamp(60 * m + 30), 'm', ['a', '', None], ['user', None],
+                       ['err', ''], ['cron', '', None]))
+
+    def hostsummary(self, rollup, args):
+        slf = self.filter('--hosts', '--no-cache', '-B', START.strftime('%Y-%m-%d'),
+                          '--rollup' if rollup else '--no-rollup', *args)
+        try:
+            src = slf.sources[0]
+            c = slf.getcursor(src)
+            try:
+                self.assertEqual(slf.rollupbounds(src, c) is not None, rollup)
+            finally:
+                c.close()
+            return sorted(slf.hostsummary(src))
+        finally:
+            slf.shutdown()
+
+    def check(self, *args):
+        raw = self.hostsummary(False, list(args))
+        self.assert_(raw)
+        self.assertEqual(self.hostsummary(True, list(args)), raw)
+        return raw
+
+    def test_all(self):
+        self.assertEqual([x[:2] for x in self.check()], [(None, 72), ('', 72), ('a', 72)])
+
+    def test_empty_program(self):
+        # NULL <> 'cron' is not true, '' <> 'cron' is
+        self.assertEqual([x[:2] for x in self.check('-p', '-cron')],
+                         [(None, 24), ('', 24), ('a', 24)])
+
+    def test_empty_host(self):
+        self.assertEqual([x[:2] for x in self.check('-h', '-a')], [('', 72)])
+
+    def test_empty_priority(self):
+        self.assertEqual([x[:2] for x in self.check('--priority', '-err')],
+                         [(None, 36), ('', 36), ('a', 36)])
+
+tests.append(RollupTest)
+
+
+class NotifyTest(clustertest):
+
+    def insert(self):
+        pgdb = self.cluster.connect()
+        try:
+            pgdb.cursor().execute("INSERT INTO logs (host, msg) VALUES ('a', 'm')")
+            pgdb.commit()
+        finally:
+            pgdb.close()
+
+    def test_waitnotify(self):
+        slf = self.filter('-P')
+        try:
+            src = slf.sources[0]
+            self.assert_(slf.has_trigger(src, pgsyslog.NOTIFY_TRIGGER))
+            self.failIf(slf.has_trigger(src, 'no_such_trigger'))
+            slf.listen(src, pgsyslog.NOTIFY_CHANNEL)
+            self.failIf(slf.waitnotify(0))
+            self.insert()
+            self.assert_(slf.waitnotify(5))
+            # Taken, so the next wait blocks again
+            self.failIf(slf.waitnotify(0))
+        finally:
+            slf.shutdown()
+
+    def test_listen(self):
+        for args, notify in ([], True), (['--no-notify'], False):
+            options = self.options('-P', *args)
+            slf = pgsyslog.syslogfilter(options)
+            try:
+                p = pgsyslog.poller(slf, options)
+                p.listen()
+                self.assertEqual(p.notify, notify)
+                self.assertEqual(slf.sources[0].listening, notify)
+            finally:
+                slf.shutdown()
+
+tests.append(NotifyTest)
+
+
+class CursorTest(clustertest):
+
+    @classmethod
+    def populate(cls, c):
+        c.execute("INSERT INTO logs (stamp, date, time, host, program, msg) "
+                  "SELECT t, t::date, t::time, 'a', 'p', 'm' || i "
+                  "FROM generate_series(9, 0, -1) AS i, "
+                  "LATERAL (SELECT %s + i * interval '1 second' AS t) AS x", (START,))
+
+    def args(self):
+        return ('-n', '0', '--itersize', '3', '--no-cache', '-B', START.strftime('%Y-%m-%d'))
+
+    def test_named(self):
+        slf = self.filter(*self.args())
+        try:
+            src = slf.sources[0]
+            c = slf.getcursor(src, named=True)
+            self.assert_(c.name)
+            self.assertEqual(c.itersize, 3)
+            c.close()
+            slf.endquery(src)
+            statement = slf.selectstmt(clauses=['ORDER BY stamp'])
+            self.assertEqual([x.msg for x in slf.query(src, statement, named=True)],
+                             ['m%d' % i for i in xrange(10)])
+        finally:
+            slf.shutdown()
+
+    def test_tail(self):
+        out = self.main(*self.args())
+        # Every row, not --itersize of them, and in time order
+        self.assertEqual([x.rsplit(' ', 1)[-1] for x in out.splitlines()],
+                         ['m%d' % i for i in xrange(10)])
+
+tests.append(CursorTest)
+
+
+class ChangesTest(clustertest):
+
+    hours = [['a', 'b'], ['a', 'c'], ['a', 'c'], ['c']]
+
+    @classmethod
+    def populate(cls, c):
+        for i, hosts in enumerate(cls.hours):
+            for j, host in enumerate(hosts):
+                c.execute('INSERT INTO logs (stamp, host, msg) VALUES (%s, %s, %s)',
+                          (stamp(3600 * i + 60 * j), host, 'm'))
+
+    def changes(self, *args):
+        return self.main('--changes', '1', '--no-cache', '-B', START.strftime('%Y-%m-%d'),
+                         *args).splitlines()
+
+    def test_report(self):
+        # The last window's changes are held back, as it may be filling up
+        self.assertEqual(self.changes(), [
+            '<%s> Starting with 2 hosts' % pgsyslog.stampformat(START),
+            '[%s - %s]' % (pgsyslog.stampformat(stamp(3600)), pgsyslog.stampformat(stamp(7200))),
+            '- b',
+            '+ c',
+            '<%s> Ending with 1 hosts' % pgsyslog.stampformat(stamp(4 * 3600))])
+
+    def test_state(self):
+        tmpdir = tempfile.mkdtemp()
+        fn = os.path.join(tmpdir, 'changes')
+        try:
+            first = self.changes('--changes-state', fn)
+            self.assertEqual(len(first), 5)
+            state = pgsyslog.loadstate(fn)
+            self.assertEqual((state['bucket'], state['hosts']), (2, ['a', 'c']))
+            # Only the windows after the checkpoint
+            self.assertEqual(self.changes('--changes-state', fn), first[-1:])
+            # Another filter, another report
+            self.assertEqual(self.changes('--changes-state', fn, '-h', 'a'), [
+                '<%s> Starting with 1 hosts' % pgsyslog.stampformat(START),
+                '<%s> Ending with 1 hosts' % pgsyslog.stampformat(stamp(3 * 3600))])
+            self.assert_('is for a different --changes report' in self.stderr, self.stderr)
+        finally:
+            shutil.rmtree(tmpdir)
+
+tests.append(ChangesTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pgsyslog
+import pgsyslogbench
+
+tests = []
+
+
+class SuiteTest(unittest.TestCase):
+
+    def test_parsesize(self):
+        self.assertEqual(pgsyslogbench.parsesize('10M'), 10000000)
+        self.assertEqual(pgsyslogbench.parsesize('5k'), 5000)
+        self.assertEqual(pgsyslogbench.parsesize('1234'), 1234)
+        for s in '', '0', 'M', '1.5M', '-1k':
+            self.assertRaises(ValueError, pgsyslogbench.parsesize, s)
+
+    def test_timings(self):
+        ts = [.5, .1, .4, .2, .3]
+        r = pgsyslogbench.timingsummary(ts)
+        self.assertEqual(r.keys(), ['min', 'median', 'p90', 'times'])
+        self.assertEqual((r['min'], r['median'], r['p90']), (.1, .3, .5))
+        # In the order run
+        self.assertEqual(r['times'], ts)
+
+    def test_synthrows(self):
+        rows = pgsyslogbench.synthrows(100, nhosts=5)
+        self.assertEqual(rows, pgsyslogbench.synthrows(100, nhosts=5))
+        self.assertNotEqual(rows, pgsyslogbench.synthrows(100, nhosts=5, seed=1))
+        self.assertEqual(len(rows[0]), len(pgsyslogbench.BENCH_COLS))
+        # Ten a second, in order to the second
+        seconds = [x[3] for x in rows]
+        self.assertEqual(sorted(seconds), seconds)
+        self.assertEqual(len(set(seconds)), 10)
+        self.assert_(len(set(x[4] for x in rows)) <= 5)
+        rec = pgsyslogbench.records(rows)[0]
+        self.assertEqual((rec.seq, rec.host), (1, rows[0][4]))
+
+    def test_readlines(self):
+        r, w = os.pipe()
+        f = os.fdopen(r)
+        try:
+            os.write(w, 'a\nb\nready c\nrest\n')
+            pgsyslogbench.readlines(f, None, marker='ready', timeout=5)
+            # Nothing past the marker's line was read
+            self.assertEqual(os.read(r, 100), 'rest\n')
+            os.close(w)
+            self.assertRaises(EnvironmentError, pgsyslogbench.readlines, f, 1, timeout=5)
+        finally:
+            f.close()
+
+    def test_runpgsyslog(self):
+        elapsed, nlines, nbytes, status, err = pgsyslogbench.runpgsyslog(['--version'])
+        self.assertEqual((nlines, nbytes, status, err), (1, len(pgsyslog.__version__) + 1, 0, ''))
+        status, err = pgsyslogbench.runpgsyslog(['--no-such-option'])[3:]
+        self.assertEqual(status, 2)
+        self.assert_('no such option' in err, err)
+
+tests.append(SuiteTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()
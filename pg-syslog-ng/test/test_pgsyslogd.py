@@ -0,0 +1,111 @@
+import StringIO
+import optparse
+import os
+import socket
+import sys
+import threading
+import unittest
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pgsyslog
+import pgsyslogc
+import pgsyslogd
+
+tests = []
+
+
+class sock(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class FramedWriterTest(unittest.TestCase):
+
+    def test_buffered(self):
+        s = sock()
+        f = pgsyslogd.framedwriter(s, 'o', 5, False)
+        f.write('abc')
+        self.assertEqual(s.sent, [])
+        f.writelines([u'd\xe9', 'f'])
+        self.assertEqual(s.sent, ['o6\nabcd\xc3\xa9'])
+        f.close()
+        self.assertEqual(s.sent, ['o6\nabcd\xc3\xa9', 'o1\nf'])
+        f.flush()
+        self.assertEqual(len(s.sent), 2)
+
+    def test_unbuffered(self):
+        s = sock()
+        f = pgsyslogd.framedwriter(s, 'e', 0, True)
+        print >> f, 'x'
+        self.assertEqual(s.sent, ['e1\nx', 'e1\n\n'])
+        self.assert_(f.isatty())
+
+tests.append(FramedWriterTest)
+
+
+class RequestTest(unittest.TestCase):
+    """pgsyslogc.py requests served by a pgsyslogd.py worker over a
+    socket pair; only what pgsyslog.py does without a database"""
+
+    def request(self, argv):
+        client, server = socket.socketpair()
+        w = pgsyslogd.worker(None, optparse.Values({'verbose': False}))
+        def serve():
+            try:
+                w.serve(server)
+            finally:
+                server.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        out, err = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            status = pgsyslogc.request(client, argv, out, err)
+        finally:
+            client.close()
+            t.join()
+        self.assertEqual(w.nrequests, 1)
+        return status, out.getvalue(), err.getvalue()
+
+    def test_version(self):
+        stdout = sys.stdout
+        self.assertEqual(self.request(['--version']), (0, pgsyslog.__version__ + '\n', ''))
+        # Put back when the request is over
+        self.assert_(sys.stdout is stdout)
+
+    def test_error(self):
+        status, out, err = self.request(['--no-such-option'])
+        self.assertEqual((status, out), (2, ''))
+        self.assert_('no such option: --no-such-option' in err, err)
+
+    def test_closed(self):
+        client, server = socket.socketpair()
+        # The daemon goes away without replying
+        server.shutdown(socket.SHUT_WR)
+        try:
+            self.assertRaises(pgsyslogc.ProtocolError, pgsyslogc.request, client,
+                              ['--version'], StringIO.StringIO(), StringIO.StringIO())
+        finally:
+            client.close()
+            server.close()
+
+    def test_exitstatus(self):
+        err = StringIO.StringIO()
+        self.assertEqual(pgsyslogd.exitstatus(SystemExit(), err), 0)
+        self.assertEqual(pgsyslogd.exitstatus(SystemExit(3), err), 3)
+        self.assertEqual(pgsyslogd.exitstatus(SystemExit('failed'), err), 1)
+        self.assertEqual(err.getvalue(), 'failed\n')
+
+tests.append(RequestTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()
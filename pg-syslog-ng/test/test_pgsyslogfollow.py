@@ -0,0 +1,57 @@
+import os
+import re
+import sys
+import tempfile
+import unittest
+from test import test_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pgsyslog
+import pgsyslogfollow
+
+tests = []
+
+
+def params(clause):
+    return re.findall(r'%\((\w+)\)s', clause)
+
+
+class StreamFilterTest(unittest.TestCase):
+
+    def test_rename(self):
+        a = pgsyslogfollow.stream(0, '- -h web1 -h web2 -p postgres').filter
+        b = pgsyslogfollow.stream(1, '- -h web1 -j error').filter
+        for f, prefix in (a, 's0_'), (b, 's1_'):
+            cond = f.condition()
+            self.assert_(params(cond), cond)
+            self.assertEqual(sorted(set(params(cond))), sorted(f.sqla))
+            self.failIf([k for k in f.sqla if not k.startswith(prefix)], f.sqla)
+        # Same option, same value, but apart in one statement
+        self.failIf(set(a.sqla) & set(b.sqla))
+        self.assertEqual(a.sqla['s0_sa1_hosts_IN'], ['web1', 'web2'])
+        self.assertEqual(b.sqla['s1_sa1_hosts_IN'], ['web1'])
+
+    def test_errors(self):
+        self.assertRaises(pgsyslog.ApplicationError, pgsyslogfollow.stream, 0, '')
+        self.assertRaises(pgsyslog.ApplicationError, pgsyslogfollow.stream, 0, '- extra')
+        self.assertRaises(pgsyslog.ApplicationError, pgsyslogfollow.stream, 0,
+                          '- --no-such-option')
+
+    def test_readstreams(self):
+        fd, fn = tempfile.mkstemp()
+        try:
+            os.write(fd, '# panes\n- -h web1\n\n  out.log -p postgres  \n')
+            os.close(fd)
+            self.assertEqual(pgsyslogfollow.readstreams(fn), ['- -h web1', 'out.log -p postgres'])
+        finally:
+            os.unlink(fn)
+
+tests.append(StreamFilterTest)
+
+
+def test_main():
+    test_support.run_unittest(*tests)
+
+if __name__ == '__main__':
+    test_main()